@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+export_masks.py
+
+Export PNGs from the mask store (processing.mask_storage: "store").
+
+With the mask store, binary masks live run-length encoded in one
+masks.sqlite per tray folder instead of one PNG per mask. Pipeline steps read
+them directly; this script writes them out as PNGs at the paths they would
+have had, for viewing, sharing or tools outside DrawerDissect.
+
+Masks that already have a PNG are left alone unless --overwrite is given.
+With --remove_store, each container is deleted once all its masks exist as
+PNGs, switching those folders back to plain PNG storage.
+
+Usage:
+    python advanced_functions/export_masks.py                         # all drawers, mask_png + full_masks
+    python advanced_functions/export_masks.py --prefix 34_4_10        # filter by drawer prefix
+    python advanced_functions/export_masks.py --kind mask_png         # only the specimen masks
+    python advanced_functions/export_masks.py --prefix 34_4_10 --remove_store
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.mask_store import CONTAINER_NAME, export_pngs  # noqa: E402
+
+# Mask folders inside each drawer (paths as in config.yaml)
+MASK_KINDS = {
+    "mask_png":   os.path.join("masks", "mask_png"),
+    "full_masks": os.path.join("masks", "full_masks"),
+}
+
+
+def drawer_ids(drawers_dir: str, prefixes: list[str] | None) -> list[str]:
+    """Return sorted drawer folder names, filtered by prefix if provided."""
+    if not os.path.isdir(drawers_dir):
+        print(f"[ERROR] drawers directory not found: {drawers_dir}")
+        return []
+    return [
+        name for name in sorted(os.listdir(drawers_dir))
+        if os.path.isdir(os.path.join(drawers_dir, name))
+        and (not prefixes or any(name.startswith(p) for p in prefixes))
+    ]
+
+
+def remove_containers(root: str) -> int:
+    """Delete the containers under root (and any journal left by a crash). Returns the number removed."""
+    removed = 0
+    for dirpath, _, files in os.walk(root):
+        if CONTAINER_NAME not in files:
+            continue
+        for suffix in ("", "-journal"):
+            path = os.path.join(dirpath, CONTAINER_NAME + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+        removed += 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export mask store contents as PNGs")
+    parser.add_argument("--drawers_dir", default="drawers",
+                        help="Root drawers directory (default: 'drawers')")
+    parser.add_argument("--prefix", nargs="+", metavar="PREFIX",
+                        help="Only include drawers whose names start with these prefix(es)")
+    parser.add_argument("--kind", nargs="+", choices=sorted(MASK_KINDS), default=sorted(MASK_KINDS),
+                        help="Mask folders to export (default: all)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Rewrite PNGs that already exist")
+    parser.add_argument("--remove_store", action="store_true",
+                        help="Delete each masks.sqlite after exporting it")
+    args = parser.parse_args()
+
+    total = 0
+    for drawer_id in drawer_ids(args.drawers_dir, args.prefix):
+        for kind in args.kind:
+            root = os.path.join(args.drawers_dir, drawer_id, MASK_KINDS[kind])
+            if not os.path.isdir(root):
+                continue
+            written = export_pngs(root, overwrite=args.overwrite)
+            total += written
+            line = f"  {drawer_id}/{kind}: {written} PNGs written"
+            if args.remove_store:
+                line += f", {remove_containers(root)} containers removed"
+            print(line)
+
+    print(f"Done: {total} PNGs written")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+file_index.py
+
+Benchmark for the drawer file index (functions/file_index.py).
+
+Builds a synthetic drawer in a temporary folder (empty files only): one
+mask per specimen under masks/mask_png/<tray>/ and one pin JSON per
+specimen under masks/pin_coordinates/<tray>/. It then looks up every
+specimen's pin JSON and mask the way create_pinmask, censor_background and
+create_transparency do, once with an os.walk per lookup (the old code) and
+once through the index, and checks that both find the same files.
+
+The os.walk lookups are quadratic, so by default only a sample of them is
+timed and the total is extrapolated.
+
+Usage:
+    python benchmarks/file_index.py
+    python benchmarks/file_index.py --specimens 20000 --trays 200
+    python benchmarks/file_index.py --walk-sample 0      # time every os.walk lookup
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.file_index import index_for  # noqa: E402
+from functions.create_pinmask import find_pin_json_path  # noqa: E402
+from functions.mask_store import find_mask  # noqa: E402
+
+
+def build_drawer(root, specimens, trays):
+    """Create the synthetic drawer; returns the specimen ids."""
+    ids = []
+    per_tray = -(-specimens // trays)
+    for i in range(specimens):
+        tray = f"{i // per_tray + 1:02d}"
+        full_id = f"bench_tray_{tray}_spec_{i % per_tray:04d}"
+        for folder, name in (("mask_png", f"{full_id}.png"), ("pin_coordinates", f"{full_id}_masked.json")):
+            directory = os.path.join(root, "masks", folder, tray)
+            os.makedirs(directory, exist_ok=True)
+            open(os.path.join(directory, name), "w").close()
+        ids.append(full_id)
+    return ids
+
+
+def walk_lookup(root, filename):
+    """The per-item lookup the steps used before the index."""
+    for dirpath, _, files in os.walk(root):
+        if filename in files:
+            return os.path.join(dirpath, filename)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-item os.walk lookups with the drawer file index")
+    parser.add_argument("--specimens", type=int, default=10000, help="Specimens in the synthetic drawer")
+    parser.add_argument("--trays", type=int, default=100, help="Tray folders to spread them over")
+    parser.add_argument("--walk-sample", type=int, default=300,
+                        help="Time this many os.walk lookups and extrapolate (0 = all)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        ids = build_drawer(root, args.specimens, args.trays)
+        print(f"Built {len(ids)} specimens in {args.trays} trays ({time.perf_counter() - start:.1f}s)\n")
+
+        pins_dir = os.path.join(root, "masks", "pin_coordinates")
+        masks_dir = os.path.join(root, "masks", "mask_png")
+        lookups = [(pins_dir, f"{i}_masked.json") for i in ids] + [(masks_dir, f"{i}.png") for i in ids]
+
+        sample = lookups
+        if args.walk_sample and args.walk_sample < len(lookups):
+            sample = random.Random(0).sample(lookups, args.walk_sample)
+        start = time.perf_counter()
+        expected = {item: walk_lookup(*item) for item in sample}
+        walk_time = (time.perf_counter() - start) * len(lookups) / len(sample)
+
+        start = time.perf_counter()
+        pin_index, mask_index = index_for(pins_dir), index_for(masks_dir)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        found = {}
+        for directory, filename in lookups:
+            if directory == pins_dir:
+                found[(directory, filename)] = find_pin_json_path(filename[:-len("_masked.json")], pins_dir, pin_index)
+            else:
+                found[(directory, filename)] = find_mask(masks_dir, [filename], mask_index)
+        index_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index_for(pins_dir), index_for(masks_dir)
+        refresh_time = time.perf_counter() - start
+
+    mismatched = [item for item, path in expected.items() if found[item] != path]
+    estimated = " (estimated)" if len(sample) < len(lookups) else ""
+    print(f"{len(lookups)} lookups")
+    print(f"  os.walk per lookup: {walk_time:8.2f}s{estimated}")
+    print(f"  file index:         {build_time + index_time:8.2f}s "
+          f"(build {build_time:.2f}s, lookups {index_time:.2f}s, refresh {refresh_time * 1000:.1f}ms)")
+    print(f"  speedup:            {walk_time / (build_time + index_time):8.0f}x")
+
+    if mismatched:
+        print(f"\n{len(mismatched)} lookups found different files, e.g. {mismatched[0]}")
+        return 1
+    print(f"\nBoth methods found the same files ({len(sample)} compared)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+measure_parity.py
+
+Parity report for polygon-native measurement
+(processing.measurement_source: "polygon") against the raster path.
+
+The raster path measures the PNG written by create_masks and cleaned by
+fix_masks. The polygon path reads the outline_specimens JSON directly. This
+script runs both on every specimen that has a JSON and a mask PNG, then
+reports how far len1_px, len2_px and area_px drift (median, 95th percentile,
+max) and lists the specimens that differ most. The drift comes from pixel
+boundaries: create_masks draws the polygon outline in black, and the raster
+contour then runs through the centres of the remaining edge pixels, so raster
+lengths and areas come out slightly smaller than the polygon's. Overlapping
+polygons also merge into one raster component but are measured separately
+from the JSON.
+
+Run fix_masks before comparing, so both paths keep only the largest part.
+
+Usage:
+    python benchmarks/measure_parity.py drawers/drawer_01
+    python benchmarks/measure_parity.py drawers/* --csv parity.csv
+    python benchmarks/measure_parity.py drawers/drawer_01 --engine compat --top 20
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.measure import process_mask, process_polygons  # noqa: E402
+
+MASK_COORDINATES = Path("masks/mask_coordinates")
+MASK_PNG = Path("masks/mask_png")
+
+
+def find_pairs(drawer_dirs):
+    """Yield (full_id, json_path, png_path) for specimens with both outputs."""
+    for drawer in drawer_dirs:
+        json_root = Path(drawer) / MASK_COORDINATES
+        png_root = Path(drawer) / MASK_PNG
+        for json_path in sorted(json_root.rglob("*.json")):
+            png_path = png_root / json_path.relative_to(json_root).with_suffix(".png")
+            if png_path.exists():
+                yield json_path.stem, json_path, png_path
+
+
+def summarise(df, column):
+    diff = df[f"{column}_rel_diff"].abs() * 100
+    return (f"{column:<8} median {diff.median():6.2f}%   p95 {diff.quantile(0.95):6.2f}%   "
+            f"max {diff.max():6.2f}%   mean signed {df[f'{column}_rel_diff'].mean() * 100:+6.2f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare polygon and raster measurements")
+    parser.add_argument("drawers", nargs="+", help="Drawer folders (drawers/<drawer_id>)")
+    parser.add_argument("--engine", default="compat", choices=["compat", "calipers"])
+    parser.add_argument("--csv", help="Write per-specimen results to this CSV")
+    parser.add_argument("--top", type=int, default=10, help="List the N largest area differences")
+    args = parser.parse_args()
+
+    rows = []
+    timings = {"raster": 0.0, "polygon": 0.0}
+    for full_id, json_path, png_path in find_pairs(args.drawers):
+        start = time.perf_counter()
+        raster = process_mask(str(png_path), args.engine)
+        timings["raster"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        polygon = process_polygons(str(json_path), args.engine)
+        timings["polygon"] += time.perf_counter() - start
+
+        if raster[0] is None or polygon[0] is None:
+            continue
+        row = {"full_id": full_id}
+        for column, index in (("len1_px", 0), ("len2_px", 2), ("area_px", 4)):
+            row[f"{column}_raster"] = raster[index]
+            row[f"{column}_polygon"] = polygon[index]
+            row[f"{column}_rel_diff"] = (polygon[index] - raster[index]) / raster[index] if raster[index] else np.nan
+        rows.append(row)
+
+    if not rows:
+        print("No specimens with both a mask JSON and a mask PNG found")
+        return 1
+
+    df = pd.DataFrame(rows)
+    print(f"Compared {len(df)} specimens (engine: {args.engine})\n")
+    for column in ("len1_px", "len2_px", "area_px"):
+        print(summarise(df, column))
+
+    print(f"\nMeasure time  raster {timings['raster']:.2f}s (PNG decode + contours)   "
+          f"polygon {timings['polygon']:.2f}s (JSON)")
+    print("The polygon path also makes create_masks/fix_masks unnecessary for measuring.")
+
+    worst = df.reindex(df["area_px_rel_diff"].abs().sort_values(ascending=False).index).head(args.top)
+    print(f"\nLargest area differences:")
+    for _, row in worst.iterrows():
+        print(f"  {row['full_id']:<40} area {row['area_px_raster']:>10.0f} -> {row['area_px_polygon']:>10.0f}"
+              f"  ({row['area_px_rel_diff'] * 100:+.2f}%)")
+
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+        print(f"\nPer-specimen results written to {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+measure_regression.py
+
+Regression check for the len1/len2 engines in functions/measure.py, run over
+a corpus of real specimen masks.
+
+For every mask PNG found under the given folders it measures the largest
+contour with both engines:
+
+    compat    - the original all-pairs search (angle tolerance for len2)
+    calipers  - rotating calipers (hull diameter, width perpendicular to it)
+
+and reports:
+    - compat vs the reference measurements.csv files (if --reference or the
+      drawer's own measurements/measurements.csv exist). These were written by
+      the old nested-loop code, so compat must match them exactly.
+    - calipers vs compat: len1 must match; len2 differs by design (the width
+      is measured exactly perpendicular, while compat allowed ~5.7 degrees of
+      tilt) and the size of that shift is summarised.
+    - time spent in each engine.
+
+Exits with status 1 if compat disagrees with a reference value or the two
+engines disagree on len1.
+
+Usage:
+    python benchmarks/measure_regression.py drawers/*/masks/mask_png
+    python benchmarks/measure_regression.py drawers/drawer_01/masks/mask_png \
+        --reference drawers/drawer_01/measurements/measurements.csv
+    python benchmarks/measure_regression.py drawers/*/masks/mask_png --limit 500
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.measure import get_lengths  # noqa: E402
+
+TOLERANCE = 1e-6
+
+
+def find_masks(folders, limit=None):
+    masks = []
+    for folder in folders:
+        masks.extend(sorted(Path(folder).rglob("*.png")))
+    return masks[:limit] if limit else masks
+
+
+def load_references(folders, extra_csvs):
+    """full_id -> (len1_px, len2_px, area_px) from measurements.csv files."""
+    csvs = [Path(p) for p in extra_csvs]
+    for folder in folders:
+        # drawers/<id>/masks/mask_png -> drawers/<id>/measurements/measurements.csv
+        candidate = Path(folder).resolve().parent.parent / "measurements" / "measurements.csv"
+        if candidate.exists():
+            csvs.append(candidate)
+
+    references = {}
+    for csv_path in csvs:
+        df = pd.read_csv(csv_path)
+        for _, row in df.dropna(subset=["len1_px", "len2_px"]).iterrows():
+            references[row["full_id"]] = (row["len1_px"], row["len2_px"], row.get("area_px"))
+    return references
+
+
+def largest_contour(mask_path):
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None
+    _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return max(contours, key=cv2.contourArea) if contours else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare measurement engines on real masks")
+    parser.add_argument("folders", nargs="+", help="Folders containing mask PNGs (searched recursively)")
+    parser.add_argument("--reference", action="append", default=[],
+                        help="Extra measurements.csv to compare compat output against (repeatable)")
+    parser.add_argument("--limit", type=int, help="Only check the first N masks")
+    args = parser.parse_args()
+
+    masks = find_masks(args.folders, args.limit)
+    if not masks:
+        print("No mask PNGs found")
+        return 1
+    references = load_references(args.folders, args.reference)
+    print(f"Checking {len(masks)} masks ({len(references)} reference rows)")
+
+    timings = {"compat": 0.0, "calipers": 0.0}
+    failures = []
+    len2_shift = []
+    checked_refs = 0
+
+    for mask_path in masks:
+        contour = largest_contour(mask_path)
+        if contour is None:
+            continue
+        full_id = mask_path.stem
+
+        results = {}
+        for engine in timings:
+            start = time.perf_counter()
+            results[engine] = get_lengths(contour, engine)
+            timings[engine] += time.perf_counter() - start
+
+        compat, calipers = results["compat"], results["calipers"]
+        if compat[0] is None:
+            continue
+
+        if abs(compat[0] - calipers[0]) > TOLERANCE:
+            failures.append(f"{full_id}: len1 compat={compat[0]:.4f} calipers={calipers[0]:.4f}")
+        if compat[2]:
+            len2_shift.append((calipers[2] - compat[2]) / compat[2])
+
+        if full_id in references:
+            checked_refs += 1
+            ref_len1, ref_len2, ref_area = references[full_id]
+            if abs(compat[0] - ref_len1) > TOLERANCE or abs(compat[2] - ref_len2) > TOLERANCE:
+                failures.append(f"{full_id}: compat ({compat[0]:.4f}, {compat[2]:.4f}) "
+                                f"!= reference ({ref_len1:.4f}, {ref_len2:.4f})")
+            if ref_area is not None and not pd.isna(ref_area) and \
+                    abs(cv2.contourArea(contour) - ref_area) > TOLERANCE:
+                failures.append(f"{full_id}: area {cv2.contourArea(contour):.1f} != reference {ref_area:.1f}")
+
+    print(f"\nCompared with reference CSVs: {checked_refs}")
+    print(f"compat   total {timings['compat']:.3f}s")
+    print(f"calipers total {timings['calipers']:.3f}s")
+    if len2_shift:
+        shift = np.array(len2_shift) * 100
+        print(f"len2 calipers vs compat: median {np.median(shift):+.2f}%, "
+              f"min {shift.min():+.2f}%, max {shift.max():+.2f}%")
+
+    if failures:
+        print(f"\n{len(failures)} regressions:")
+        for line in failures[:50]:
+            print(f"  {line}")
+        return 1
+
+    print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
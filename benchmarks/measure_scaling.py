@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+measure_scaling.py
+
+Scaling benchmark for measure_specimens on the process pool.
+
+Runs generate_csv_with_measurements over the given mask folder once per
+worker count (1, 2, 4, ... up to the number of cores, or --workers), each
+time into a fresh temporary output folder with visualizations off, and
+reports wall time, masks per second and speedup over one worker. The CSVs
+of all runs are compared, so a speedup that changed the results shows up
+as a failure.
+
+Usage:
+    python benchmarks/measure_scaling.py drawers/drawer_01/masks/mask_png
+    python benchmarks/measure_scaling.py drawers/drawer_01/masks/mask_png --workers 1 2 4 8
+    python benchmarks/measure_scaling.py drawers/drawer_01/masks/mask_png --chunk-size 16 --engine compat
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.measure import generate_csv_with_measurements  # noqa: E402
+
+
+def default_worker_counts():
+    counts, n = [], 1
+    while n < cpu_count():
+        counts.append(n)
+        n *= 2
+    return counts + [cpu_count()]
+
+
+def run_once(mask_dir, workers, chunk_size, engine):
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        generate_csv_with_measurements(
+            mask_dir, output_dir, visualization_mode="off", length_engine=engine,
+            sequential=workers == 1, max_workers=workers, chunk_size=chunk_size,
+        )
+        elapsed = time.perf_counter() - start
+        df = pd.read_csv(os.path.join(output_dir, "measurements.csv"))
+    return elapsed, df.sort_values("full_id").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure measure_specimens scaling with worker count")
+    parser.add_argument("mask_dir", help="Folder of mask PNGs (searched recursively)")
+    parser.add_argument("--workers", type=int, nargs="+", help="Worker counts to try (default: 1, 2, 4, ... cores)")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Masks per task")
+    parser.add_argument("--engine", default="compat", choices=["compat", "calipers"])
+    args = parser.parse_args()
+
+    masks = sum(1 for _ in Path(args.mask_dir).rglob("*.png"))
+    if not masks:
+        print("No mask PNGs found")
+        return 1
+
+    worker_counts = args.workers or default_worker_counts()
+    print(f"{masks} masks, {cpu_count()} cores, chunk size {args.chunk_size}, engine {args.engine}\n")
+    print(f"{'workers':>7}  {'time':>8}  {'masks/s':>8}  {'speedup':>7}")
+
+    baseline_time, baseline_df, mismatched = None, None, []
+    for workers in worker_counts:
+        elapsed, df = run_once(args.mask_dir, workers, args.chunk_size, args.engine)
+        if baseline_time is None:
+            baseline_time, baseline_df = elapsed, df
+        elif not df.equals(baseline_df):
+            mismatched.append(workers)
+        print(f"{workers:>7}  {elapsed:>7.2f}s  {masks / elapsed:>8.1f}  {baseline_time / elapsed:>6.2f}x")
+
+    if mismatched:
+        print(f"\nResults differ from the first run for worker counts: {mismatched}")
+        return 1
+    print("\nAll runs produced the same measurements")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,7 @@ class DrawerDissectConfig:
         self._roboflow_cache = None
         self._api_keys_cache = None
         self._runner_cache: Dict[str, Any] = {}
+        self._llm_client_cache = None
         self._setup_base_directories()
 
     # ------------------------------------------------------------------
@@ -49,6 +50,12 @@ class DrawerDissectConfig:
     def set_cached_runner(self, model_key: str, runner):
         self._runner_cache[model_key] = runner
 
+    def get_cached_llm_client(self):
+        return self._llm_client_cache
+
+    def set_cached_llm_client(self, client):
+        self._llm_client_cache = client
+
     # ------------------------------------------------------------------
     # Local inference
     # ------------------------------------------------------------------
@@ -158,7 +165,8 @@ class DrawerDissectConfig:
             return []
         return sorted(
             item for item in os.listdir(drawers_base)
-            if os.path.isdir(os.path.join(drawers_base, item)) and item != "unsorted"
+            if os.path.isdir(os.path.join(drawers_base, item))
+            and item != "unsorted" and not item.startswith(".")
         )
 
     def setup_drawer_directories(self, drawer_id: str):
@@ -178,6 +186,11 @@ class DrawerDissectConfig:
         subdir = self._config["directories"]["drawer_subdirs"][subdir_key]
         return os.path.join(self.get_drawer_path(drawer_id), subdir)
 
+    def get_drawer_directories(self, drawer_id: str) -> Dict[str, str]:
+        """Path of every drawer subfolder, by key."""
+        return {key: self.get_drawer_directory(drawer_id, key)
+                for key in self._config["directories"]["drawer_subdirs"]}
+
     def move_image_to_drawer(self, drawer_id: str, filename: str) -> bool:
         src = os.path.join(self.unsorted_directory, filename)
         if not os.path.exists(src):
@@ -227,6 +240,86 @@ class DrawerDissectConfig:
         }
         return {**defaults, **self._config.get("traycontext_settings", {})}
 
+    @property
+    def streaming_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "queue_size": 32,
+            "inference_workers": 4,
+            "cpu_workers": None,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("streaming", {})}
+
+    @property
+    def watch_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "mode": "auto",
+            "poll_seconds": 10,
+            "settle_seconds": 30,
+            "status_seconds": 60,
+            "status_file": None,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("watch", {})}
+
+    @property
+    def queue_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "directory": None,
+            "lease_seconds": 300,
+            "heartbeat_seconds": 30,
+            "poll_seconds": 10,
+            "max_attempts": 3,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("queue", {})}
+
+    @property
+    def instrumentation_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "enabled": True,
+            "directory": "run_logs",
+            "item_records": True,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("instrumentation", {})}
+
+    @property
+    def progress_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "refresh_seconds": 0.5,
+            "plain_seconds": 30,
+            "event_log": True,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("progress", {})}
+
+    @property
+    def metrics_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "port": None,
+            "host": "127.0.0.1",
+            "textfile_directory": None,
+            "textfile_seconds": 15,
+        }
+        return {**defaults, **self._config.get("resources", {}).get("metrics", {})}
+
+    @property
+    def scheduling_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "parallel_drawers": 1,
+            "cpu_slots": 1,
+            "inference_slots": 2,
+            "llm_slots": 2,
+            "memory_gb": None,
+            "step_memory_gb": {},
+        }
+        return {**defaults, **self._config.get("resources", {}).get("scheduling", {})}
+
+    @property
+    def resource_scheduler_settings(self) -> Dict[str, Any]:
+        defaults = {
+            "memory_limit_gb": None,
+            "memory_fraction": 0.75,
+            "bytes_per_pixel": {},
+        }
+        return {**defaults, **self._config.get("resources", {}).get("scheduler", {})}
+
     def get_memory_config(self, step: str) -> Dict[str, Any]:
         memory = self._config.get("resources", {}).get("memory", {})
         override = memory.get("step_overrides", {}).get(step, {})
@@ -1,8 +1,29 @@
 import os
 import numpy as np
 from PIL import Image
-from concurrent.futures import ProcessPoolExecutor
 from logging_utils import log, log_found, log_progress
+from functions.mask_store import mask_exists, read_mask, find_mask
+from functions.file_index import index_for
+from functions.resource_scheduler import run_tasks
+from functions.instrumentation import phase
+
+def fit_mask(mask_np, size):
+    """Resize a mask to an image size (width, height) if needed, keeping hard edges."""
+    if (mask_np.shape[1], mask_np.shape[0]) == size:
+        return mask_np
+    return np.array(Image.fromarray(mask_np).resize(size, Image.Resampling.NEAREST))
+
+def censor_array(specimen_np, mask_np):
+    """
+    Whiten the background of an RGB specimen array in place and return it.
+
+    Specimen pixels are limited to 1-254 so they never collide with the white
+    background; pixels where the mask is not above 128 become 255.
+    """
+    mask_np = fit_mask(mask_np, (specimen_np.shape[1], specimen_np.shape[0]))
+    np.clip(specimen_np, 1, 254, out=specimen_np)
+    specimen_np[mask_np <= 128] = 255
+    return specimen_np
 
 def process_masking(args):
     """
@@ -20,32 +41,23 @@ def process_masking(args):
     
     try:
         # Open and process the specimen image
-        specimen_img = Image.open(specimen_path)
-        if specimen_img.mode in ('RGBA', 'LA') or (specimen_img.mode == 'P' and 'transparency' in specimen_img.info):
-            specimen_img = specimen_img.convert('RGB')
-        
-        # Open and process the mask
-        mask_img = Image.open(mask_path).convert('L')
+        with phase("decode"):
+            specimen_img = Image.open(specimen_path)
+            if specimen_img.mode != 'RGB':
+                specimen_img = specimen_img.convert('RGB')
+            specimen_np = np.array(specimen_img)
         
-        # Ensure mask and specimen are the same size
-        if specimen_img.size != mask_img.size:
-            mask_img = mask_img.resize(specimen_img.size, Image.Resampling.NEAREST)
+        # Open and process the mask (PNG or mask store)
+        mask_np = read_mask(mask_path)
+        if mask_np is None:
+            log(f"Could not read mask {mask_path}")
+            return False
         
-        # Convert to numpy arrays for processing
-        specimen_np = np.array(specimen_img)
-        mask_np = np.array(mask_img) / 255.0
-        
-        # Limit specimen pixels to range 1-254 to avoid overlap with background/mask values
-        specimen_np = np.clip(specimen_np, 1, 254)
-        
-        background_img = np.ones_like(specimen_np) * 255  # White background
-        
-        # Apply the mask
-        result_np = (specimen_np * np.stack([mask_np] * 3, axis=-1) +
-                    background_img * (1 - np.stack([mask_np] * 3, axis=-1))).astype(np.uint8)
+        result_np = censor_array(specimen_np, mask_np)
         
         # Save the result
-        Image.fromarray(result_np).save(output_path)
+        with phase("encode"):
+            Image.fromarray(result_np).save(output_path)
         log_progress("censor_background", current, total, f"Processed {os.path.basename(specimen_path)}")
         return True
         
@@ -53,10 +65,13 @@ def process_masking(args):
         log(f"Error processing {os.path.basename(specimen_path)}: {str(e)}")
         return False
 
-def find_mask_path(specimen_path, mask_dir):
+def find_mask_path(specimen_path, mask_dir, index=None):
     """
     Find the corresponding mask for a specimen image.
     Handles both standard tray-based naming and custom specimen-only naming.
+    
+    Args:
+        index: FileIndex of mask_dir to reuse (default: index_for(mask_dir))
     """
     # Extract full_id from specimen path
     base_name = os.path.splitext(os.path.basename(specimen_path))[0]
@@ -71,7 +86,7 @@ def find_mask_path(specimen_path, mask_dir):
         if '_tray_' in base_name and '_spec' in base_name:
             # Standard naming: construct mask path with tray subfolder
             mask_path = os.path.join(mask_dir, tray_id, f"{base_name}.png")
-            if os.path.exists(mask_path):
+            if mask_exists(mask_path):
                 return mask_path
     
     # Method 2: Try direct mask lookup (for custom specimen naming)
@@ -80,20 +95,20 @@ def find_mask_path(specimen_path, mask_dir):
     
     # First try the root mask directory
     direct_mask_path = os.path.join(mask_dir, mask_filename)
-    if os.path.exists(direct_mask_path):
+    if mask_exists(direct_mask_path):
         return direct_mask_path
     
     # Search recursively in subdirectories
-    for root, _, files in os.walk(mask_dir):
-        if mask_filename in files:
-            return os.path.join(root, mask_filename)
+    found = find_mask(mask_dir, [mask_filename], index)
+    if found:
+        return found
     
     # Method 3: Try flat structure assuming specimens are not in tray subfolders
     # This handles the case where specimens are directly in the specimens folder
     if len(path_parts) >= 2:
         specimens_subdir = path_parts[-2]  # Could be a subfolder within specimens
         mask_path = os.path.join(mask_dir, specimens_subdir, f"{base_name}.png")
-        if os.path.exists(mask_path):
+        if mask_exists(mask_path):
             return mask_path
     
     return None
@@ -114,6 +129,7 @@ def censor_background(specimens_dir, mask_dir, masked_specs_dir):
     # Find all specimen images that need processing
     tasks = []
     supported_formats = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+    mask_index = index_for(mask_dir)
     
     for root, _, files in os.walk(specimens_dir):
         for file in files:
@@ -121,7 +137,7 @@ def censor_background(specimens_dir, mask_dir, masked_specs_dir):
                 continue
                 
             specimen_path = os.path.join(root, file)
-            mask_path = find_mask_path(specimen_path, mask_dir)
+            mask_path = find_mask_path(specimen_path, mask_dir, mask_index)
             
             if not mask_path:
                 # Log missing masks for debugging
@@ -155,8 +171,8 @@ def censor_background(specimens_dir, mask_dir, masked_specs_dir):
     processed = 0
     skipped = 0
     
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(process_masking, tasks))
+    # Through run_tasks so each specimen is measured in the run log
+    results = run_tasks(process_masking, tasks, "censor_background", [t[0] for t in tasks])
         
     for result in results:
         if result:
@@ -1,8 +1,36 @@
 import os
 import json
+import numpy as np
 from PIL import Image, ImageDraw
 from concurrent.futures import ThreadPoolExecutor
-from logging_utils import log, log_found, log_progress
+from logging_utils import log, log_found, log_progress, worker_setup
+from functions.mask_store import mask_exists, write_mask
+from functions.instrumentation import item, phase
+
+def rasterize_polygons(data):
+    """
+    Fill every predicted polygon of a segmentation result into a binary 'L' image.
+    Returns None if the result has no valid image dimensions.
+    """
+    image_info = data.get('image', {})
+    img_width = int(image_info.get('width', 0))
+    img_height = int(image_info.get('height', 0))
+
+    if not (img_width and img_height):
+        return None
+
+    binary_mask = Image.new('L', (img_width, img_height))
+    draw = ImageDraw.Draw(binary_mask)
+
+    for prediction in data.get('predictions', []):
+        points = prediction.get('points', [])
+        if not points:
+            continue
+
+        xy = [(int(point['x']), int(point['y'])) for point in points]
+        draw.polygon(xy, outline=0, fill=255)
+
+    return binary_mask
 
 def process_mask(args):
     """
@@ -11,37 +39,31 @@ def process_mask(args):
     Returns:
         bool: True if processed successfully, False otherwise
     """
-    json_path, png_path, current, total = args
+    json_path, png_path, current, total, store = args
     
     # Skip if mask already exists
-    if os.path.exists(png_path):
+    if mask_exists(png_path):
         log_progress("create_masks", current, total, f"Skipped (already exists)")
         return False
     
+    with item(os.path.basename(png_path), png_path):
+        return _make_mask(json_path, png_path, current, total, store)
+
+def _make_mask(json_path, png_path, current, total, store):
     try:
         with open(json_path, 'r') as f:
             data = json.load(f)
             
-        image_info = data.get('image', {})
-        img_width = int(image_info.get('width', 0))
-        img_height = int(image_info.get('height', 0))
-        
-        if not (img_width and img_height):
+        binary_mask = rasterize_polygons(data)
+        if binary_mask is None:
             log(f"Skipped {json_path}: Invalid dimensions")
             return False
-            
-        binary_mask = Image.new('L', (img_width, img_height))
-        draw = ImageDraw.Draw(binary_mask)
-        
-        for prediction in data.get('predictions', []):
-            points = prediction.get('points', [])
-            if not points:
-                continue
-                
-            xy = [(int(point['x']), int(point['y'])) for point in points]
-            draw.polygon(xy, outline=0, fill=255)
         
-        binary_mask.save(png_path, optimize=True)
+        if store:
+            write_mask(png_path, np.asarray(binary_mask), store=True)
+        else:
+            with phase("encode", png_path):
+                binary_mask.save(png_path, optimize=True)
         log_progress("create_masks", current, total, f"Created mask")
         return True
         
@@ -49,7 +71,7 @@ def process_mask(args):
         log(f"Error with {os.path.basename(json_path)}: {str(e)}")
         return False
 
-def create_masks(jsondir, pngdir):
+def create_masks(jsondir, pngdir, store=False):
     """
     Create binary masks from segmentation JSON files.
     Handles both tray-based and specimen-only directory structures.
@@ -57,6 +79,7 @@ def create_masks(jsondir, pngdir):
     Args:
         jsondir: Directory containing segmentation JSON files
         pngdir: Directory to save binary mask PNG files
+        store: Save masks in per-tray containers instead of PNGs (see mask_store)
     """
     # Ensure output directory exists
     os.makedirs(pngdir, exist_ok=True)
@@ -92,8 +115,8 @@ def create_masks(jsondir, pngdir):
     log_found("segmentation files", len(tasks))
     
     # Add progress tracking indices
-    tasks = [(t[0], t[1], i+1, len(tasks)) for i, t in enumerate(tasks)]
+    tasks = [(t[0], t[1], i+1, len(tasks), store) for i, t in enumerate(tasks)]
     
     # Process masks in parallel
-    with ThreadPoolExecutor() as executor:
+    with ThreadPoolExecutor(**worker_setup()) as executor:
         results = list(executor.map(lambda x: process_mask(x), tasks))
\ No newline at end of file
@@ -1,14 +1,20 @@
 import os
 import json
 import shutil
+import numpy as np
 from PIL import Image, ImageDraw
 from concurrent.futures import ProcessPoolExecutor
-from logging_utils import log, log_found, log_progress
+from logging_utils import log, log_found, log_progress, worker_setup
+from functions.mask_store import mask_exists, read_mask, write_mask, iter_masks
+from functions.file_index import index_for
 
-def find_pin_json_path(base_name, coord_input_dir):
+def find_pin_json_path(base_name, coord_input_dir, index=None):
     """
     Find the corresponding pin JSON file for a mask.
     Handles both tray-based and flat directory structures.
+    
+    Args:
+        index: FileIndex of coord_input_dir to reuse (default: index_for(coord_input_dir))
     """
     json_filename = f"{base_name}_masked.json"
     
@@ -17,12 +23,22 @@ def find_pin_json_path(base_name, coord_input_dir):
     if os.path.exists(direct_json_path):
         return direct_json_path
     
-    # Search recursively in subdirectories
-    for root, _, files in os.walk(coord_input_dir):
-        if json_filename in files:
-            return os.path.join(root, json_filename)
-    
-    return None
+    # Look up in subdirectories
+    return (index or index_for(coord_input_dir)).find(json_filename)
+
+def save_full_mask(image, output_path, store):
+    """Save a full mask as a PNG, or as a binary mask in the mask store."""
+    if store:
+        write_mask(output_path, np.asarray(image.convert("L")), store=True)
+    else:
+        image.save(output_path)
+
+def copy_unedited(image_path, mask_image, output_path, store):
+    """Keep the specimen mask unchanged as the full mask (a file copy when both are PNGs)."""
+    if not store and os.path.exists(image_path):
+        shutil.copy(image_path, output_path)
+    else:
+        save_full_mask(mask_image, output_path, store)
 
 def process_mask(args):
     """
@@ -31,7 +47,7 @@ def process_mask(args):
     Returns:
         str: Status message
     """
-    image_path, coord_input_dir, output_dir, base_name, current, total = args
+    image_path, coord_input_dir, output_dir, base_name, current, total, store = args
     
     # First check if any version of the output already exists
     existing_files = [
@@ -42,7 +58,7 @@ def process_mask(args):
     for i in range(1, 10):  # Assuming no more than 9 pins
         existing_files.append(os.path.join(output_dir, f"{base_name}_fullmask_{i}.png"))
         
-    if any(os.path.exists(f) for f in existing_files):
+    if any(mask_exists(f) for f in existing_files):
         log_progress("create_pinmask", current, total, f"Skipped (already exists)")
         return False
     
@@ -50,7 +66,11 @@ def process_mask(args):
     json_path = find_pin_json_path(base_name, coord_input_dir)
     
     try:
-        with Image.open(image_path).convert("RGB") as mask_image:
+        mask_np = read_mask(image_path)
+        if mask_np is None:
+            log(f"Could not read mask {image_path}")
+            return False
+        with Image.fromarray(mask_np).convert("RGB") as mask_image:
             if json_path and os.path.exists(json_path):
                 with open(json_path, 'r') as f:
                     data = json.load(f)
@@ -72,7 +92,7 @@ def process_mask(args):
                         draw = ImageDraw.Draw(separate_mask)
                         draw.polygon(points, fill="black")
                         separate_output_path = os.path.join(output_dir, f"{base_name}_fullmask_{i}.png")
-                        separate_mask.save(separate_output_path)
+                        save_full_mask(separate_mask, separate_output_path, store)
                     
                     log_progress("create_pinmask", current, total, f"Created {pin_count} pin masks")
                     return True
@@ -82,7 +102,7 @@ def process_mask(args):
                     draw = ImageDraw.Draw(mask_image)
                     draw.polygon(pin_polygons[0], fill="black")
                     output_path = os.path.join(output_dir, f"{base_name}_fullmask.png")
-                    mask_image.save(output_path)
+                    save_full_mask(mask_image, output_path, store)
                     
                     log_progress("create_pinmask", current, total, f"Created 1 pin mask")
                     return True
@@ -90,7 +110,7 @@ def process_mask(args):
                 else:
                     # No pins found, copy original image as unedited
                     output_path = os.path.join(output_dir, f"{base_name}_fullmask_unedited.png")
-                    shutil.copy(image_path, output_path)
+                    copy_unedited(image_path, mask_image, output_path, store)
                     
                     log_progress("create_pinmask", current, total, f"No pins found")
                     return True
@@ -98,7 +118,7 @@ def process_mask(args):
             else:
                 # No JSON file found, copy original image as unedited
                 output_path = os.path.join(output_dir, f"{base_name}_fullmask_unedited.png")
-                shutil.copy(image_path, output_path)
+                copy_unedited(image_path, mask_image, output_path, store)
                 
                 log_progress("create_pinmask", current, total, f"No JSON data")
                 return True
@@ -107,15 +127,16 @@ def process_mask(args):
         log(f"Error creating pin mask for {base_name}: {str(e)}")
         return False
 
-def create_pinmask(image_input_dir, coord_input_dir, output_dir):
+def create_pinmask(image_input_dir, coord_input_dir, output_dir, store=False):
     """
     Create pin masks from specimen masks and pin segmentation data.
     Supports both tray-based and specimen-only directory structures.
     
     Args:
-        image_input_dir: Directory containing specimen mask images
+        image_input_dir: Directory containing specimen mask images (PNGs or mask store)
         coord_input_dir: Directory containing pin segmentation JSON files
         output_dir: Directory to save the combined masks
+        store: Save the combined masks in per-tray containers instead of PNGs (see mask_store)
     """
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -123,27 +144,23 @@ def create_pinmask(image_input_dir, coord_input_dir, output_dir):
     # Find all mask images and prepare tasks
     tasks = []
     
-    for root, _, files in os.walk(image_input_dir):
-        for file in files:
-            if not file.endswith('.png'):
-                continue
-                
-            # Get the specimen ID and paths
-            full_id = file.replace('.png', '')
-            image_path = os.path.join(root, file)
-            
-            # Create output directory with the same relative structure
-            rel_path = os.path.relpath(root, image_input_dir)
-            if rel_path == '.':
-                # Files are in the root - put outputs in root of output_dir
-                out_subfolder = output_dir
-            else:
-                # Files are in subdirectories - mirror the structure
-                out_subfolder = os.path.join(output_dir, rel_path)
-            
-            os.makedirs(out_subfolder, exist_ok=True)
-            
-            tasks.append((image_path, coord_input_dir, out_subfolder, full_id))
+    for image_path in iter_masks(image_input_dir):
+        # Get the specimen ID and paths
+        root = os.path.dirname(image_path)
+        full_id = os.path.splitext(os.path.basename(image_path))[0]
+        
+        # Create output directory with the same relative structure
+        rel_path = os.path.relpath(root, image_input_dir)
+        if rel_path == '.':
+            # Files are in the root - put outputs in root of output_dir
+            out_subfolder = output_dir
+        else:
+            # Files are in subdirectories - mirror the structure
+            out_subfolder = os.path.join(output_dir, rel_path)
+        
+        os.makedirs(out_subfolder, exist_ok=True)
+        
+        tasks.append((image_path, coord_input_dir, out_subfolder, full_id))
     
     if not tasks:
         log("No mask files found to process")
@@ -152,11 +169,11 @@ def create_pinmask(image_input_dir, coord_input_dir, output_dir):
     log_found("mask files", len(tasks))
     
     # Add progress tracking indices
-    tasks = [(t[0], t[1], t[2], t[3], i+1, len(tasks)) for i, t in enumerate(tasks)]
+    tasks = [(t[0], t[1], t[2], t[3], i+1, len(tasks), store) for i, t in enumerate(tasks)]
     
     # Process masks in parallel
     processed = 0
     skipped = 0
     
-    with ProcessPoolExecutor() as executor:
+    with ProcessPoolExecutor(**worker_setup()) as executor:
         results = list(executor.map(process_mask, tasks))
\ No newline at end of file
@@ -1,15 +1,20 @@
 import os
+import numpy as np
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
-import multiprocessing
 import logging
 from typing import Tuple, List, Optional
+from functions.resource_scheduler import run_tasks
+from functions.mask_store import mask_exists, read_mask, find_mask
+from functions.censor_background import fit_mask
+from functions.file_index import FileIndex, index_for
+from functions.instrumentation import phase
+from logging_utils import log, log_found, log_progress
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
-def find_mask_path(specimen_path: str, mask_dir: str) -> Optional[str]:
+def find_mask_path(specimen_path: str, mask_dir: str, index: Optional[FileIndex] = None) -> Optional[str]:
     """
     Find the corresponding mask for a specimen image with _masked in the filename.
     Supports both tray-based and specimen-only directory structures.
@@ -17,6 +22,7 @@ def find_mask_path(specimen_path: str, mask_dir: str) -> Optional[str]:
     Args:
         specimen_path: Path to the specimen image
         mask_dir: Directory containing mask files
+        index: FileIndex of mask_dir to reuse (default: index_for(mask_dir))
         
     Returns:
         Optional[str]: Path to the mask file or None if not found
@@ -39,7 +45,7 @@ def find_mask_path(specimen_path: str, mask_dir: str) -> Optional[str]:
             
             for mask_name in mask_options:
                 mask_path = os.path.join(mask_subdir, mask_name)
-                if os.path.exists(mask_path):
+                if mask_exists(mask_path):
                     return mask_path
     
     # Method 2: Try direct lookup in mask_dir (for specimen-only drawers)
@@ -52,96 +58,80 @@ def find_mask_path(specimen_path: str, mask_dir: str) -> Optional[str]:
     # First try the root mask directory
     for mask_name in mask_options:
         direct_mask_path = os.path.join(mask_dir, mask_name)
-        if os.path.exists(direct_mask_path):
+        if mask_exists(direct_mask_path):
             return direct_mask_path
     
     # Method 3: Search recursively in subdirectories
-    for root, _, files in os.walk(mask_dir):
-        for mask_name in mask_options:
-            if mask_name in files:
-                return os.path.join(root, mask_name)
+    found = find_mask(mask_dir, mask_options, index)
+    if found:
+        return found
     
     # Method 4: Try flat structure assuming specimens are not in tray subfolders
     if len(path_parts) >= 2:
         specimens_subdir = path_parts[-2]  # Could be a subfolder within specimens
         for mask_name in mask_options:
             mask_path = os.path.join(mask_dir, specimens_subdir, mask_name)
-            if os.path.exists(mask_path):
+            if mask_exists(mask_path):
                 return mask_path
             
     return None
 
-def process_single_image(args: Tuple[str, str, str, str]) -> bool:
+def save_cutouts(specimen_np: np.ndarray, mask_np: np.ndarray,
+                 transparent_output_path: str, whitebg_output_path: str) -> None:
+    """
+    Save the transparent (RGBA) and white background versions of a specimen.
+
+    Pixels where the mask is above 128 are kept; the rest become transparent or
+    white. specimen_np (RGB, uint8) is overwritten with the white background
+    version.
+    """
+    mask_np = fit_mask(mask_np, (specimen_np.shape[1], specimen_np.shape[0]))
+    foreground = mask_np > 128
+
+    rgba = np.empty(specimen_np.shape[:2] + (4,), dtype=np.uint8)
+    rgba[..., :3] = specimen_np
+    rgba[..., 3] = foreground
+    rgba[..., 3] *= 255
+    with phase("encode"):
+        Image.fromarray(rgba, 'RGBA').save(transparent_output_path, "PNG", optimize=True)
+    del rgba
+
+    specimen_np[~foreground] = 255
+    with phase("encode"):
+        Image.fromarray(specimen_np, 'RGB').save(whitebg_output_path)
+
+def process_single_image(args: Tuple[str, str, str, str, int, int]) -> bool:
     """
     Process a single specimen image with its mask to create transparent versions.
     
     Args:
-        args: Tuple of (specimen_path, mask_path, transparent_output_path, whitebg_output_path)
+        args: Tuple of (specimen_path, mask_path, transparent_output_path, whitebg_output_path,
+              current, total)
         
     Returns:
         bool: True if processed successfully, False otherwise
     """
-    specimen_path, mask_path, transparent_output_path, whitebg_output_path = args
+    specimen_path, mask_path, transparent_output_path, whitebg_output_path, current, total = args
     
     if os.path.exists(transparent_output_path):
+        log_progress("create_transparency", current, total, "Skipped (already exists)")
         return False
         
     try:
-        with Image.open(specimen_path).convert("RGBA") as specimen_image:
-            with Image.open(mask_path).convert("L") as mask_image:
-                # No need to resize - we assume they're already the same size
-                
-                # Enhance the mask for clearer edges
-                enhanced_mask = mask_image.point(lambda x: 255 if x > 128 else 0)
-                r, g, b, _ = specimen_image.split()
-                alpha = enhanced_mask.point(lambda x: 255 if x > 128 else 0)
-                
-                # Create transparent version
-                transparent_image = Image.merge('RGBA', (r, g, b, alpha))
-                transparent_image.save(transparent_output_path, "PNG", optimize=True)
-                
-                # Create white background version
-                white_bg = Image.new('RGB', specimen_image.size, (255, 255, 255))
-                white_bg.paste(transparent_image, mask=alpha)
-                white_bg.save(whitebg_output_path)
-                
-                # Success without printing each file
-                return True
+        mask_np = read_mask(mask_path)
+        if mask_np is None:
+            log(f"Error: {os.path.basename(specimen_path)} - could not read mask {mask_path}")
+            return False
+        with phase("decode"), Image.open(specimen_path) as specimen_image:
+            specimen_np = np.array(specimen_image.convert("RGB"))
+        save_cutouts(specimen_np, mask_np, transparent_output_path, whitebg_output_path)
+        log_progress("create_transparency", current, total, f"Processed {os.path.basename(specimen_path)}")
+        return True
                 
     except Exception as e:
-        print(f"Error: {os.path.basename(specimen_path)} - {str(e)}")
+        log(f"Error: {os.path.basename(specimen_path)} - {str(e)}")
         return False
 
-def determine_optimal_workers(total_files: int, sequential: bool = False, max_workers: Optional[int] = None) -> int:
-    """
-    Determine optimal number of worker processes based on configuration and available resources.
-    
-    Args:
-        total_files: Number of files to process
-        sequential: If True, use only 1 worker
-        max_workers: Maximum number of workers to use
-        
-    Returns:
-        int: Number of workers to use
-    """
-    if sequential:
-        return 1
-        
-    cpu_cores = multiprocessing.cpu_count()
-    
-    # Default to 75% of cores for large batches
-    if total_files > 10:
-        workers = min(max(1, cpu_cores * 3 // 4), total_files)
-    else:
-        # For small batches, use 50% of cores
-        workers = min(max(1, cpu_cores // 2), total_files)
-    
-    # Apply max_workers constraint if specified
-    if max_workers is not None:
-        workers = min(workers, max_workers)
-        
-    return workers
-
 def create_transparency(specimen_input_dir: str, mask_input_dir: str, 
                       transparent_output_dir: str, whitebg_output_dir: str,
                       sequential: bool = False, max_workers: Optional[int] = None, 
@@ -157,16 +147,17 @@ def create_transparency(specimen_input_dir: str, mask_input_dir: str,
         whitebg_output_dir: Directory to save white background images
         sequential: If True, process one at a time
         max_workers: Maximum number of parallel workers
-        batch_size: Process images in batches of this size
+        batch_size: Maximum number of images in flight at once
     """
     tasks: List[Tuple[str, str, str, str]] = []
     skipped = missing_masks = 0
 
     supported_formats = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+    mask_index = index_for(mask_input_dir)
     for root, _, files in os.walk(specimen_input_dir):
         for file in (f for f in files if f.lower().endswith(supported_formats) and '_masked' in f):
             specimen_path = os.path.join(root, file)
-            mask_path = find_mask_path(specimen_path, mask_input_dir)
+            mask_path = find_mask_path(specimen_path, mask_input_dir, mask_index)
             
             if not mask_path:
                 missing_masks += 1
@@ -195,60 +186,19 @@ def create_transparency(specimen_input_dir: str, mask_input_dir: str,
             tasks.append((specimen_path, mask_path, transparent_output_path, whitebg_output_path))
 
     if not tasks:
-        print("No valid image pairs found")
+        log("No valid image pairs found")
         return
 
     if missing_masks > 0:
-        print(f"Warning: {missing_masks} specimens had no corresponding masks")
+        log(f"Warning: {missing_masks} specimens had no corresponding masks")
 
-    # Determine optimal worker count based on configuration
-    num_workers = determine_optimal_workers(len(tasks), sequential, max_workers)
-    print(f"Processing {len(tasks)} images with {num_workers} workers")
-    
-    # Process in batches if batch_size is specified
-    if batch_size and batch_size < len(tasks):
-        print(f"Processing in batches of {batch_size}")
-        processed = 0
-        skipped = 0
-        total_batches = (len(tasks) + batch_size - 1) // batch_size
-        
-        for i in range(0, len(tasks), batch_size):
-            batch = tasks[i:i+batch_size]
-            batch_num = i//batch_size + 1
-            
-            # Show batch progress
-            print(f"\rProcessing batch {batch_num}/{total_batches} [{i}/{len(tasks)} images]", end="", flush=True)
-            
-            with ThreadPoolExecutor(max_workers=num_workers) as executor:
-                batch_results = list(executor.map(process_single_image, batch))
-                
-            batch_processed = sum(1 for r in batch_results if r)
-            batch_skipped = sum(1 for r in batch_results if not r)
-            processed += batch_processed
-            skipped += batch_skipped
-            
-            # Update progress after each batch
-            print(f"\rProcessed {i + len(batch)}/{len(tasks)} images", end="", flush=True)
-            
-        print()  # Final newline after batches complete
-    else:
-        # Process all at once with progress indicator
-        processed = 0
-        skipped = 0
-        progress_interval = 100  # Update progress bar every 100 images
-        
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            futures = [executor.submit(process_single_image, task) for task in tasks]
-            
-            for i, future in enumerate(futures):
-                result = future.result()
-                if result:
-                    processed += 1
-                else:
-                    skipped += 1
-                
-                # Show progress periodically
-                if (i + 1) % progress_interval == 0 or (i + 1) == len(tasks):
-                    print(f"\rProcessed {i + 1}/{len(tasks)} images", end="", flush=True)
-        
-        print()  # Final newline
\ No newline at end of file
+    log_found("specimen-mask pairs", len(tasks))
+    tasks = [t + (i + 1, len(tasks)) for i, t in enumerate(tasks)]
+
+    # Threads share one process; admission keeps the decoded images of running tasks under the memory ceiling
+    results = run_tasks(process_single_image, tasks, "create_transparency", [task[0] for task in tasks],
+                        sequential=sequential, max_workers=max_workers, max_in_flight=batch_size,
+                        use_threads=True)
+    processed = sum(1 for r in results if r)
+    skipped = len(results) - processed
+    log(f"Processed {processed}/{len(tasks)} images")
@@ -3,11 +3,48 @@ import json
 import re
 from PIL import Image, ImageFile
 from concurrent.futures import ThreadPoolExecutor
-from logging_utils import log, log_found, log_progress
+from logging_utils import log, log_found, log_progress, worker_setup
+from functions.file_index import index_for
 
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+LABEL_CLASSES = ['barcode', 'geocode', 'label', 'qr']
+
+def crop_label_regions(img, data, output_folder, base_name):
+    """
+    Crop each detected label component out of an already-open full-size tray image.
+    
+    Returns:
+        set: Label classes that now have a crop on disk
+    """
+    scale_x = img.width / float(data['image']['width'])
+    scale_y = img.height / float(data['image']['height'])
+    
+    processed = set()
+    for pred in data['predictions']:
+        class_name = pred['class']
+        if class_name not in LABEL_CLASSES:
+            continue
+        
+        output_path = os.path.join(output_folder, f"{base_name}_{class_name}.jpg")
+        if os.path.exists(output_path):
+            processed.add(class_name)
+            continue
+            
+        x, y = pred['x'], pred['y']
+        width, height = pred['width'], pred['height']
+        
+        xmin = max(int((x - width/2) * scale_x), 0)
+        ymin = max(int((y - height/2) * scale_y), 0)
+        xmax = min(int((x + width/2) * scale_x), img.width)
+        ymax = min(int((y + height/2) * scale_y), img.height)
+        
+        cropped = img.crop((xmin, ymin, xmax, ymax))
+        cropped.save(output_path)
+        processed.add(class_name)
+    return processed
+
 def process_label(args):
     fullsize_dir, resized_dir, coordinates_dir, output_dir, root, resized_filename, current, total = args
     
@@ -61,26 +98,15 @@ def process_label(args):
     
     # If still not found, search recursively
     if not original_path:
-        for root_dir, _, files in os.walk(fullsize_dir):
-            for file in files:
-                file_base, file_ext = os.path.splitext(file)
-                if (file_base == base_name or file_base == f"{drawer_name}_tray_{tray_num}") and file_ext.lower() in supported_formats:
-                    original_path = os.path.join(root_dir, file)
-                    original_ext = file_ext
-                    break
-            if original_path:
+        for path in index_for(fullsize_dir).paths():
+            file_base, file_ext = os.path.splitext(os.path.basename(path))
+            if (file_base == base_name or file_base == f"{drawer_name}_tray_{tray_num}") and file_ext.lower() in supported_formats:
+                original_path = path
+                original_ext = file_ext
                 break
     
-    # Search recursively for the JSON file
-    json_files = []
-    for root_dir, _, files in os.walk(coordinates_dir):
-        for file in files:
-            if file == json_filename:
-                json_path = os.path.join(root_dir, file)
-                json_files.append(json_path)
-    
-    # Use the first JSON file found, if any
-    json_path = json_files[0] if json_files else None
+    # Look up the JSON file anywhere under the coordinates directory
+    json_path = index_for(coordinates_dir).find(json_filename)
     
     # Create output directory that preserves structure
     output_folder = os.path.join(output_dir, tray_num)
@@ -105,7 +131,7 @@ def process_label(args):
         # Check if any label has already been processed
         any_label_exists = any(
             os.path.exists(os.path.join(output_folder, f"{base_name}_{label_type}.jpg"))
-            for label_type in ['barcode', 'geocode', 'label', 'qr']
+            for label_type in LABEL_CLASSES
         )
         
         if any_label_exists:
@@ -116,31 +142,7 @@ def process_label(args):
             if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
                 img = img.convert('RGB')
                 
-            scale_x = img.width / float(data['image']['width'])
-            scale_y = img.height / float(data['image']['height'])
-            
-            processed = set()
-            for pred in data['predictions']:
-                class_name = pred['class']
-                if class_name not in ['barcode', 'geocode', 'label', 'qr']:
-                    continue
-                
-                output_path = os.path.join(output_folder, f"{base_name}_{class_name}.jpg")
-                if os.path.exists(output_path):
-                    processed.add(class_name)
-                    continue
-                    
-                x, y = pred['x'], pred['y']
-                width, height = pred['width'], pred['height']
-                
-                xmin = max(int((x - width/2) * scale_x), 0)
-                ymin = max(int((y - height/2) * scale_y), 0)
-                xmax = min(int((x + width/2) * scale_x), img.width)
-                ymax = min(int((y + height/2) * scale_y), img.height)
-                
-                cropped = img.crop((xmin, ymin, xmax, ymax))
-                cropped.save(output_path)
-                processed.add(class_name)
+            crop_label_regions(img, data, output_folder, base_name)
             
             log_progress("crop_labels", current, total, f"Processed {base_name}")
             return True
@@ -193,6 +195,6 @@ def crop_labels(fullsize_dir, resized_dir, coordinates_dir, output_dir):
     processed = 0
     skipped = 0
     
-    with ThreadPoolExecutor() as executor:
+    with ThreadPoolExecutor(**worker_setup()) as executor:
         results = list(executor.map(lambda x: process_label(x), tasks))
 
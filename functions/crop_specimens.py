@@ -1,13 +1,64 @@
 import os
 import json
 from PIL import Image, ImageFile
-from multiprocessing import Pool, cpu_count
 from logging_utils import log, log_found, log_progress
+from functions.resource_scheduler import run_tasks
+from functions.file_index import index_for
+from functions.instrumentation import phase
 import re
 
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+def sort_annotations_by_row(annotations, row_threshold=50):
+    """Order specimen detections row by row (top to bottom, then left to right) for consistent numbering."""
+    sorted_annotations = []
+    current_row = []
+    last_y = None
+    
+    for ann in sorted(annotations, key=lambda a: (a['y'], a['x'])):
+        if last_y is None or abs(ann['y'] - last_y) > row_threshold:
+            if current_row:
+                sorted_annotations.extend(sorted(current_row, key=lambda a: a['x']))
+            current_row = [ann]
+            last_y = ann['y']
+        else:
+            current_row.append(ann)
+    if current_row:
+        sorted_annotations.extend(sorted(current_row, key=lambda a: a['x']))
+    return sorted_annotations
+
+def crop_specimen_regions(img, sorted_annotations, resized_dimensions, specimen_folder,
+                          drawer_name, tray_num, original_ext):
+    """
+    Crop every detected specimen out of an already-open full-size tray image.
+    Coordinates are scaled from the resized (1000px) detection space.
+    """
+    scale_x = img.width / float(resized_dimensions['width'])
+    scale_y = img.height / float(resized_dimensions['height'])
+    
+    for idx, ann in enumerate(sorted_annotations, 1):
+        x, y = ann['x'], ann['y']
+        width, height = ann['width'], ann['height']
+        
+        # Add padding around specimen
+        padding = 10
+        xmin = max(int((x - width/2 - padding) * scale_x), 0)
+        ymin = max(int((y - height/2 - padding) * scale_y), 0)
+        xmax = min(int((x + width/2 + padding) * scale_x), img.width)
+        ymax = min(int((y + height/2 + padding) * scale_y), img.height)
+        
+        if xmax <= xmin or ymax <= ymin:
+            continue
+        
+        cropped = img.crop((xmin, ymin, xmax, ymax))
+        output_path = os.path.join(
+            specimen_folder, 
+            f'{drawer_name}_tray_{tray_num}_spec_{idx:03}{original_ext}'
+        )
+        with phase("encode"):
+            cropped.save(output_path)
+
 def process_tray(args):
     trays_dir, resized_trays_dir, specimens_dir, root, resized_filename, current, total = args
     base_name = resized_filename.replace('_1000.jpg', '')
@@ -62,26 +113,15 @@ def process_tray(args):
             
     # If not found, try to locate the file more flexibly
     if not original_path:
-        for root_dir, _, files in os.walk(drawer_folder):
-            for file in files:
-                file_base, file_ext = os.path.splitext(file)
-                if file_ext.lower() in supported_formats and file_base.endswith(f"_tray_{tray_num}"):
-                    original_path = os.path.join(root_dir, file)
-                    original_ext = file_ext
-                    break
-            if original_path:
+        for path in index_for(drawer_folder).paths():
+            file_base, file_ext = os.path.splitext(os.path.basename(path))
+            if file_ext.lower() in supported_formats and file_base.endswith(f"_tray_{tray_num}"):
+                original_path = path
+                original_ext = file_ext
                 break
     
-    # Search recursively for the JSON file in the coordinates directory
-    json_files = []
-    for root_dir, _, files in os.walk(os.path.join(resized_trays_dir, 'coordinates')):
-        for file in files:
-            if file == f'{base_name}_1000.json':
-                json_path = os.path.join(root_dir, file)
-                json_files.append(json_path)
-    
-    # Use the first matching JSON if found
-    json_path = json_files[0] if json_files else None
+    # Look up the JSON file anywhere under the coordinates directory
+    json_path = index_for(os.path.join(resized_trays_dir, 'coordinates')).find(f'{base_name}_1000.json')
     
     # FIXED: Create the specimen folder without duplicating the drawer name
     specimen_folder = os.path.join(specimens_dir, tray_num)
@@ -110,50 +150,16 @@ def process_tray(args):
                 log(f"Skipped {base_name}: Missing image dimensions in JSON")
                 return False
     
-        # Organize specimens by row for consistent numbering
-        row_threshold = 50
-        sorted_annotations = []
-        current_row = []
-        last_y = None
-        
-        for ann in sorted(annotations, key=lambda a: (a['y'], a['x'])):
-            if last_y is None or abs(ann['y'] - last_y) > row_threshold:
-                if current_row:
-                    sorted_annotations.extend(sorted(current_row, key=lambda a: a['x']))
-                current_row = [ann]
-                last_y = ann['y']
-            else:
-                current_row.append(ann)
-        if current_row:
-            sorted_annotations.extend(sorted(current_row, key=lambda a: a['x']))
+        sorted_annotations = sort_annotations_by_row(annotations)
         
         with Image.open(original_path) as img:
-            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                img = img.convert('RGB')
-                
-            scale_x = img.width / float(resized_dimensions['width'])
-            scale_y = img.height / float(resized_dimensions['height'])
-            
-            for idx, ann in enumerate(sorted_annotations, 1):
-                x, y = ann['x'], ann['y']
-                width, height = ann['width'], ann['height']
-                
-                # Add padding around specimen
-                padding = 10
-                xmin = max(int((x - width/2 - padding) * scale_x), 0)
-                ymin = max(int((y - height/2 - padding) * scale_y), 0)
-                xmax = min(int((x + width/2 + padding) * scale_x), img.width)
-                ymax = min(int((y + height/2 + padding) * scale_y), img.height)
+            with phase("decode"):
+                img.load()
+                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                    img = img.convert('RGB')
                 
-                if xmax <= xmin or ymax <= ymin:
-                    continue
-                
-                cropped = img.crop((xmin, ymin, xmax, ymax))
-                output_path = os.path.join(
-                    specimen_folder, 
-                    f'{drawer_name}_tray_{tray_num}_spec_{idx:03}{original_ext}'
-                )
-                cropped.save(output_path)
+            crop_specimen_regions(img, sorted_annotations, resized_dimensions,
+                                  specimen_folder, drawer_name, tray_num, original_ext)
         
         log_progress("crop_specimens", current, total, f"Processed {base_name} with {len(sorted_annotations)} specimens")
         return True
@@ -220,10 +226,13 @@ def crop_specimens_from_trays(trays_dir, resized_trays_dir, specimens_dir):
         
     log(f"Processing {len(tasks)} new trays")
     
-    # Process in parallel
-    num_workers = min(cpu_count(), len(tasks))
-    with Pool(num_workers) as pool:
-        results = pool.map(process_tray, tasks)
+    # Memory estimates come from the full-size trays the crops are cut from
+    full_size = {}
+    for root, _, files in os.walk(trays_dir):
+        for f in files:
+            full_size.setdefault(os.path.splitext(f)[0], os.path.join(root, f))
+    originals = [full_size.get(task[4].replace('_1000.jpg', '')) for task in tasks]
+    results = run_tasks(process_tray, tasks, "crop_specimens", originals)
 
 
 
@@ -1,9 +1,10 @@
 import os
 import json
 from PIL import Image, ImageFile
-from multiprocessing import Pool, cpu_count
 from logging_utils import log, log_found, log_progress
 from config import DrawerDissectConfig
+from functions.resource_scheduler import run_tasks
+from functions.instrumentation import phase
 
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -16,13 +17,6 @@ def find_original_file(fullsize_dir, base_name):
             return path
     return None
 
-def determine_optimal_workers(total_files: int, sequential: bool = False, max_workers: int = None) -> int:
-    if sequential:
-        return 1
-    if max_workers is not None:
-        return min(max_workers, total_files)
-    return min(max(1, cpu_count() // 2), total_files)
-
 def process_image(args):
     fullsize_dir, resized_dir, trays_dir, resized_filename, current, total = args
     
@@ -49,8 +43,10 @@ def process_image(args):
             annotations = json.load(file)['predictions']
 
         with Image.open(original_image_path) as original_img, Image.open(resized_image_path) as resized_img:
-            if original_img.mode in ('RGBA', 'LA') or (original_img.mode == 'P' and 'transparency' in original_img.info):
-                original_img = original_img.convert('RGB')
+            with phase("decode"):
+                original_img.load()
+                if original_img.mode in ('RGBA', 'LA') or (original_img.mode == 'P' and 'transparency' in original_img.info):
+                    original_img = original_img.convert('RGB')
                 
             scale_x = original_img.width / resized_img.width
             scale_y = original_img.height / resized_img.height
@@ -66,7 +62,8 @@ def process_image(args):
                 cropped_img = original_img.crop((xmin, ymin, xmax, ymax))
                 original_ext = os.path.splitext(original_image_path)[1]
                 cropped_image_path = os.path.join(base_folder_path, f'{base_name}_tray_{i:02}{original_ext}')
-                cropped_img.save(cropped_image_path, quality=95)
+                with phase("encode"):
+                    cropped_img.save(cropped_image_path, quality=95)
 
         log_progress("crop_trays", current, total, f"Processed {base_name} with {len(annotations)} trays")
         return True
@@ -100,13 +97,13 @@ def crop_trays_from_fullsize(fullsize_dir, resized_dir, trays_dir, sequential=Fa
     
     tasks = [(fullsize_dir, resized_dir, trays_dir, filename, i+1, len(resized_filenames)) for i, filename in enumerate(resized_filenames)]
     
-    num_workers = determine_optimal_workers(len(tasks), sequential, max_workers)
-    
-    if num_workers > 1 and not sequential:
-        with Pool(num_workers) as pool:
-            results = pool.map(process_image, tasks)
-    else:
-        results = [process_image(task) for task in tasks]
+    # Each task decodes a full-size drawer; admit them by estimated memory
+    originals = [
+        find_original_file(fullsize_dir, os.path.splitext(filename)[0].replace('_1000', ''))
+        for filename in resized_filenames
+    ]
+    results = run_tasks(process_image, tasks, "crop_trays", originals,
+                        sequential=sequential, max_workers=max_workers, max_in_flight=batch_size)
     
     processed = sum(results)
     skipped = len(results) - processed
@@ -0,0 +1,164 @@
+"""
+cutout_stage.py
+
+censor_background and create_transparency both produce a specimen cut out
+of its background: the first whitens the background of the specimen crop
+(no_background), the second re-decodes that image together with the full
+mask to write the transparent PNG and the white background copy.
+
+The fused stage handles one specimen per worker task: the crop and its
+mask are decoded once, the no-background image is made with in-place uint8
+operations and saved, and the same array then gives the transparent and
+white background versions. Tasks run on the process pool with memory-aware
+admission, so large crops are not all decoded at once.
+
+Output filenames and folder layout match the separate steps. For PNG and
+TIFF specimens the files are identical; for JPEG specimens the cutouts are
+made from the pixels before the no-background JPEG is encoded, so they skip
+one round of compression.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from logging_utils import log, log_found, log_progress
+from functions.censor_background import censor_array, find_mask_path as find_specimen_mask
+from functions.create_transparency import save_cutouts, find_mask_path as find_full_mask
+from functions.mask_store import read_mask
+from functions.file_index import index_for
+from functions.instrumentation import phase
+from functions.resource_scheduler import run_tasks
+
+CUTOUT_STAGE_STEPS = ("censor_background", "create_transparency")
+
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+
+
+def find_cutout_jobs(specimens_dir, mask_png_dir, no_background_dir, full_masks_dir,
+                     transparent_dir, whitebg_dir, steps):
+    """
+    Build one job per specimen crop that still has an output to write.
+
+    A cutout is only planned when the specimen's full mask exists and its
+    no-background image exists or is made by the same job.
+    """
+    jobs = []
+    missing_masks = 0
+    mask_index, full_mask_index = index_for(mask_png_dir), index_for(full_masks_dir)
+    for root, _, files in os.walk(specimens_dir):
+        for file in sorted(files):
+            if not file.lower().endswith(SUPPORTED_FORMATS):
+                continue
+            specimen_path = os.path.join(root, file)
+            stem, ext = os.path.splitext(os.path.relpath(specimen_path, specimens_dir))
+            nobg_path = os.path.join(no_background_dir, f"{stem}_masked{ext}")
+
+            censor = "censor_background" in steps and not os.path.exists(nobg_path)
+            mask_path = find_specimen_mask(specimen_path, mask_png_dir, mask_index) if censor else None
+            if censor and not mask_path:
+                log(f"Warning: No mask found for specimen {os.path.splitext(file)[0]}")
+                censor = False
+
+            cutout = False
+            full_mask_path = transparent_path = whitebg_path = None
+            if "create_transparency" in steps and (censor or os.path.exists(nobg_path)):
+                relative_dir = os.path.relpath(os.path.dirname(nobg_path), no_background_dir)
+                base_name = os.path.splitext(os.path.basename(nobg_path))[0]
+                transparent_path = os.path.normpath(
+                    os.path.join(transparent_dir, relative_dir, f"{base_name}_finalmask.png"))
+                whitebg_path = os.path.normpath(
+                    os.path.join(whitebg_dir, relative_dir, f"{base_name}_whitebg{ext}"))
+                if not os.path.exists(transparent_path):
+                    full_mask_path = find_full_mask(nobg_path, full_masks_dir, full_mask_index)
+                    if full_mask_path:
+                        cutout = True
+                    else:
+                        missing_masks += 1
+
+            if censor or cutout:
+                jobs.append({
+                    'specimen_path': specimen_path,
+                    'mask_path': mask_path,
+                    'nobg_path': nobg_path,
+                    'full_mask_path': full_mask_path,
+                    'transparent_path': transparent_path,
+                    'whitebg_path': whitebg_path,
+                    'censor': censor,
+                    'cutout': cutout,
+                })
+
+    if missing_masks:
+        log(f"Warning: {missing_masks} specimens had no corresponding full masks")
+    return jobs
+
+
+def fused_cutout_task(args):
+    """
+    Worker entry point: write the pending no-background, transparent and white
+    background images of one specimen from a single decode.
+    """
+    job, current, total = args
+    name = os.path.basename(job['specimen_path'])
+
+    try:
+        if job['censor']:
+            mask_np = read_mask(job['mask_path'])
+            if mask_np is None:
+                log(f"Could not read mask {job['mask_path']}")
+                return False
+            with phase("decode"), Image.open(job['specimen_path']) as img:
+                specimen_np = np.array(img.convert('RGB'))
+            censor_array(specimen_np, mask_np)
+            os.makedirs(os.path.dirname(job['nobg_path']), exist_ok=True)
+            with phase("encode"):
+                Image.fromarray(specimen_np).save(job['nobg_path'])
+        else:
+            with phase("decode"), Image.open(job['nobg_path']) as img:
+                specimen_np = np.array(img.convert('RGB'))
+
+        if job['cutout']:
+            full_mask_np = read_mask(job['full_mask_path'])
+            if full_mask_np is None:
+                log(f"Could not read mask {job['full_mask_path']}")
+                return False
+            os.makedirs(os.path.dirname(job['transparent_path']), exist_ok=True)
+            os.makedirs(os.path.dirname(job['whitebg_path']), exist_ok=True)
+            save_cutouts(specimen_np, full_mask_np, job['transparent_path'], job['whitebg_path'])
+
+        log_progress("cutout_stage", current, total, f"Processed {name}")
+        return True
+
+    except Exception as e:
+        log(f"Error processing {name}: {str(e)}")
+        return False
+
+
+def run_fused_cutout_stage(specimens_dir, mask_png_dir, no_background_dir, full_masks_dir,
+                           transparent_dir, whitebg_dir, steps=CUTOUT_STAGE_STEPS,
+                           sequential=False, max_workers=None, batch_size=None):
+    """
+    Run censor_background and create_transparency as one pass per specimen.
+
+    Args:
+        specimens_dir:     Directory containing specimen crops
+        mask_png_dir:      Directory containing specimen masks
+        no_background_dir: Directory for the no-background images
+        full_masks_dir:    Directory containing create_pinmask masks
+        transparent_dir:   Directory for the transparent PNGs
+        whitebg_dir:       Directory for the white background images
+        steps:             Which of the two steps to cover
+        sequential:        Process one specimen at a time
+        max_workers:       Maximum number of worker processes
+        batch_size:        Maximum number of specimens in flight at once
+    """
+    jobs = find_cutout_jobs(specimens_dir, mask_png_dir, no_background_dir, full_masks_dir,
+                            transparent_dir, whitebg_dir, steps)
+    if not jobs:
+        log("No pending specimen cutouts")
+        return
+
+    log_found("specimens", len(jobs))
+    tasks = [(job, i, len(jobs)) for i, job in enumerate(jobs, 1)]
+    results = run_tasks(fused_cutout_task, tasks, "cutout_stage", [job['specimen_path'] for job in jobs],
+                        sequential=sequential, max_workers=max_workers, max_in_flight=batch_size)
+    log(f"Processed {sum(1 for r in results if r)}/{len(jobs)} specimens")
@@ -4,10 +4,11 @@ from pathlib import Path
 from typing import List, Set
 from logging_utils import log
 
-def discover_and_sort_drawers(config) -> List[str]:
+def discover_and_sort_drawers(config, filenames: List[str] = None) -> List[str]:
     """
     Discover images in unsorted directory, create drawer folders, and sort images.
-    Returns list of drawer IDs that were processed.
+    If filenames is given, only those images are sorted (the rest may still be
+    being written). Returns list of drawer IDs that were processed.
     """
     unsorted_dir = config.unsorted_directory
     
@@ -19,7 +20,7 @@ def discover_and_sort_drawers(config) -> List[str]:
     supported_formats = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
     image_files = []
     
-    for file in os.listdir(unsorted_dir):
+    for file in (os.listdir(unsorted_dir) if filenames is None else filenames):
         if file.lower().endswith(supported_formats):
             image_files.append(file)
     
@@ -57,6 +58,9 @@ def discover_and_sort_drawers(config) -> List[str]:
         log(f"Moved {moved_count}/{len(files)} images for {drawer_id}")
         sorted_drawers.append(drawer_id)
     
+    if filenames is not None:
+        return sorted_drawers
+
     # Check if unsorted directory is now empty
     remaining_files = [f for f in os.listdir(unsorted_dir) 
                       if not f.startswith('.') and os.path.isfile(os.path.join(unsorted_dir, f))]
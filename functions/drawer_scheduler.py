@@ -0,0 +1,269 @@
+"""
+drawer_scheduler.py
+
+Runs several drawers at the same time under one global resource budget.
+
+By default process_images works through drawers one by one, so while drawer A
+waits on Roboflow or an LLM the CPU sits idle even though drawer B could be
+cropping trays. The scheduler runs each drawer in a worker thread that walks
+through that drawer's steps in order. Before a step starts it takes what it
+needs from the shared budget:
+
+    cpu        - image-processing steps (each already uses a process pool)
+    inference  - detection / segmentation steps (Roboflow or local models)
+    llm        - transcription steps
+    memory_gb  - estimated peak memory of the step, against the same
+                 ceiling as the tasks inside the steps (resources.scheduler)
+
+A step that cannot get its share waits, so e.g. only one CPU-heavy step runs
+at a time while other drawers keep the inference and LLM slots busy. Step
+order inside a drawer is never changed, and a drawer whose step raises
+stops there (as the sequential loop does) while the other drawers go on.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging_utils import log
+from functions.metrics import track_queue, untrack_queue
+from functions.resource_scheduler import memory_ceiling, GB
+
+# Which budget each step draws from
+STEP_RESOURCE_CLASS = {
+    "resize_drawers":       "cpu",
+    "find_trays":           "inference",
+    "crop_trays":           "cpu",
+    "resize_trays":         "cpu",
+    "find_traylabels":      "inference",
+    "crop_labels":          "cpu",
+    "find_specimens":       "inference",
+    "crop_specimens":       "cpu",
+    "tray_stage":           "cpu",
+    "create_traymaps":      "cpu",
+    "outline_specimens":    "inference",
+    "create_masks":         "cpu",
+    "fix_masks":            "cpu",
+    "measure_specimens":    "cpu",
+    "mask_stage":           "cpu",
+    "censor_background":    "cpu",
+    "outline_pins":         "inference",
+    "create_pinmask":       "cpu",
+    "create_transparency":  "cpu",
+    "cutout_stage":         "cpu",
+    "transcribe_barcodes":  "llm",
+    "transcribe_geocodes":  "llm",
+    "transcribe_taxonomy":  "llm",
+    "transcribe_specimens": "llm",
+    "merge_data":           "cpu",
+}
+
+# Rough peak memory per step in GB; steps that open full-size drawer images need the most
+DEFAULT_STEP_MEMORY_GB = {
+    "resize_drawers": 4,
+    "crop_trays":     8,
+    "resize_trays":   2,
+    "crop_labels":    2,
+    "crop_specimens": 2,
+    "tray_stage":     3,
+}
+
+
+def step_memory_allowance(memory_gb=None):
+    """
+    GB of step estimates that may run at once: memory_gb capped at the
+    process memory ceiling of resource_scheduler, or that ceiling when
+    memory_gb is not set (None when neither is known).
+    """
+    ceiling = memory_ceiling()
+    if ceiling is None:
+        return memory_gb
+    ceiling_gb = ceiling / GB
+    return ceiling_gb if memory_gb is None else min(memory_gb, ceiling_gb)
+
+
+class ResourceBudget:
+    """Counted slots per resource class plus a shared memory allowance."""
+
+    def __init__(self, slots, memory_gb=None):
+        self.slots = dict(slots)
+        self.memory_gb = memory_gb
+        self._in_use = {name: 0 for name in self.slots}
+        self._memory_in_use = 0.0
+        self._cond = threading.Condition()
+
+    def _fits(self, resource, memory):
+        if self._in_use[resource] >= self.slots[resource]:
+            return False
+        if self.memory_gb is None or self._memory_in_use == 0:
+            # A single step larger than the whole allowance still gets to run alone
+            return True
+        return self._memory_in_use + memory <= self.memory_gb
+
+    def acquire(self, resource, memory=0.0):
+        with self._cond:
+            while not self._fits(resource, memory):
+                self._cond.wait()
+            self._in_use[resource] += 1
+            self._memory_in_use += memory
+
+    def release(self, resource, memory=0.0):
+        with self._cond:
+            self._in_use[resource] -= 1
+            self._memory_in_use -= memory
+            self._cond.notify_all()
+
+
+class DrawerScheduler:
+    """
+    Run each drawer's step list in a worker thread, at most `parallel_drawers`
+    at a time, drawing from a shared ResourceBudget.
+
+    Args:
+        run_step: Callable(drawer_id, step) that runs one step
+        settings: config.scheduling_settings
+    """
+
+    def __init__(self, run_step, settings):
+        self.run_step = run_step
+        self.parallel_drawers = max(1, settings["parallel_drawers"])
+        self.budget = ResourceBudget(
+            {
+                "cpu": max(1, settings["cpu_slots"]),
+                "inference": max(1, settings["inference_slots"]),
+                "llm": max(1, settings["llm_slots"]),
+            },
+            memory_gb=step_memory_allowance(settings["memory_gb"]),
+        )
+        self.step_memory_gb = {**DEFAULT_STEP_MEMORY_GB, **(settings.get("step_memory_gb") or {})}
+        self.timeline = []  # (drawer_id, step, queued, started, finished)
+        self.running = set()  # drawers whose steps are being worked through
+        self.waiting = 0      # drawers submitted but not started
+        self.steps_waiting = {name: 0 for name in self.budget.slots}  # steps waiting for a slot
+        self._timeline_lock = threading.Lock()
+        self._start = None
+        self._executor = None
+
+    def _run_drawer(self, drawer_id, steps):
+        """
+        Run one drawer's steps in order. The drawer stops at the first step
+        that raises, since later steps would work from missing or partial
+        outputs. Returns False if a step raised.
+        """
+        with self._timeline_lock:
+            self.waiting -= 1
+            self.running.add(drawer_id)
+        try:
+            for i, step in enumerate(steps):
+                if not self._run_one(drawer_id, step):
+                    skipped = steps[i + 1:]
+                    if skipped:
+                        log(f"[{drawer_id}] Stopping after failed {step}; skipped {', '.join(skipped)}")
+                    return False
+        finally:
+            with self._timeline_lock:
+                self.running.discard(drawer_id)
+        return True
+
+    def _run_one(self, drawer_id, step):
+        """Run one step once its resources are free. Returns False if it raised."""
+        resource = STEP_RESOURCE_CLASS.get(step, "cpu")
+        memory = self.step_memory_gb.get(step, 1)
+        queued = time.time()
+        with self._timeline_lock:
+            self.steps_waiting[resource] += 1
+        try:
+            self.budget.acquire(resource, memory)
+        finally:
+            with self._timeline_lock:
+                self.steps_waiting[resource] -= 1
+        started = time.time()
+        try:
+            log(f"[{drawer_id}] Running {step}")
+            self.run_step(drawer_id, step)
+            return True
+        except Exception as e:
+            log(f"[{drawer_id}] Error in {step}: {e}")
+            return False
+        finally:
+            self.budget.release(resource, memory)
+            with self._timeline_lock:
+                self.timeline.append((drawer_id, step, queued, started, time.time()))
+
+    def submit(self, drawer_id, steps):
+        """
+        Queue one drawer; it starts once fewer than parallel_drawers are running.
+        Drawers start in the order they were submitted.
+
+        Returns:
+            Future: Resolves to True if no step raised
+        """
+        if self._executor is None:
+            self._start = self._start or time.time()
+            self._executor = ThreadPoolExecutor(max_workers=self.parallel_drawers, thread_name_prefix="drawer")
+            track_queue("drawers", self.depths)
+        with self._timeline_lock:
+            self.waiting += 1
+        future = self._executor.submit(self._run_drawer, drawer_id, steps)
+        future.add_done_callback(self._cancelled)
+        return future
+
+    def _cancelled(self, future):
+        if future.cancelled():
+            with self._timeline_lock:
+                self.waiting -= 1
+
+    def depths(self):
+        """Drawers waiting and running, and steps waiting for each resource slot (for metrics)."""
+        with self._timeline_lock:
+            return {"waiting": self.waiting, "running": len(self.running),
+                    **{f"steps_waiting_{name}": n for name, n in self.steps_waiting.items()}}
+
+    def shutdown(self, cancel_waiting=False):
+        """Wait for the submitted drawers (only the running ones with cancel_waiting)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=cancel_waiting)
+            self._executor = None
+            untrack_queue("drawers")
+
+    def run(self, drawer_steps):
+        """
+        Run all drawers.
+
+        Args:
+            drawer_steps: Ordered mapping of drawer_id -> list of steps
+
+        Returns:
+            list: Drawers that stopped at a failed step
+        """
+        self._start = time.time()
+        memory = f"{self.budget.memory_gb:.1f}" if self.budget.memory_gb else "unlimited"
+        log(f"Scheduling {len(drawer_steps)} drawers, up to {self.parallel_drawers} at a time "
+            f"(cpu={self.budget.slots['cpu']}, inference={self.budget.slots['inference']}, "
+            f"llm={self.budget.slots['llm']}, memory_gb={memory})")
+
+        futures = {drawer_id: self.submit(drawer_id, steps) for drawer_id, steps in drawer_steps.items()}
+        self.shutdown()
+        failed = [drawer_id for drawer_id, future in futures.items() if not future.result()]
+        if failed:
+            log(f"Failed drawers: {', '.join(failed)}")
+        return failed
+
+    def log_timeline(self):
+        """Print when each step of each drawer started and how long it ran or waited."""
+        if not self.timeline:
+            return
+        log("\n" + "=" * 80)
+        log("DRAWER TIMELINE (seconds from start)")
+        log("=" * 80)
+        drawers = []
+        for entry in self.timeline:
+            if entry[0] not in drawers:
+                drawers.append(entry[0])
+        for drawer_id in drawers:
+            entries = sorted((e for e in self.timeline if e[0] == drawer_id), key=lambda e: e[3])
+            first, last = entries[0][3], entries[-1][4]
+            log(f"\n{drawer_id}: {first - self._start:.1f}s -> {last - self._start:.1f}s")
+            for _, step, queued, started, finished in entries:
+                waited = f"  (waited {started - queued:.1f}s)" if started - queued >= 0.1 else ""
+                log(f"  {started - self._start:8.1f}s  {step:<22} {finished - started:8.1f}s{waited}")
+        log("=" * 80)
@@ -0,0 +1,182 @@
+"""
+file_index.py
+
+Name lookups under a drawer folder without walking it for every item.
+
+Several steps look up one file per tray or specimen (a coordinates JSON, a
+mask, a pin JSON) with an os.walk of the whole folder, which is quadratic
+in the number of files on large drawers. index_for(root) returns an index
+of every file under root, built once per process with os.scandir.
+
+Each index_for call brings the index up to date by comparing the mtime of
+every indexed directory with the one recorded at its last scan and
+rescanning only the directories that changed, so files written since (by
+this step, its workers or an earlier step) are found. That costs one stat
+per directory, so call index_for once per step or per task and keep the
+index for per-item lookups. Lookups and refreshes share the index's lock,
+so threads of one step can refresh and query the same index.
+
+Lookups keep os.walk's order: the first match is the one an os.walk of root
+would reach first.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+# Directory mtimes closer than this to the scan time may not show a change
+# made right after it (coarse timestamps on some filesystems), so those
+# directories are rescanned on the next refresh
+SETTLE_SECONDS = 2.0
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class FileIndex:
+    """Every file under a folder, by name, in os.walk order."""
+
+    def __init__(self, root: str):
+        self.root = os.path.normpath(root)
+        self.lock = threading.Lock()
+        self._dirs: Dict[str, Optional[int]] = {}   # directory -> mtime at last scan (None = rescan)
+        self._files: Dict[str, List[str]] = {}      # directory -> file names
+        self._subdirs: Dict[str, List[str]] = {}    # directory -> subdirectory paths
+        self._by_name: Dict[str, List[str]] = {}    # file name -> directories holding it
+        self._order: Dict[str, tuple] = {}          # directory -> sort key matching os.walk order
+        self._scan(self.root, ())
+
+    def _forget(self, directory: str) -> None:
+        for name in self._files.pop(directory, ()):
+            holders = self._by_name.get(name)
+            if holders:
+                holders.remove(directory)
+                if not holders:
+                    del self._by_name[name]
+        for sub in self._subdirs.pop(directory, ()):
+            self._forget(sub)
+        self._dirs.pop(directory, None)
+        self._order.pop(directory, None)
+
+    def _scan(self, directory: str, order: tuple) -> None:
+        """(Re)scan one directory and any subdirectories not indexed yet."""
+        known = set(self._subdirs.get(directory, ()))
+        for name in self._files.pop(directory, ()):
+            holders = self._by_name[name]
+            holders.remove(directory)
+            if not holders:
+                del self._by_name[name]
+
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            self._forget(directory)
+            return
+
+        self._dirs[directory] = mtime if time.time() - mtime / 1e9 > SETTLE_SECONDS else None
+        self._order[directory] = order
+        files, subdirs = [], []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            (subdirs if is_dir else files).append(entry)
+
+        self._files[directory] = [e.name for e in files]
+        for name in self._files[directory]:
+            holders = self._by_name.setdefault(name, [])
+            holders.append(directory)
+            if len(holders) > 1:
+                holders.sort(key=self._order.__getitem__)
+
+        self._subdirs[directory] = [e.path for e in subdirs]
+        for sub in known - set(self._subdirs[directory]):
+            self._forget(sub)
+        for position, entry in enumerate(subdirs):
+            if entry.path not in known:
+                self._scan(entry.path, order + (position,))
+            elif self._order[entry.path] != order + (position,):
+                self._reorder(entry.path, order + (position,))
+
+    def _reorder(self, directory: str, order: tuple) -> None:
+        """Give a directory and its subtree new os.walk positions."""
+        self._order[directory] = order
+        for position, sub in enumerate(self._subdirs.get(directory, ())):
+            self._reorder(sub, order + (position,))
+        for name in self._files.get(directory, ()):
+            self._by_name[name].sort(key=self._order.__getitem__)
+
+    def refresh(self) -> None:
+        """Rescan the directories whose contents changed since they were scanned."""
+        with self.lock:
+            if self.root not in self._dirs:
+                self._scan(self.root, ())
+                return
+            for directory in list(self._dirs):
+                if directory not in self._dirs:
+                    continue  # dropped while rescanning its parent
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    self._forget(directory)
+                    continue
+                if self._dirs[directory] != mtime:
+                    self._scan(directory, self._order[directory])
+
+    def find(self, name: str) -> Optional[str]:
+        """Path of the first file with this name, or None."""
+        with self.lock:
+            holders = self._by_name.get(name)
+            return os.path.join(holders[0], name) if holders else None
+
+    def find_first(self, names: Sequence[str]) -> Optional[str]:
+        """Path of the first directory's match for any of the names (earlier names win within a directory)."""
+        best = None
+        with self.lock:
+            for rank, name in enumerate(names):
+                holders = self._by_name.get(name)
+                if holders:
+                    key = (self._order[holders[0]], rank)
+                    if best is None or key < best[0]:
+                        best = (key, os.path.join(holders[0], name))
+        return best[1] if best else None
+
+    def directories_with(self, names: Sequence[str]) -> List[str]:
+        """Directories holding a file with any of these names, in os.walk order."""
+        with self.lock:
+            found = {d for name in names for d in self._by_name.get(name, ())}
+            return sorted(found, key=self._order.__getitem__)
+
+    def paths(self, predicate: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """Paths of all indexed files (optionally only names matching predicate), in os.walk order."""
+        # A snapshot: other threads may refresh the index while the caller goes through it
+        with self.lock:
+            return [os.path.join(directory, name)
+                    for directory in sorted(self._files, key=self._order.__getitem__)
+                    for name in self._files[directory]
+                    if predicate is None or predicate(name)]
+
+
+def forget_indexes(root: str) -> None:
+    """Drop this process's indexes of root and of folders under it (e.g. once a drawer is done)."""
+    root = os.path.abspath(root)
+    with _indexes_lock:
+        for key in [k for k in _indexes if k[1] == root or k[1].startswith(root + os.sep)]:
+            del _indexes[key]
+
+
+def index_for(root: str) -> FileIndex:
+    """The up-to-date index of root for this process."""
+    # Processes keep their own index; a forked copy would carry another process's state
+    key = (os.getpid(), os.path.abspath(root))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            _indexes[key] = FileIndex(root)
+            return _indexes[key]
+    index.refresh()
+    return index
@@ -6,8 +6,9 @@ import tempfile
 from PIL import Image
 from contextlib import contextmanager
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
 from logging_utils import log, log_found, log_progress
+from functions.metrics import RETRIES
+from functions.resource_scheduler import run_tasks
 
 
 @contextmanager
@@ -46,6 +47,7 @@ def retry_with_backoff(func, max_retries=3, base_delay=2, max_delay=60):
             if is_server_error and attempt < max_retries:
                 delay = min(base_delay * (2 ** attempt) + random.uniform(0, 1), max_delay)
                 log(f"Server error (attempt {attempt + 1}/{max_retries + 1}), retrying in {delay:.1f}s...")
+                RETRIES.inc(operation="outline_specimens")
                 time.sleep(delay)
             else:
                 raise
@@ -124,26 +126,10 @@ def infer_beetles(
         for i, (root, file) in enumerate(image_files)
     ]
 
-    processed = 0
-    skipped = 0
-    errors = 0
-
-    if sequential:
-        log("Processing images sequentially")
-        for task in tasks:
-            try:
-                result = process_image(task)
-                processed += bool(result)
-                skipped += not bool(result)
-            except Exception as e:
-                log(f"Error in task: {e}")
-                errors += 1
-    else:
-        workers = max_workers if max_workers is not None else min(32, os.cpu_count() * 2)
-        log(f"Processing images in parallel with {workers} workers")
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            results = list(executor.map(process_image, tasks))
-            processed = sum(1 for r in results if r)
-            skipped = len(tasks) - processed - errors
-
-    log(f"outline_specimens complete: {processed} processed, {skipped} skipped, {errors} errors")
+    # Threads mostly wait on the model; run_tasks sizes the pool and logs tasks that raise
+    results = run_tasks(process_image, tasks, "outline_specimens", [os.path.join(root, file) for root, file in image_files],
+                        sequential=sequential, max_workers=max_workers, use_threads=True, network=True)
+    processed = sum(1 for r in results if r)
+    skipped = len(tasks) - processed
+
+    log(f"outline_specimens complete: {processed} processed, {skipped} skipped or failed")
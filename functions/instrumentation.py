@@ -0,0 +1,388 @@
+"""
+instrumentation.py
+
+Per-step and per-item measurements written to a structured run log
+(run_logs/run_<time>_<pid>.jsonl by default, one JSON object per line).
+
+- step: one record per step run of a drawer, with wall time, CPU time,
+  bytes read and written, peak RSS, item count and the time spent in each
+  phase, summed over its items.
+- item: one record per tray, specimen or image a step processed. Tasks run
+  through resource_scheduler.run_tasks and model predictions are recorded
+  automatically, including those running on worker processes (the record
+  travels back with the task result and is written by the main process).
+
+Phases are timed with `with phase("decode"):` around the hot spots:
+
+    decode   reading and decoding images and masks
+    infer    local model inference
+    encode   encoding images, including writing the encoded file
+    write    other output files (JSON, CSV, databases)
+    network  Roboflow and LLM requests
+
+Bytes are the read()/write() totals from /proc/thread-self/io and peak RSS
+comes from getrusage, so on systems without them (macOS, Windows) those
+fields are null. Each measurement is a few microseconds, so the log can
+stay on; set resources.instrumentation.enabled: false to turn it off.
+
+Records are also handed to the listeners added with add_listener, which is
+how metrics.py counts items and steps; measurements are taken whenever the
+run log or a listener is on.
+
+profile_step wraps one step in cProfile (this thread only) or in py-spy, a
+sampling profiler that also follows worker processes, and saves the result
+next to the run log.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from logging_utils import log
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PHASES = ("decode", "infer", "encode", "write", "network")
+
+_run = {"path": None, "lock": threading.Lock(), "items": True}
+_listeners = []              # callables given every item and step record (see metrics.py)
+_steps = {}                  # id -> StepRecord of steps running in this process
+_steps_lock = threading.Lock()
+_local = threading.local()   # .item: record of the item this thread is working on
+
+
+def _io_counters() -> tuple:
+    """(bytes read, bytes written) by this thread so far, or (None, None)."""
+    try:
+        with open("/proc/thread-self/io") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss_mb(who=None) -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _delta(after, before):
+    return after - before if after is not None and before is not None else None
+
+
+# ------------------------------------------------------------------
+# Run log
+# ------------------------------------------------------------------
+
+def start_run(settings: Dict, argv=None) -> Optional[str]:
+    """Open the run log for this process (resources.instrumentation). Returns its path."""
+    if not settings["enabled"]:
+        return None
+    os.makedirs(settings["directory"], exist_ok=True)
+    path = os.path.join(settings["directory"], f"run_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.jsonl")
+    _run["path"] = path
+    _run["items"] = settings["item_records"]
+    write_event({"event": "run_start", "argv": argv if argv is not None else sys.argv[1:]})
+    return path
+
+
+def add_listener(listener) -> None:
+    """Also hand every item and step record to listener(record), e.g. to update metrics."""
+    _listeners.append(listener)
+
+
+def enabled() -> bool:
+    """True if anything (the run log or a listener) takes measurements."""
+    return _run["path"] is not None or bool(_listeners)
+
+
+def write_event(record: Dict, to_log: bool = True) -> None:
+    """Append one record to the run log (unless to_log is False) and pass it to the listeners."""
+    record = {"time": round(time.time(), 3), **record}
+    if _run["path"] is not None and to_log:
+        line = json.dumps(record) + "\n"
+        with _run["lock"]:
+            with open(_run["path"], "a") as f:
+                f.write(line)
+    for listener in _listeners:
+        listener(record)
+
+
+# ------------------------------------------------------------------
+# Steps
+# ------------------------------------------------------------------
+
+class StepRecord:
+    """Totals of one step run, filled in by its items and phases."""
+
+    def __init__(self, step: str, drawer_id: str, drawer_path: str):
+        self.step = step
+        self.drawer_id = drawer_id
+        self.drawer_path = os.path.abspath(drawer_path) + os.sep
+        self.pid = os.getpid()
+        self.thread = threading.get_ident()
+        self.items = 0
+        self.failed = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.read_bytes = self.write_bytes = 0
+        self.peak_rss_mb = None
+        self.lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_item(self, record: Dict) -> None:
+        """Count a finished item and write its record."""
+        with self.lock:
+            self.items += 1
+            self.failed += 0 if record["ok"] else 1
+            for name, seconds in record["phases"].items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            # Items run on the step's own thread are already in its I/O counters
+            if record.pop("thread", None) != self.thread or record["pid"] != self.pid:
+                self.read_bytes += record["read_bytes"] or 0
+                self.write_bytes += record["write_bytes"] or 0
+            if record["peak_rss_mb"] is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0, record["peak_rss_mb"])
+        write_event({"event": "item", "step": self.step, "drawer": self.drawer_id, **record},
+                    to_log=_run["items"])
+
+
+def _step_for(path: Optional[str] = None) -> Optional[StepRecord]:
+    """
+    The running step an item or phase belongs to: the step of this thread,
+    else the one whose drawer holds path, else the only step running.
+    Steps copied into forked worker processes are ignored.
+    """
+    pid = os.getpid()
+    current = getattr(_local, "step", None)
+    if current is not None and current.pid == pid:
+        return current
+    with _steps_lock:
+        steps = [s for s in _steps.values() if s.pid == pid]
+    if path:
+        path = os.path.abspath(path)
+        for step in steps:
+            if path.startswith(step.drawer_path):
+                return step
+    return steps[0] if len(steps) == 1 else None
+
+
+@contextmanager
+def step_record(step: str, drawer_id: str, drawer_path: str):
+    """Measure one step run and write its record when it ends."""
+    if not enabled():
+        yield None
+        return
+    record = StepRecord(step, drawer_id, drawer_path)
+    with _steps_lock:
+        _steps[id(record)] = record
+    previous, _local.step = getattr(_local, "step", None), record
+    read0, write0 = _io_counters()
+    cpu0 = os.times()
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        seconds = time.perf_counter() - start
+        cpu = os.times()
+        read1, write1 = _io_counters()
+        _local.step = previous
+        with _steps_lock:
+            _steps.pop(id(record), None)
+        peaks = [p for p in (record.peak_rss_mb, _peak_rss_mb(),
+                             _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None) if p is not None]
+        write_event({
+            "event": "step",
+            "step": step,
+            "drawer": drawer_id,
+            "ok": ok,
+            "seconds": round(seconds, 3),
+            # Children count once their worker processes have exited
+            "cpu_seconds": round((cpu.user + cpu.system + cpu.children_user + cpu.children_system)
+                                 - (cpu0.user + cpu0.system + cpu0.children_user + cpu0.children_system), 3),
+            "items": record.items,
+            "failed_items": record.failed,
+            "phases": {k: round(v, 3) for k, v in record.phases.items() if v},
+            "read_bytes": record.read_bytes + (_delta(read1, read0) or 0),
+            "write_bytes": record.write_bytes + (_delta(write1, write0) or 0),
+            "peak_rss_mb": max(peaks) if peaks else None,
+        })
+
+
+# ------------------------------------------------------------------
+# Items and phases
+# ------------------------------------------------------------------
+
+@contextmanager
+def item(name: str, path: Optional[str] = None):
+    """
+    Measure one item. Its record goes to the running step it belongs to;
+    in a worker process (no step running there) it is left on
+    _local.last_item for measure_item to send back.
+    """
+    if not enabled() and getattr(_local, "worker", False) is False:
+        yield None
+        return
+    if getattr(_local, "item", None) is not None:
+        # Already inside an item (e.g. a prediction within a task)
+        yield _local.item
+        return
+    record = {"item": name, "phases": {}, "pid": os.getpid(), "thread": threading.get_ident()}
+    _local.item = record
+    read0, write0 = _io_counters()
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        _local.item = None
+        read1, write1 = _io_counters()
+        record.update(
+            ok=ok and record.get("ok", True),
+            seconds=round(time.perf_counter() - start, 4),
+            read_bytes=_delta(read1, read0),
+            write_bytes=_delta(write1, write0),
+            peak_rss_mb=_peak_rss_mb(),
+        )
+        record["phases"] = {k: round(v, 4) for k, v in record["phases"].items()}
+        step = _step_for(path)
+        if step is not None:
+            step.add_item(record)
+        else:
+            _local.last_item = record
+
+
+@contextmanager
+def phase(name: str, path: Optional[str] = None):
+    """Add the time spent in the block to a phase of the current item (or step)."""
+    current = getattr(_local, "item", None)
+    step = None
+    if current is None:
+        if not enabled():
+            yield
+            return
+        step = _step_for(path)
+        if step is None:
+            yield
+            return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if current is not None:
+            current["phases"][name] = current["phases"].get(name, 0.0) + seconds
+        else:
+            step.add_phase(name, seconds)
+
+
+def measure_item(func, name, task):
+    """
+    Run func(task) as one measured item. Used as the task function of
+    resource_scheduler.run_tasks, so it also runs on worker processes.
+
+    Returns:
+        (result, item record to pass to record_item, or None if already recorded)
+    """
+    _local.worker = True
+    _local.last_item = None
+    try:
+        with item(name) as record:
+            result = func(task)
+            if record is not None:
+                record["ok"] = result is not False
+    finally:
+        _local.worker = False
+    return result, _local.last_item
+
+
+def record_item(record: Optional[Dict], path: Optional[str] = None) -> None:
+    """Add an item record returned by measure_item in a worker process to its step."""
+    if record is None:
+        return
+    step = _step_for(path)
+    if step is not None:
+        step.add_item(record)
+
+
+# ------------------------------------------------------------------
+# Profiling (--profile)
+# ------------------------------------------------------------------
+
+def profile_path(drawer_id: str, step: str, extension: str) -> str:
+    """Where a step's profile goes: beside the run log, named after it."""
+    base = (os.path.splitext(_run["path"])[0] if _run["path"] else
+            os.path.join("run_logs", f"profile_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}"))
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    return f"{base}_{drawer_id}_{step}.{extension}"
+
+
+@contextmanager
+def profile_step(drawer_id: str, step: str, mode: str = "cprofile"):
+    """
+    Profile one step run.
+
+    Args:
+        mode: "cprofile" (deterministic, this thread only; .prof file plus the
+              top functions in the log) or "sample" (py-spy, samples this
+              process and its workers; .svg flame graph)
+    """
+    if mode == "sample":
+        py_spy = shutil.which("py-spy")
+        if py_spy is None:
+            log("py-spy not found (pip install py-spy); profiling with cProfile instead")
+        else:
+            path = profile_path(drawer_id, step, "svg")
+            proc = subprocess.Popen([py_spy, "record", "--pid", str(os.getpid()), "--subprocesses",
+                                     "--output", path, "--nonblocking"],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            try:
+                yield
+            finally:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    _, err = proc.communicate(timeout=60)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    err = b""
+                if os.path.exists(path):
+                    log(f"Profile of {step} saved to {path}")
+                else:
+                    log(f"py-spy did not write a profile: {err.decode(errors='replace').strip()[-300:]}")
+            return
+
+    path = profile_path(drawer_id, step, "prof")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        log(f"Profile of {step} saved to {path} (worker processes are not included); top functions:")
+        stats = pstats.Stats(path)
+        stats.sort_stats("cumulative")
+        for (filename, line, func), (_, calls, _, cumulative, _) in list(
+                sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True))[:12]:
+            log(f"  {cumulative:8.2f}s  {calls:>8}  {os.path.basename(filename)}:{line}({func})")
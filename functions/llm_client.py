@@ -14,6 +14,12 @@ are provider-agnostic. Responses mimic the Anthropic shape:
 """
 
 import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from functions.instrumentation import phase
+from functions.metrics import LLM_REQUESTS, LLM_SECONDS, LLM_TOKENS
 
 logging.getLogger("httpx").disabled = True
 logging.getLogger("openai").disabled = True
@@ -68,6 +74,29 @@ def _to_openai_content(content_blocks: list) -> list:
     return result
 
 
+# ---------------------------------------------------------------------------
+# Request metrics
+# ---------------------------------------------------------------------------
+
+@contextmanager
+def _request(provider: str):
+    """Time one API request (network phase and LLM metrics) and count whether it failed."""
+    start = time.perf_counter()
+    status = "error"
+    try:
+        with phase("network"):
+            yield
+        status = "ok"
+    finally:
+        LLM_SECONDS.observe(time.perf_counter() - start, provider=provider)
+        LLM_REQUESTS.inc(provider=provider, status=status)
+
+
+def _count_tokens(provider: str, input_tokens: int, output_tokens: int) -> None:
+    LLM_TOKENS.inc(input_tokens or 0, provider=provider, direction="input")
+    LLM_TOKENS.inc(output_tokens or 0, provider=provider, direction="output")
+
+
 # ---------------------------------------------------------------------------
 # Anthropic client
 # ---------------------------------------------------------------------------
@@ -102,13 +131,15 @@ class AnthropicLLMClient:
         messages: list,
         temperature: float = 0,
     ) -> MessageResponse:
-        response = self._client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            system=system,
-            messages=messages,
-        )
+        with _request("anthropic"):
+            response = self._client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system=system,
+                messages=messages,
+            )
+        _count_tokens("anthropic", response.usage.input_tokens, response.usage.output_tokens)
         return MessageResponse(
             text=response.content[0].text,
             input_tokens=response.usage.input_tokens,
@@ -194,19 +225,22 @@ class OpenAICompatibleLLMClient:
         if not first_user_done and system:
             openai_messages.insert(0, {"role": "system", "content": system})
 
-        response = self._client.chat.completions.create(
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            messages=openai_messages,
-        )
+        with _request("openai_compatible"):
+            response = self._client.chat.completions.create(
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                messages=openai_messages,
+            )
         text = (response.choices[0].message.content or "").strip()
         usage = response.usage
-        return MessageResponse(
+        result = MessageResponse(
             text=text,
             input_tokens=usage.prompt_tokens if usage else 0,
             output_tokens=usage.completion_tokens if usage else 0,
         )
+        _count_tokens("openai_compatible", result.usage.input_tokens, result.usage.output_tokens)
+        return result
 
     def is_rate_limit_error(self, exc) -> bool:
         return self._RateLimitError is not None and isinstance(exc, self._RateLimitError)
@@ -226,6 +260,68 @@ class OpenAICompatibleLLMClient:
         )
 
 
+# ---------------------------------------------------------------------------
+# Token usage metering
+# ---------------------------------------------------------------------------
+
+class UsageMeter:
+    """Calls and token counts of one step run (updated from any thread)."""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, usage: _Usage) -> None:
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += usage.input_tokens or 0
+            self.output_tokens += usage.output_tokens or 0
+
+    def to_dict(self) -> dict:
+        return {"calls": self.calls, "input_tokens": self.input_tokens, "output_tokens": self.output_tokens}
+
+
+_active_meter = threading.local()
+
+
+@contextmanager
+def meter_usage():
+    """
+    Count the tokens of every client built by build_llm_client in this thread
+    while the block runs, including calls made from worker threads it starts.
+    """
+    meter = UsageMeter()
+    previous = getattr(_active_meter, "meter", None)
+    _active_meter.meter = meter
+    try:
+        yield meter
+    finally:
+        _active_meter.meter = previous
+
+
+class _MeteredClient:
+    """A shared client whose responses are also counted in one UsageMeter."""
+
+    def __init__(self, client, meter: UsageMeter):
+        self._client = client
+        self._meter = meter
+
+    def create_message_sync(self, *args, **kwargs) -> MessageResponse:
+        response = self._client.create_message_sync(*args, **kwargs)
+        self._meter.add(response.usage)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _metered(client):
+    meter = getattr(_active_meter, "meter", None)
+    return _MeteredClient(client, meter) if meter is not None else client
+
+
 # ---------------------------------------------------------------------------
 # Factory
 # ---------------------------------------------------------------------------
@@ -233,6 +329,8 @@ class OpenAICompatibleLLMClient:
 def build_llm_client(config):
     """
     Return the correct LLM client based on config.llm_config['provider'].
+    The client is built once per config and reused by later steps and drawers.
+    Inside meter_usage() the returned client also counts its token usage.
 
     Args:
         config: DrawerDissectConfig instance
@@ -240,18 +338,24 @@ def build_llm_client(config):
     Returns:
         AnthropicLLMClient or OpenAICompatibleLLMClient
     """
+    client = config.get_cached_llm_client()
+    if client is not None:
+        return _metered(client)
+
     llm_cfg = config.llm_config
     provider = llm_cfg.get("provider", "anthropic")
 
     if provider == "anthropic":
-        return AnthropicLLMClient(api_key=config.api_keys["anthropic"])
-
-    if provider == "openai_compatible":
+        client = AnthropicLLMClient(api_key=config.api_keys["anthropic"])
+    elif provider == "openai_compatible":
         oc = llm_cfg.get("openai_compatible", {})
-        return OpenAICompatibleLLMClient(
+        client = OpenAICompatibleLLMClient(
             base_url=oc.get("base_url", "http://localhost:11434/v1"),
             api_key=oc.get("api_key", "ollama"),
         )
+    if client is not None:
+        config.set_cached_llm_client(client)
+        return _metered(client)
 
     raise ValueError(
         f"Unknown LLM provider: '{provider}'. "
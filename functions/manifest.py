@@ -0,0 +1,704 @@
+"""
+manifest.py
+
+Per-drawer record of step runs and the files they produced, kept in
+<drawer>/manifest.sqlite.
+
+- artifacts: every file under the drawer's output folders, with the folder
+  key it belongs to (config directories.drawer_subdirs), the tray or
+  specimen it is for, its size and mtime, and the step run that last wrote
+  it.
+- dirs:      the mtime of every directory under those folders when they were
+  last recorded. Files appearing or disappearing change their directory's
+  mtime, so comparing these (one stat per directory) tells whether a
+  folder's file list may have changed without listing it.
+- runs:      one row per step run: parameters, start and end time, host and
+  pid, outcome, how many artifacts it added, changed or removed, a
+  fingerprint of its input and output folders when it finished, and how
+  many files, trays or specimens it processed with its LLM token usage
+  (the throughput history --plan estimates from).
+
+- summaries:   cached reports kept up to date by the pipeline, such as the
+  per-step completion counts shown by --status.
+- derivations: for each tray or specimen output, the settings it was made
+  with and the content hashes of the input files it was made from (see
+  Invalidation below).
+
+This gives the pipeline four things:
+
+- Skipping: a step is up to date when its last run used the same
+  parameters, changed nothing, and its input and output folders still match
+  the fingerprint taken when it finished. Such a step would find nothing to
+  do, so it is skipped without scanning its folders.
+- Crash recovery: a run still marked as running whose process is gone
+  crashed. Files it left behind are checked (image end markers, JSON
+  parsing) and truncated ones are removed so the step writes them again.
+- Status: folder contents come from the database once the directory mtimes
+  confirm it is current, instead of listing every tray folder.
+- Invalidation: before a step writes a folder, outputs whose settings or
+  input contents changed since they were made are removed (invalidate), so
+  the step's own skip logic makes just those trays or specimens again.
+  Inputs are matched by name: an output for a specimen depends on the input
+  files of that specimen and of its tray, an output for a tray on those of
+  the tray and of the drawer. The drawer's files are its own image and JSON
+  (drawer_01.jpg, drawer_01_1000.json); other whole-drawer files in the
+  input folders, such as fullsize/sizeratios.csv, are not inputs. Content hashes are taken when first needed
+  and kept until the file changes; detection JSONs are hashed without their
+  timing and request ids, so a rerun that finds the same boxes leaves the
+  downstream files alone. An input that is gone only counts as a change
+  while other files of its tray (or drawer) remain in its folder, i.e. when
+  the item was dropped upstream rather than the folder cleared to save
+  space. Outputs made before tracking started are taken as current the first
+  time their step runs.
+
+Directory mtimes do not change when a file is rewritten in place, so
+rewrites are only seen when a step's outputs are recorded (which stats every
+file) and not when files are edited by hand.
+"""
+
+import json
+import os
+import pathlib
+import re
+import socket
+import sqlite3
+import threading
+import time
+import hashlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from logging_utils import log
+
+MANIFEST_NAME = "manifest.sqlite"
+
+# Directories modified this recently may change again within the same mtime
+# tick (coarse timestamps on some filesystems), so they never count as settled
+SETTLE_SECONDS = 2.0
+
+# Transient SQLite files next to databases kept in output folders
+SQLITE_SIDECARS = ('-wal', '-shm', '-journal')
+
+# Recorded mtime of a folder that does not exist
+MISSING = -1
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path        TEXT PRIMARY KEY,
+    dir_key     TEXT NOT NULL,
+    item        TEXT,
+    size        INTEGER,
+    mtime_ns    INTEGER,
+    step        TEXT,
+    run_id      INTEGER,
+    recorded_at REAL,
+    hash        TEXT
+);
+CREATE INDEX IF NOT EXISTS artifacts_dir_key ON artifacts (dir_key);
+CREATE TABLE IF NOT EXISTS dirs (
+    path     TEXT PRIMARY KEY,
+    dir_key  TEXT NOT NULL,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_dir_key ON dirs (dir_key);
+CREATE TABLE IF NOT EXISTS runs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    step        TEXT NOT NULL,
+    params      TEXT,
+    host        TEXT,
+    pid         INTEGER,
+    started_at  REAL,
+    finished_at REAL,
+    status      TEXT,
+    changed     INTEGER,
+    input_fingerprint TEXT,
+    fingerprint TEXT,
+    units       INTEGER,
+    usage       TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_step ON runs (step, id);
+CREATE TABLE IF NOT EXISTS derivations (
+    output  TEXT PRIMARY KEY,
+    dir_key TEXT NOT NULL,
+    params  TEXT,
+    inputs  TEXT,
+    run_id  INTEGER
+);
+CREATE INDEX IF NOT EXISTS derivations_dir_key ON derivations (dir_key);
+CREATE TABLE IF NOT EXISTS summaries (
+    name       TEXT PRIMARY KEY,
+    value      TEXT,
+    updated_at REAL
+);
+"""
+
+# Fields of detection JSONs that differ between calls returning the same boxes
+VOLATILE_JSON_KEYS = {"time", "inference_id", "detection_id", "image_path"}
+
+
+def item_id(filename: str) -> str:
+    """Tray or specimen a file belongs to, e.g. 'drawer_01_tray_03_spec_002' (else the file stem)."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    match = re.match(r'(.*?_tray_\d+(?:_spec_\d+)?)', stem)
+    return match.group(1) if match else stem
+
+
+def parent_item(item: str) -> Optional[str]:
+    """Tray of a specimen item, drawer of a tray item, None for anything else."""
+    match = re.fullmatch(r'(.*?)(_tray_\d+)(_spec_\d+)?', item)
+    if not match:
+        return None
+    return match.group(1) + match.group(2) if match.group(3) else match.group(1)
+
+
+def _same_drawer(a: str, b: str) -> bool:
+    """True if two whole-drawer items are files of the same drawer, e.g. 'drawer_01' and 'drawer_01_1000'."""
+    return bool(re.fullmatch(re.escape(a) + r'(_\d+)?', b) or re.fullmatch(re.escape(b) + r'(_\d+)?', a))
+
+
+def derives_from(item: str, source: str) -> bool:
+    """True if an output for item is made from the input files of item source (see Invalidation)."""
+    if source == item:
+        return True
+    parent = parent_item(item)
+    if parent is None:
+        return parent_item(source) is None and _same_drawer(item, source)
+    if parent_item(parent) is None:
+        return parent_item(source) is None and _same_drawer(parent, source)
+    return source == parent
+
+
+def _strip_volatile(data):
+    if isinstance(data, dict):
+        return {k: _strip_volatile(v) for k, v in data.items() if k not in VOLATILE_JSON_KEYS}
+    if isinstance(data, list):
+        return [_strip_volatile(v) for v in data]
+    return data
+
+
+def content_hash(path: str) -> str:
+    """Digest of a file's content (JSON without VOLATILE_JSON_KEYS, other files byte for byte)."""
+    digest = hashlib.blake2b(digest_size=16)
+    if path.lower().endswith('.json'):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            digest.update(json.dumps(_strip_volatile(data), sort_keys=True).encode())
+            return digest.hexdigest()
+        except ValueError:
+            pass
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_complete(path: str) -> bool:
+    """Cheap check that a file was written to the end (image end markers, JSON that parses)."""
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        size = os.path.getsize(path)
+        if ext in ('.jpg', '.jpeg', '.png', '.json') and size == 0:
+            return False
+        if ext in ('.jpg', '.jpeg', '.png'):
+            with open(path, 'rb') as f:
+                f.seek(max(0, size - 1024))
+                tail = f.read()
+            return (b'\xff\xd9' if ext != '.png' else b'IEND') in tail
+        if ext == '.json':
+            with open(path) as f:
+                json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class Manifest:
+    """The manifest of one drawer."""
+
+    def __init__(self, drawer_dir: str, directories: Dict[str, str], snapshot: bool = False):
+        """
+        Args:
+            drawer_dir:  The drawer folder; paths are stored relative to it
+            directories: Folder key -> path for every drawer subfolder
+            snapshot:    Work on an in-memory copy of the existing manifest
+                         file, which is only read (see open_snapshot)
+        """
+        self.drawer_dir = os.path.normpath(drawer_dir)
+        self.directories = {k: os.path.normpath(v) for k, v in directories.items()}
+        self.path = os.path.join(self.drawer_dir, MANIFEST_NAME)
+        self.lock = threading.RLock()
+        if snapshot:
+            source = sqlite3.connect(f"{pathlib.Path(os.path.abspath(self.path)).as_uri()}?mode=ro",
+                                     uri=True, timeout=60)
+            self._db = sqlite3.connect(":memory:", check_same_thread=False)
+            try:
+                source.backup(self._db)
+            finally:
+                source.close()
+        else:
+            os.makedirs(self.drawer_dir, exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        if "hash" not in {row[1] for row in self._db.execute("PRAGMA table_info(artifacts)")}:
+            self._db.execute("ALTER TABLE artifacts ADD COLUMN hash TEXT")
+        run_columns = {row[1] for row in self._db.execute("PRAGMA table_info(runs)")}
+        for column, kind in (("units", "INTEGER"), ("usage", "TEXT")):
+            if column not in run_columns:
+                self._db.execute(f"ALTER TABLE runs ADD COLUMN {column} {kind}")
+        self._db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self._db.close()
+
+    # ------------------------------------------------------------------
+    # Folders
+    # ------------------------------------------------------------------
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(path, self.drawer_dir).replace(os.sep, '/')
+
+    def _abs(self, rel: str) -> str:
+        return os.path.join(self.drawer_dir, *rel.split('/'))
+
+    def _nested(self, key: str) -> set:
+        """Roots of other folder keys inside this one; they are recorded under their own key."""
+        root = self.directories[key]
+        return {p for k, p in self.directories.items() if k != key and p.startswith(root + os.sep)}
+
+    def sync(self, key: str, full: bool = False, step: Optional[str] = None,
+             run_id: Optional[int] = None) -> int:
+        """
+        Bring the records of one folder up to date with the disk.
+
+        Only directories whose mtime changed are listed again, unless full is
+        set, in which case every file is stat'ed so in-place rewrites are seen
+        too. New and changed files are attributed to step/run_id.
+
+        Returns:
+            int: Number of artifacts added, changed or removed
+        """
+        root = self.directories[key]
+        nested = self._nested(key)
+        now = time.time()
+
+        with self.lock:
+            recorded_dirs = dict(self._db.execute(
+                "SELECT path, mtime_ns FROM dirs WHERE dir_key = ?", (key,)))
+            artifacts = {path: (size, mtime) for path, size, mtime in self._db.execute(
+                "SELECT path, size, mtime_ns FROM artifacts WHERE dir_key = ?", (key,))}
+
+            children = defaultdict(list)
+            for rel in recorded_dirs:
+                children[rel.rsplit('/', 1)[0] if '/' in rel else ''].append(rel)
+            by_dir = defaultdict(list)
+            for rel in artifacts:
+                by_dir[rel.rsplit('/', 1)[0]].append(rel)
+
+            seen_dirs, kept, upserts = {}, set(), []
+            stack = [root]
+            while stack:
+                directory = stack.pop()
+                rel_dir = self._rel(directory)
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    if directory == root:
+                        seen_dirs[rel_dir] = MISSING
+                    continue
+
+                settled = mtime if now - mtime / 1e9 > SETTLE_SECONDS else None
+                if not full and settled is not None and recorded_dirs.get(rel_dir) == mtime:
+                    seen_dirs[rel_dir] = mtime
+                    kept.update(by_dir[rel_dir])
+                    stack.extend(self._abs(c) for c in children[rel_dir])
+                    continue
+
+                seen_dirs[rel_dir] = settled
+                try:
+                    with os.scandir(directory) as entries:
+                        entries = list(entries)
+                except OSError:
+                    continue
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if entry.path not in nested:
+                                stack.append(entry.path)
+                            continue
+                        if entry.name == MANIFEST_NAME or entry.name.endswith(SQLITE_SIDECARS):
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    rel = self._rel(entry.path)
+                    kept.add(rel)
+                    if artifacts.get(rel) != (st.st_size, st.st_mtime_ns):
+                        upserts.append((rel, key, item_id(entry.name), st.st_size, st.st_mtime_ns,
+                                        step, run_id, now))
+
+            removed = [(rel,) for rel in artifacts if rel not in kept]
+            # Replacing a row clears its hash, so changed files are hashed again when needed
+            self._db.executemany(
+                "INSERT OR REPLACE INTO artifacts (path, dir_key, item, size, mtime_ns, step, run_id, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", upserts)
+            self._db.executemany("DELETE FROM artifacts WHERE path = ?", removed)
+            self._db.executemany("DELETE FROM derivations WHERE output = ?", removed)
+            self._db.execute("DELETE FROM dirs WHERE dir_key = ?", (key,))
+            self._db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                 [(rel, key, mtime) for rel, mtime in seen_dirs.items()])
+            self._db.commit()
+        return len(upserts) + len(removed)
+
+    def unchanged(self, keys: Iterable[str]) -> bool:
+        """True if every recorded directory of these folders still has its recorded, settled mtime."""
+        with self.lock:
+            for key in keys:
+                rows = self._db.execute("SELECT path, mtime_ns FROM dirs WHERE dir_key = ?", (key,)).fetchall()
+                if not rows:
+                    return False
+                for rel, recorded in rows:
+                    if recorded is None:
+                        return False
+                    try:
+                        mtime = os.stat(self._abs(rel)).st_mtime_ns
+                    except OSError:
+                        mtime = MISSING
+                    if mtime != recorded:
+                        return False
+        return True
+
+    def fingerprint(self, keys: Iterable[str]) -> Optional[str]:
+        """
+        Digest of the recorded directory mtimes of these folders and a summary
+        of their recorded files, so rewrites seen by a full sync count too
+        (None if any directory is not settled).
+        """
+        digest = hashlib.sha1()
+        with self.lock:
+            for key in sorted(set(keys)):
+                for rel, mtime in self._db.execute(
+                        "SELECT path, mtime_ns FROM dirs WHERE dir_key = ? ORDER BY path", (key,)):
+                    if mtime is None:
+                        return None
+                    digest.update(f"{rel}\0{mtime}\n".encode())
+                count, total, latest = self._db.execute(
+                    "SELECT count(*), sum(size), max(mtime_ns) FROM artifacts WHERE dir_key = ?", (key,)).fetchone()
+                digest.update(f"{key}\0{count}\0{total}\0{latest}\n".encode())
+        return digest.hexdigest()
+
+    def files(self, key: str) -> List[str]:
+        """Recorded files of a folder, relative to the folder ('/'-separated)."""
+        prefix = self._rel(self.directories[key]) + '/'
+        with self.lock:
+            return [path[len(prefix):] for (path,) in self._db.execute(
+                "SELECT path FROM artifacts WHERE dir_key = ? ORDER BY path", (key,))]
+
+    def save_summary(self, name: str, value) -> None:
+        """Cache a JSON-serialisable summary of the drawer under a name."""
+        with self.lock:
+            self._db.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+                             (name, json.dumps(value), time.time()))
+            self._db.commit()
+
+    def load_summary(self, name: str) -> tuple:
+        """(summary, time it was saved), or (None, None) if none was saved."""
+        with self.lock:
+            row = self._db.execute("SELECT value, updated_at FROM summaries WHERE name = ?", (name,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, None)
+
+    # ------------------------------------------------------------------
+    # Derivations
+    # ------------------------------------------------------------------
+
+    def _input_files(self, input_keys: Iterable[str]) -> Dict[str, list]:
+        """Recorded files of the input folders: path -> [folder key, item, hash or None]."""
+        files = {}
+        for key in input_keys:
+            for path, item, digest in self._db.execute(
+                    "SELECT path, item, hash FROM artifacts WHERE dir_key = ?", (key,)):
+                files[path] = [key, item, digest]
+        return files
+
+    def _hash_of(self, files: Dict[str, list], path: str) -> Optional[str]:
+        """Content hash of a recorded input file, computed and stored on first use."""
+        entry = files[path]
+        if entry[2] is None:
+            try:
+                entry[2] = content_hash(self._abs(path))
+            except OSError:
+                return None
+            self._db.execute("UPDATE artifacts SET hash = ? WHERE path = ?", (entry[2], path))
+        return entry[2]
+
+    def record(self, key: str, input_keys: List[str], params: str, run_id: Optional[int] = None,
+               rows: Optional[Iterable[str]] = None, drawer_level: bool = False) -> int:
+        """
+        Record how the outputs of a folder were made: the settings they depend
+        on and the content hashes of their input files as they are now.
+
+        Covers the files written by run_id and those with no record yet, and
+        with rows also the rows of an aggregate file in the folder (e.g.
+        measurements.csv), by item.
+
+        Args:
+            key:          Output folder key
+            input_keys:   Folders its files are made from
+            params:       Settings they depend on besides their inputs
+            run_id:       Run that wrote the folder's new and changed files
+            rows:         Item ids of the rows of the folder's aggregate file
+            drawer_level: Also track files that are not for a tray or specimen
+
+        Returns:
+            int: Number of outputs recorded
+        """
+        with self.lock:
+            recorded = {output for (output,) in self._db.execute(
+                "SELECT output FROM derivations WHERE dir_key = ?", (key,))}
+            outputs = [(path, item) for path, item, written_by in self._db.execute(
+                           "SELECT path, item, run_id FROM artifacts WHERE dir_key = ?", (key,))
+                       if (drawer_level or parent_item(item) is not None)
+                       and (path not in recorded or (run_id is not None and written_by == run_id))]
+            if rows is not None:
+                rows = set(rows)
+                prefix = f"{key}#"
+                outputs += [(prefix + item, item) for item in sorted(rows) if prefix + item not in recorded]
+                self._db.executemany("DELETE FROM derivations WHERE output = ?", [
+                    (output,) for output in recorded
+                    if output.startswith(prefix) and output[len(prefix):] not in rows])
+
+            files = self._input_files(input_keys) if outputs else {}
+            by_item = defaultdict(list)
+            for path, (_, item, _) in files.items():
+                by_item[item].append(path)
+            drawer_items = [item for item in by_item if parent_item(item) is None]
+            drawer_inputs = {}  # drawer -> paths of its own whole-drawer files
+
+            def of_drawer(drawer):
+                if drawer not in drawer_inputs:
+                    drawer_inputs[drawer] = [path for item in drawer_items if _same_drawer(drawer, item)
+                                             for path in by_item[item]]
+                return drawer_inputs[drawer]
+
+            records = []
+            for output, item in outputs:
+                parent = parent_item(item)
+                if parent is None:
+                    sources = of_drawer(item)
+                elif parent_item(parent) is None:
+                    sources = by_item[item] + of_drawer(parent)
+                else:
+                    sources = by_item[item] + by_item[parent]
+                inputs = sorted((files[path][0], path, self._hash_of(files, path)) for path in sources)
+                records.append((output, key, params,
+                                json.dumps([i for i in inputs if i[2] is not None]), run_id))
+            self._db.executemany("INSERT OR REPLACE INTO derivations VALUES (?, ?, ?, ?, ?)", records)
+            self._db.commit()
+        return len(records)
+
+    def invalidate(self, key: str, input_keys: List[str], params: str) -> List[str]:
+        """
+        Remove the outputs of a folder whose settings or input contents
+        changed since they were recorded, so the step writing the folder
+        makes them again.
+
+        Returns:
+            List[str]: Items of recorded aggregate rows that are out of date;
+                       their records are dropped and the caller removes the rows
+        """
+        with self.lock:
+            derivations = self._db.execute(
+                "SELECT output, params, inputs FROM derivations WHERE dir_key = ?", (key,)).fetchall()
+            if not derivations:
+                return []
+            files = self._input_files(input_keys)
+            present = defaultdict(set)  # folder key -> trays and drawers with files in it
+            for path, (input_key, item, _) in files.items():
+                parent = parent_item(item)
+                if parent is not None:
+                    present[input_key].add(parent)
+
+            def changed(input_key, path, digest):
+                if path not in files:
+                    # Gone: the item was dropped upstream if the rest of its tray or drawer is still there
+                    parent = parent_item(item_id(path))
+                    return parent is not None and parent in present[input_key]
+                return self._hash_of(files, path) != digest
+
+            def output_item(output):
+                return output.split('#', 1)[1] if '#' in output else item_id(output)
+
+            # Inputs are filtered again so records made before drawer files were
+            # matched by name do not count unrelated files such as sizeratios.csv
+            stale = [output for output, recorded_params, inputs in derivations
+                     if recorded_params != params
+                     or any(changed(*i) for i in json.loads(inputs)
+                            if derives_from(output_item(output), item_id(i[1])))]
+            self._db.executemany("DELETE FROM derivations WHERE output = ?", [(output,) for output in stale])
+            self._db.commit()
+
+        prefix = f"{key}#"
+        rows = [output[len(prefix):] for output in stale if output.startswith(prefix)]
+        removed = 0
+        for output in stale:
+            if output.startswith(prefix):
+                continue
+            try:
+                os.remove(self._abs(output))
+                removed += 1
+            except OSError:
+                continue
+        if removed:
+            self.sync(key)
+            log(f"{key}: removed {removed} outdated file(s) whose inputs or settings changed")
+        return rows
+
+    # ------------------------------------------------------------------
+    # Runs
+    # ------------------------------------------------------------------
+
+    def up_to_date(self, step: str, params: str, input_keys: List[str], output_keys: List[str]) -> bool:
+        """True if the step's last run would be repeated with nothing to do (see module docstring)."""
+        keys = list(input_keys) + list(output_keys)
+        with self.lock:
+            row = self._db.execute(
+                "SELECT params, status, changed, fingerprint FROM runs WHERE step = ? ORDER BY id DESC LIMIT 1",
+                (step,)).fetchone()
+            if not row or row[0] != params or row[1] != "finished" or row[2] != 0 or row[3] is None:
+                return False
+            return self.unchanged(keys) and self.fingerprint(keys) == row[3]
+
+    def begin(self, step: str, params: str, input_keys: List[str], output_keys: List[str]) -> int:
+        """Record the start of a step run (after recovering crashed runs of the step). Returns the run id."""
+        self.recover(step, output_keys)
+        for key in input_keys:
+            self.sync(key)
+        with self.lock:
+            cursor = self._db.execute(
+                "INSERT INTO runs (step, params, host, pid, started_at, status, input_fingerprint) "
+                "VALUES (?, ?, ?, ?, ?, 'running', ?)",
+                (step, params, socket.gethostname(), os.getpid(), time.time(), self.fingerprint(input_keys)))
+            self._db.commit()
+            return cursor.lastrowid
+
+    def finish(self, run_id: int, step: str, input_keys: List[str], output_keys: List[str],
+               ok: bool = True) -> int:
+        """
+        Record the end of a step run and the artifacts it produced.
+
+        Returns:
+            int: Number of artifacts the run added, changed or removed
+        """
+        changed = sum(self.sync(key, full=True, step=step, run_id=run_id) for key in output_keys)
+        for key in input_keys:
+            if key not in output_keys:
+                self.sync(key)
+        with self.lock:
+            (input_fingerprint,) = self._db.execute(
+                "SELECT input_fingerprint FROM runs WHERE id = ?", (run_id,)).fetchone()
+            # Inputs that changed while the step ran may not have been seen by it
+            fingerprint = None
+            if input_fingerprint is not None and self.fingerprint(input_keys) == input_fingerprint:
+                fingerprint = self.fingerprint(list(input_keys) + list(output_keys))
+            self._db.execute(
+                "UPDATE runs SET finished_at = ?, status = ?, changed = ?, fingerprint = ? WHERE id = ?",
+                (time.time(), "finished" if ok else "failed", changed, fingerprint, run_id))
+            self._db.commit()
+        return changed
+
+    def record_work(self, run_id: int, units: Optional[int], usage: Optional[dict] = None) -> None:
+        """Store how many trays/specimens/files a run processed and its LLM token usage."""
+        with self.lock:
+            self._db.execute("UPDATE runs SET units = ?, usage = ? WHERE id = ?",
+                             (units, json.dumps(usage) if usage else None, run_id))
+            self._db.commit()
+
+    def work_history(self) -> List[tuple]:
+        """(step, seconds, units, usage) of every finished run that recorded its units."""
+        with self.lock:
+            rows = self._db.execute(
+                "SELECT step, finished_at - started_at, units, usage FROM runs "
+                "WHERE status = 'finished' AND units IS NOT NULL").fetchall()
+        return [(step, seconds, units, json.loads(usage) if usage else None) for step, seconds, units, usage in rows]
+
+    def recover(self, step: str, output_keys: List[str]) -> int:
+        """
+        Find earlier runs of the step on this host whose process is gone
+        without finishing, and remove the incomplete files they left in the
+        output folders. Returns the number of files removed.
+        """
+        host = socket.gethostname()
+        with self.lock:
+            crashed = [(run_id, started) for run_id, started, pid in self._db.execute(
+                "SELECT id, started_at, pid FROM runs WHERE step = ? AND status = 'running' AND host = ?",
+                (step, host)) if pid != os.getpid() and not _process_alive(pid)]
+        if not crashed:
+            return 0
+
+        since_ns = int(min(started for _, started in crashed) * 1e9)
+        removed = 0
+        for key in output_keys:
+            nested = self._nested(key)
+            for dirpath, dirnames, files in os.walk(self.directories[key]):
+                dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in nested]
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        if os.stat(path).st_mtime_ns < since_ns or is_complete(path):
+                            continue
+                        os.remove(path)
+                        removed += 1
+                        log(f"Removed incomplete {self._rel(path)} left by an interrupted {step} run")
+                    except OSError:
+                        continue
+
+        with self.lock:
+            self._db.executemany("UPDATE runs SET status = 'crashed' WHERE id = ?",
+                                 [(run_id,) for run_id, _ in crashed])
+            self._db.commit()
+        log(f"{step}: found {len(crashed)} interrupted run(s), removed {removed} incomplete file(s)")
+        return removed
+
+
+def manifest_for(drawer_dir: str, directories: Dict[str, str]) -> Manifest:
+    """The manifest of a drawer, opened once per process."""
+    key = (os.getpid(), os.path.abspath(drawer_dir))
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = Manifest(drawer_dir, directories)
+        return _manifests[key]
+
+
+def open_snapshot(drawer_dir: str, directories: Dict[str, str]) -> Optional[Manifest]:
+    """
+    A private in-memory copy of a drawer's manifest, for dry runs: it can be
+    synced and queried like the manifest, but the file is only read and
+    nothing is written back. None if the drawer has no manifest. Close it
+    when done.
+    """
+    if not os.path.exists(os.path.join(drawer_dir, MANIFEST_NAME)):
+        return None
+    return Manifest(drawer_dir, directories, snapshot=True)
+
+
+def close_manifest(drawer_dir: str) -> None:
+    """Close this process's connection to a drawer's manifest, if open (it is reopened on next use)."""
+    key = (os.getpid(), os.path.abspath(drawer_dir))
+    with _manifests_lock:
+        manifest = _manifests.pop(key, None)
+    if manifest is not None:
+        manifest.close()
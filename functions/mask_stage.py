@@ -0,0 +1,196 @@
+"""
+mask_stage.py
+
+create_masks -> fix_masks -> measure_specimens form a pure chain on each
+specimen: rasterize the outline polygons, keep the largest component,
+measure it. Run as separate steps, every mask PNG is written by create_masks,
+read and rewritten by fix_masks, then read again by measure_specimens.
+
+The fused stage runs the chain for one specimen at a time in a worker
+process, entirely in memory: the final mask PNG is written once and the
+measurement row is sent back to the parent, which appends it to
+measurements.csv.
+
+Output files match the separate steps byte for byte (an unchanged mask is
+saved the way create_masks saves it, a fixed one the way fix_masks does), so
+the separate steps remain usable for debugging or re-running one part. With
+the mask store, masks go to the per-tray containers instead.
+"""
+
+import os
+import json
+import numpy as np
+from logging_utils import log, log_found, log_progress
+from functions.create_masks import rasterize_polygons
+from functions.multipolygon_fixer import keep_largest_component
+from functions.measure import (
+    measure_mask_array, process_polygons, measurement_row, compact_result,
+    MeasurementWriter, create_visualizations,
+)
+from functions.resource_scheduler import run_tasks
+from functions.mask_store import mask_exists, read_mask, write_mask, iter_masks
+
+MASK_STAGE_STEPS = ("create_masks", "fix_masks", "measure_specimens")
+
+
+def _mirror(path, input_dir, output_dir, ext):
+    relative = os.path.relpath(path, input_dir)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + ext)
+
+
+def find_mask_jobs(mask_coordinates_dir, mask_png_dir, steps, processed_ids):
+    """
+    Build one job per specimen that still has work to do.
+
+    When create_masks is part of the stage, specimens come from the outline
+    JSONs and an existing PNG counts as already created and fixed. Otherwise
+    they come from the existing PNGs, which are fixed and measured as the
+    separate steps would.
+    """
+    create = "create_masks" in steps
+    fix = "fix_masks" in steps
+    measure = "measure_specimens" in steps
+
+    if create:
+        sources = sorted(os.path.join(root, f) for root, _, files in os.walk(mask_coordinates_dir)
+                         for f in files if f.endswith('.json'))
+    else:
+        sources = sorted(iter_masks(mask_png_dir))
+
+    jobs = []
+    for path in sources:
+        if 'checkpoint' in os.path.basename(path):
+            continue
+        if create:
+            json_path, png_path = path, _mirror(path, mask_coordinates_dir, mask_png_dir, '.png')
+        else:
+            json_path, png_path = _mirror(path, mask_png_dir, mask_coordinates_dir, '.json'), path
+
+        full_id = os.path.splitext(os.path.basename(path))[0]
+        needs_create = create and not mask_exists(png_path)
+        job = {
+            'full_id': full_id,
+            'json_path': json_path,
+            'png_path': png_path,
+            'create': needs_create,
+            'fix': fix and (needs_create or not create),
+            'measure': measure and full_id not in processed_ids,
+        }
+        if job['create'] or job['fix'] or job['measure']:
+            jobs.append(job)
+    return jobs
+
+
+def fused_mask_task(args):
+    """
+    Worker entry point: rasterize, fix and measure one specimen in memory.
+    Returns (full_id, measurement result or None).
+    """
+    job, current, total, options = args
+    done = []
+
+    try:
+        mask = None
+        if job['create']:
+            with open(job['json_path'], 'r') as f:
+                image = rasterize_polygons(json.load(f))
+            if image is None:
+                log(f"Skipped {job['json_path']}: Invalid dimensions")
+                return job['full_id'], None
+            mask = np.asarray(image)
+            os.makedirs(os.path.dirname(job['png_path']), exist_ok=True)
+            done.append('mask')
+        elif job['fix'] or (job['measure'] and not options['polygon_source']):
+            mask = read_mask(job['png_path'])
+            if mask is None:
+                log(f"Could not read {job['png_path']}")
+                return job['full_id'], None
+
+        written = False
+        if job['fix']:
+            fixed, _ = keep_largest_component(mask)
+            if not np.array_equal(fixed, mask) or not options['only_changed']:
+                write_mask(job['png_path'], fixed, store=options['store'] if job['create'] else None)
+                written = True
+                done.append('fixed')
+            mask = fixed
+        if job['create'] and not written:
+            if options['store']:
+                write_mask(job['png_path'], mask, store=True)
+            else:
+                image.save(job['png_path'], optimize=True)
+
+        result = None
+        if job['measure']:
+            if options['polygon_source']:
+                result = process_polygons(job['json_path'], options['length_engine'])
+            else:
+                result = measure_mask_array(mask, options['length_engine'], job['png_path'])
+            result = compact_result(result)
+            done.append('measured')
+
+        log_progress("mask_stage", current, total, f"{job['full_id']} ({', '.join(done) or 'nothing to do'})")
+        return job['full_id'], result
+
+    except Exception as e:
+        log(f"Error processing {job['full_id']}: {str(e)}")
+        return job['full_id'], None
+
+
+def run_fused_mask_stage(mask_coordinates_dir, mask_png_dir, measurements_dir,
+                         steps=MASK_STAGE_STEPS, sequential=False, max_workers=None,
+                         length_engine="compat", polygon_source=False,
+                         visualization_mode="on", only_changed=True, store=False,
+                         csv_filename='measurements.csv'):
+    """
+    Run create_masks, fix_masks and measure_specimens as one pass per specimen.
+
+    Args:
+        mask_coordinates_dir: Directory containing outline_specimens JSONs
+        mask_png_dir:         Directory for the mask PNGs
+        measurements_dir:     Directory for measurements.csv and visualizations
+        steps:                Which of the three steps to cover
+        sequential:           Process one specimen at a time
+        max_workers:          Maximum number of worker processes
+        length_engine:        "compat" or "calipers" (see measure.get_lengths)
+        polygon_source:       Measure from the JSON polygons instead of the mask
+        visualization_mode:   "on", "off", or "rand_sample"
+        only_changed:         Only rewrite masks that fixing changes
+        store:                Save new masks in per-tray containers instead of PNGs (see mask_store)
+    """
+    measure = "measure_specimens" in steps
+    writer = None
+    processed_ids = set()
+    if measure:
+        os.makedirs(measurements_dir, exist_ok=True)
+        writer = MeasurementWriter(os.path.join(measurements_dir, csv_filename))
+        processed_ids = writer.processed_ids
+
+    jobs = find_mask_jobs(mask_coordinates_dir, mask_png_dir, steps, processed_ids)
+
+    def record(index, output):
+        # A task that crashed its worker comes back as False; record it as a failed measurement
+        if jobs[index]['measure']:
+            writer.append(measurement_row(jobs[index]['full_id'], output[1] if output else None))
+
+    try:
+        if jobs:
+            log_found("specimens", len(jobs))
+            options = {
+                'length_engine': length_engine,
+                'polygon_source': polygon_source,
+                'only_changed': only_changed,
+                'store': store,
+            }
+            tasks = [(job, i, len(jobs), options) for i, job in enumerate(jobs, 1)]
+            run_tasks(fused_mask_task, tasks, "mask_stage", [None] * len(tasks),
+                      sequential=sequential, max_workers=max_workers,
+                      on_result=record if measure else None)
+        else:
+            log("No pending specimen masks")
+    finally:
+        total_rows = writer.finish() if writer else 0
+
+    if measure:
+        create_visualizations(writer.csv_path, mask_png_dir, measurements_dir, visualization_mode, total_rows,
+                              sequential=sequential, max_workers=max_workers)
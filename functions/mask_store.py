@@ -0,0 +1,207 @@
+"""
+mask_store.py
+
+Optional compact storage for binary masks (processing.mask_storage: "store").
+
+With PNG storage every specimen leaves one mask_png file and one or more
+full_masks files. With the store, the masks of each tray folder live in a
+single container, <mask dir>/<tray folder>/masks.sqlite, with one row per mask
+holding its size and its run-length encoding (zlib-compressed uint32 run
+lengths, alternating background/foreground, starting with background).
+
+Masks keep their PNG paths as keys: <dir>/<tray>/<name>.png is stored as
+<name> in <dir>/<tray>/masks.sqlite. So the steps compute paths exactly as
+before and only swap their image reads and writes for read_mask/write_mask,
+which use the PNG when it exists and the container otherwise. Readers
+therefore work with either storage, and a folder may hold both.
+
+PNGs are exported on demand with export_pngs (see
+advanced_functions/export_masks.py).
+"""
+
+import os
+import sqlite3
+import threading
+import zlib
+from typing import Iterator, List, Optional
+
+import cv2
+import numpy as np
+
+from functions.file_index import FileIndex, index_for
+from functions.instrumentation import phase
+
+CONTAINER_NAME = "masks.sqlite"
+
+_containers = {}
+_containers_lock = threading.Lock()
+
+
+def rle_encode(mask: np.ndarray) -> bytes:
+    """Run-length encode a binary mask (values > 127 are foreground)."""
+    flat = (np.asarray(mask) > 127).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        # Runs always start with background
+        runs = np.concatenate(([0], runs))
+    return zlib.compress(runs.astype(np.uint32).tobytes(), 1)
+
+
+def rle_decode(blob: bytes, height: int, width: int) -> np.ndarray:
+    """Decode rle_encode output back to a 0/255 uint8 mask."""
+    runs = np.frombuffer(zlib.decompress(blob), dtype=np.uint32)
+    values = np.zeros(len(runs), dtype=np.uint8)
+    values[1::2] = 255
+    return np.repeat(values, runs).reshape(height, width)
+
+
+class MaskContainer:
+    """All masks of one tray folder in a single SQLite file, keyed by name."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # Default rollback journal: no -wal/-shm files left beside the container
+        # by worker processes that exit without closing their connection
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS masks "
+                         "(name TEXT PRIMARY KEY, height INTEGER, width INTEGER, rle BLOB)")
+        self._db.commit()
+
+    def get(self, name: str) -> Optional[np.ndarray]:
+        with self.lock:
+            row = self._db.execute("SELECT height, width, rle FROM masks WHERE name = ?", (name,)).fetchone()
+        return rle_decode(row[2], row[0], row[1]) if row else None
+
+    def put(self, name: str, mask: np.ndarray) -> None:
+        height, width = mask.shape[:2]
+        blob = rle_encode(mask)
+        with self.lock:
+            self._db.execute("INSERT OR REPLACE INTO masks VALUES (?, ?, ?, ?)", (name, height, width, blob))
+            self._db.commit()
+
+    def __contains__(self, name: str) -> bool:
+        with self.lock:
+            return self._db.execute("SELECT 1 FROM masks WHERE name = ?", (name,)).fetchone() is not None
+
+    def names(self) -> List[str]:
+        with self.lock:
+            return [r[0] for r in self._db.execute("SELECT name FROM masks ORDER BY name")]
+
+    def close(self) -> None:
+        with self.lock:
+            self._db.close()
+
+
+def _container(directory: str, create: bool = False) -> Optional[MaskContainer]:
+    """The container of a folder, or None if it has none and create is False."""
+    path = os.path.join(directory, CONTAINER_NAME)
+    # Connections must not cross a fork, so each process opens its own
+    key = (os.getpid(), os.path.abspath(path))
+    with _containers_lock:
+        if key not in _containers:
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(directory, exist_ok=True)
+            _containers[key] = MaskContainer(path)
+        return _containers[key]
+
+
+def close_containers(root: str) -> None:
+    """Close this process's connections to the containers under root (they are reopened on next use)."""
+    root = os.path.abspath(root)
+    with _containers_lock:
+        keys = [k for k in _containers if k[0] == os.getpid() and k[1].startswith(root + os.sep)]
+        containers = [_containers.pop(k) for k in keys]
+    for container in containers:
+        container.close()
+
+
+def _split(png_path: str):
+    return os.path.dirname(png_path), os.path.splitext(os.path.basename(png_path))[0]
+
+
+def mask_exists(png_path: str) -> bool:
+    """True if the mask exists as a PNG or in its folder's container."""
+    if os.path.exists(png_path):
+        return True
+    directory, name = _split(png_path)
+    container = _container(directory)
+    return container is not None and name in container
+
+
+def read_mask(png_path: str) -> Optional[np.ndarray]:
+    """Grayscale mask from the PNG if it exists, else from the container; None if neither has it."""
+    with phase("decode", png_path):
+        if os.path.exists(png_path):
+            return cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
+        directory, name = _split(png_path)
+        container = _container(directory)
+        return container.get(name) if container is not None else None
+
+
+def write_mask(png_path: str, mask: np.ndarray, store: Optional[bool] = None) -> None:
+    """
+    Save a binary mask under its PNG path.
+
+    Args:
+        store: True = container, False = PNG file, None = wherever the mask
+               is now (PNG if that file exists, otherwise the container)
+    """
+    if store is None:
+        store = not os.path.exists(png_path) and mask_exists(png_path)
+    with phase("encode", png_path):
+        if store:
+            directory, name = _split(png_path)
+            _container(directory, create=True).put(name, mask)
+        else:
+            cv2.imwrite(png_path, mask)
+
+
+def iter_masks(root: str) -> Iterator[str]:
+    """
+    PNG paths of every mask under root, whether stored as a file or in a
+    container. A mask present both ways is yielded once, for its PNG.
+    """
+    for dirpath, _, files in os.walk(root):
+        pngs = [f for f in files if f.endswith('.png')]
+        for f in pngs:
+            yield os.path.join(dirpath, f)
+        if CONTAINER_NAME in files:
+            exported = set(pngs)
+            for name in _container(dirpath).names():
+                if f"{name}.png" not in exported:
+                    yield os.path.join(dirpath, f"{name}.png")
+
+
+def find_mask(root: str, filenames: List[str], index: Optional[FileIndex] = None) -> Optional[str]:
+    """
+    Search root recursively for the first of the given mask file names.
+
+    Args:
+        index: FileIndex of root to reuse (default: index_for(root))
+    """
+    index = index or index_for(root)
+    for dirpath in index.directories_with(list(filenames) + [CONTAINER_NAME]):
+        container = _container(dirpath)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.exists(path) or (container and os.path.splitext(filename)[0] in container):
+                return path
+    return None
+
+
+def export_pngs(root: str, overwrite: bool = False) -> int:
+    """Write every stored mask under root as a PNG at its path. Returns the number written."""
+    written = 0
+    for dirpath, _, files in os.walk(root):
+        if CONTAINER_NAME not in files:
+            continue
+        container = _container(dirpath)
+        for name in container.names():
+            png_path = os.path.join(dirpath, f"{name}.png")
+            if overwrite or not os.path.exists(png_path):
+                cv2.imwrite(png_path, container.get(name))
+                written += 1
+    return written
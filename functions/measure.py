@@ -1,100 +1,238 @@
 import os
+import re
+import csv
+import sqlite3
 import cv2
-import glob
+import json
 import numpy as np
 import pandas as pd
 import random
-from concurrent.futures import ThreadPoolExecutor
 import logging
-import matplotlib.pyplot as plt
 from logging_utils import log
+from functions.resource_scheduler import run_tasks
+from functions.mask_store import read_mask, iter_masks
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
-def get_lengths(contour):
+# Engines for get_lengths: "compat" (the original all-pairs search with its
+# angle tolerance, vectorized; default, so len2 means the same in existing and
+# new measurements) or "calipers" (O(h) rotating calipers, exact perpendicular width)
+LENGTH_ENGINES = ("compat", "calipers")
+
+# |cos| between a candidate len2 segment and len1 below which "compat" treats them as perpendicular
+PERPENDICULAR_TOLERANCE = 0.1
+
+
+def _compat_lengths(hull_points):
     """
-    Find len1 (maximum length) and len2 (longest perpendicular length) across the contour.
-    Returns both lengths and their endpoints.
+    All-pairs search over hull points, matching the original nested loops:
+    len1 is the farthest pair; len2 is the farthest pair whose direction is
+    within PERPENDICULAR_TOLERANCE of perpendicular to len1. Ties resolve to
+    the first pair in (i, j) order, as the loops did.
     """
-    hull = cv2.convexHull(contour)
-    hull_points = hull.reshape(-1, 2)
-    
-    # Find len1 (maximum length)
-    max_distance = 0
-    len1_points = None
-    
-    for i in range(len(hull_points)):
-        for j in range(i + 1, len(hull_points)):
-            dist = np.sqrt(np.sum((hull_points[i] - hull_points[j]) ** 2))
-            if dist > max_distance:
-                max_distance = dist
-                len1_points = (hull_points[i], hull_points[j])
-    
-    # Calculate len2 (perpendicular to len1)
-    if len1_points is None:
+    n = len(hull_points)
+    if n < 2:
         return None, None, None, None
-    
-    # Get vector of len1
-    len1_vector = len1_points[1] - len1_points[0]
+
+    points = hull_points.astype(np.float64)
+    i_idx, j_idx = np.triu_indices(n, k=1)
+    vectors = points[j_idx] - points[i_idx]
+    dists = np.sqrt(np.sum(vectors ** 2, axis=1))
+
+    best = int(np.argmax(dists))
+    max_distance = dists[best]
+    if max_distance == 0:
+        return None, None, None, None
+    len1_points = (hull_points[i_idx[best]], hull_points[j_idx[best]])
+
+    len1_vector = points[j_idx[best]] - points[i_idx[best]]
     len1_unit = len1_vector / np.linalg.norm(len1_vector)
-    
-    # Find perpendicular direction
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        angles = np.abs((vectors / dists[:, None]) @ len1_unit)
+    candidates = np.flatnonzero((angles < PERPENDICULAR_TOLERANCE) & (dists > 0))
+    if len(candidates) == 0:
+        return max_distance, len1_points, 0, None
+
+    best2 = candidates[int(np.argmax(dists[candidates]))]
+    len2_points = (hull_points[i_idx[best2]], hull_points[j_idx[best2]])
+    return max_distance, len1_points, dists[best2], len2_points
+
+
+def _caliper_lengths(hull_points):
+    """
+    Rotating calipers over the convex hull. len1 is the hull diameter, found
+    among antipodal vertex pairs; len2 is the width of the hull measured
+    perpendicular to len1, drawn as a segment crossing len1 at its midpoint.
+    """
+    points = hull_points.astype(np.float64)
+    if len(points) < 2:
+        return None, None, None, None
+
+    # Drop repeated vertices so every edge has a direction
+    edges = np.roll(points, -1, axis=0) - points
+    keep = np.any(edges != 0, axis=1)
+    points, hull_points = points[keep], hull_points[keep]
+    n = len(points)
+    if n < 2:
+        return None, None, None, None
+
+    if n == 2:
+        pairs_i, pairs_j = np.array([0]), np.array([1])
+    else:
+        # Orient counter-clockwise so edge angles increase around the hull
+        x, y = points[:, 0], points[:, 1]
+        if np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) < 0:
+            points, hull_points = points[::-1], hull_points[::-1]
+
+        edges = np.roll(points, -1, axis=0) - points
+        angles = np.unwrap(np.arctan2(edges[:, 1], edges[:, 0]))
+        angles = angles - angles[0]
+
+        # Vertex k supports every direction between edge k-1 and edge k, so the
+        # vertex antipodal to edge i is where angle(i) + pi falls in that sequence
+        extended = np.concatenate([angles, angles + 2 * np.pi])
+        k = np.searchsorted(extended, angles + np.pi) % n
+        edge_start = np.arange(n)
+        edge_end = (edge_start + 1) % n
+
+        # Neighbouring vertices cover parallel edges and rounding at the boundaries
+        pairs_i = np.concatenate([edge_start, edge_end] * 3)
+        pairs_j = np.concatenate([(k - 1) % n, (k - 1) % n, k, k, (k + 1) % n, (k + 1) % n])
+
+    dists = np.sqrt(np.sum((points[pairs_j] - points[pairs_i]) ** 2, axis=1))
+    best = int(np.argmax(dists))
+    max_distance = dists[best]
+    if max_distance == 0:
+        return None, None, None, None
+    a, b = pairs_i[best], pairs_j[best]
+    len1_points = (hull_points[a], hull_points[b])
+
+    len1_unit = (points[b] - points[a]) / max_distance
     perp_vector = np.array([-len1_unit[1], len1_unit[0]])
-    
-    # Find the maximum length perpendicular to len1
-    max_perp_distance = 0
-    len2_points = None
-    
-    for i in range(len(hull_points)):
-        for j in range(i + 1, len(hull_points)):
-            # Vector between current points
-            vector = hull_points[j] - hull_points[i]
-            
-            # Project vector onto perpendicular direction
-            projection = np.dot(vector, perp_vector)
-            
-            # Calculate actual distance
-            dist = np.sqrt(np.sum((hull_points[i] - hull_points[j]) ** 2))
-            
-            # Check if points form a line roughly perpendicular to len1
-            angle = np.abs(np.dot(vector / np.linalg.norm(vector), len1_unit))
-            if angle < 0.1 and dist > max_perp_distance:  # angle close to 90 degrees
-                max_perp_distance = dist
-                len2_points = (hull_points[i], hull_points[j])
-    
-    return max_distance, len1_points, max_perp_distance, len2_points
+    midpoint = (points[a] + points[b]) / 2
+    offsets = (points - midpoint) @ perp_vector
+    width = offsets.max() - offsets.min()
+    if width == 0:
+        return max_distance, len1_points, 0, None
+
+    len2_points = (np.round(midpoint + offsets.min() * perp_vector, 2),
+                   np.round(midpoint + offsets.max() * perp_vector, 2))
+    return max_distance, len1_points, width, len2_points
+
+
+def get_lengths(contour, engine="compat"):
+    """
+    Find len1 (maximum length) and len2 (length perpendicular to len1) across the contour.
+    Returns both lengths and their endpoints.
 
-def process_mask(mask_path):
+    engine="calipers" measures len2 as the hull width perpendicular to len1;
+    engine="compat" reproduces the original pairwise search, where len2 is the
+    longest hull chord within the angle tolerance of perpendicular.
+    """
+    hull = cv2.convexHull(contour)
+    hull_points = hull.reshape(-1, 2)
+
+    if engine == "compat":
+        return _compat_lengths(hull_points)
+    return _caliper_lengths(hull_points)
+
+def measure_mask_array(mask, engine="compat", name="mask"):
+    """
+    Calculate the measurements (len1, len2, and area) of a decoded grayscale mask.
+    Returns lengths and their endpoints.
+    """
+    # Ensure mask is binary
+    _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        logger.warning(f"No contours found in {name}")
+        return None, None, None, None, None
+
+    contour = max(contours, key=cv2.contourArea)
+    area_px = cv2.contourArea(contour)
+
+    # Get both length measurements and endpoints
+    len1_px, len1_points, len2_px, len2_points = get_lengths(contour, engine)
+
+    return len1_px, len1_points, len2_px, len2_points, area_px
+
+def process_mask(mask_path, engine="compat"):
     """
     Process a mask and calculate the measurements (len1, len2, and area).
     Returns lengths and their endpoints.
     """
     try:
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        mask = read_mask(mask_path)
         if mask is None:
             logger.error(f"Could not read mask: {mask_path}")
             return None, None, None, None, None
-            
-        # Ensure mask is binary
-        _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
-        
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        if not contours:
-            logger.warning(f"No contours found in {mask_path}")
+
+        return measure_mask_array(mask, engine, mask_path)
+    except Exception as e:
+        logger.error(f"Error processing {os.path.basename(mask_path)}: {e}")
+        return None, None, None, None, None
+
+def largest_polygon(predictions):
+    """
+    Return the largest predicted polygon as an int32 contour (shape (n, 1, 2))
+    and its shoelace area, or (None, 0) if there is none. Points are truncated
+    to integers the same way create_masks does before filling them.
+    """
+    best, best_area = None, 0
+    for prediction in predictions:
+        points = prediction.get('points', [])
+        if len(points) < 3:
+            continue
+        xy = np.array([(int(p['x']), int(p['y'])) for p in points], dtype=np.int32)
+        x, y = xy[:, 0].astype(np.float64), xy[:, 1].astype(np.float64)
+        area = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+        if area > best_area:
+            best, best_area = xy.reshape(-1, 1, 2), area
+    return best, best_area
+
+def process_polygons(json_path, engine="compat"):
+    """
+    Measure a specimen straight from its outline_specimens JSON, without a mask PNG.
+    Uses the largest polygon (like fix_masks keeping the largest component),
+    its shoelace area, and get_lengths on its hull.
+    Returns the same tuple as process_mask.
+    """
+    try:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+
+        contour, area_px = largest_polygon(data.get('predictions', []))
+        if contour is None:
+            logger.warning(f"No polygons found in {json_path}")
             return None, None, None, None, None
-            
-        contour = max(contours, key=cv2.contourArea)
-        area_px = cv2.contourArea(contour)
-        
-        # Get both length measurements and endpoints
-        len1_px, len1_points, len2_px, len2_points = get_lengths(contour)
-        
+
+        len1_px, len1_points, len2_px, len2_points = get_lengths(contour, engine)
         return len1_px, len1_points, len2_px, len2_points, area_px
     except Exception as e:
-        logger.error(f"Error processing {os.path.basename(mask_path)}: {e}")
+        logger.error(f"Error processing {os.path.basename(json_path)}: {e}")
         return None, None, None, None, None
 
+def compact_result(result):
+    """
+    Reduce a process_mask-style result to plain floats, with each pair of
+    endpoints flattened to (x1, y1, x2, y2), so a worker process sends back a
+    few bytes instead of pickled NumPy arrays.
+    """
+    len1_px, len1_points, len2_px, len2_points, area_px = result
+    if len1_px is None:
+        return result
+    return (float(len1_px), flatten_points(len1_points), float(len2_px),
+            flatten_points(len2_points), float(area_px))
+
+def _measure_chunk(args):
+    """Pool entry point: measure a chunk of masks (or outline JSONs) in one task."""
+    paths, engine, from_polygons = args
+    measure_file = process_polygons if from_polygons else process_mask
+    return [compact_result(measure_file(path, engine)) for path in paths]
+
 def should_create_visualizations(visualization_mode, existing_vis_count, total_masks):
     """
     Determine if visualizations should be created based on mode and existing count.
@@ -138,7 +276,245 @@ def select_random_masks(all_masks, max_count):
     
     return random.sample(all_masks, max_count)
 
-def generate_csv_with_measurements(mask_dir, output_dir, csv_filename='measurements.csv', visualization_mode="on"):
+ENDPOINT_COLUMNS = ['len1_x1', 'len1_y1', 'len1_x2', 'len1_y2',
+                    'len2_x1', 'len2_y1', 'len2_x2', 'len2_y2']
+
+MEASUREMENT_COLUMNS = ['full_id', 'drawer_id', 'tray_id',
+                       'len1_px', 'len2_px', 'area_px',
+                       *ENDPOINT_COLUMNS,
+                       'mask_OK']
+
+def specimen_ids(full_id):
+    """Return (drawer_id, tray_id) for a specimen full_id."""
+    # Try to extract drawer_id and tray_id from standard naming
+    # If it fails, use the filename as-is
+    if '_tray_' in full_id and '_spec' in full_id:
+        # Standard naming: drawer_id_tray_XX_spec_YY
+        return full_id.split('_tray_')[0], full_id.split('_spec')[0]
+    # Non-standard naming: use filename as full_id
+    return "custom_specimens", "custom_specimens"
+
+def flatten_points(points):
+    """(p1, p2) endpoints -> (x1, y1, x2, y2) as floats."""
+    (x1, y1), (x2, y2) = points
+    return float(x1), float(y1), float(x2), float(y2)
+
+def measurement_row(full_id, result):
+    """Build one measurements row from a process_mask-style or compact result tuple."""
+    drawer_id, tray_id = specimen_ids(full_id)
+    row = {col: None for col in MEASUREMENT_COLUMNS}
+    row.update(full_id=full_id, drawer_id=drawer_id, tray_id=tray_id, mask_OK='Y')
+
+    len1_px, len1_points, len2_px, len2_points, area_px = result if result else (None,) * 5
+    if len1_px and len2_px and area_px:
+        row.update(len1_px=float(len1_px), len2_px=float(len2_px), area_px=float(area_px))
+        # Endpoints as numeric columns: x1, y1, x2, y2 per length
+        for prefix, points in (('len1', len1_points), ('len2', len2_points)):
+            if len(points) == 2:
+                points = flatten_points(points)
+            row.update(zip((f'{prefix}_x1', f'{prefix}_y1', f'{prefix}_x2', f'{prefix}_y2'), points))
+    else:
+        # Mark as problematic mask if measurement failed
+        row['mask_OK'] = 'N'
+    return row
+
+# Older CSVs stored endpoints as str((array([x, y]), array([x, y])))
+_POINT_NUMBER = re.compile(r'-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?')
+
+def parse_legacy_points(text):
+    """Read (x1, y1, x2, y2) from a legacy len*_points string without eval, or None."""
+    if not isinstance(text, str):
+        return None
+    numbers = _POINT_NUMBER.findall(re.sub(r'dtype=\w+', '', text))
+    return tuple(float(n) for n in numbers) if len(numbers) == 4 else None
+
+class MeasurementWriter:
+    """
+    Measurements store for one drawer.
+
+    Rows live in measurements.sqlite next to the CSV, one typed column per
+    value (endpoints as len1_x1 ... len2_y2), keyed by full_id. Rows are
+    inserted as results arrive, so an interrupted run keeps what it
+    measured, and the processed full_ids for skip logic come from the
+    primary key. measurements.csv is an export written by finish(): new
+    rows are appended when the CSV is still the one last exported,
+    otherwise it is written in full.
+
+    If measurements.csv was changed since the last export (edited by hand,
+    or written by an older version with len1_points/len2_points strings),
+    the database is reloaded from it first.
+    """
+
+    COMMIT_EVERY = 200
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.db_path = os.path.splitext(csv_path)[0] + '.sqlite'
+        self._db = sqlite3.connect(self.db_path)
+        # Rollback journal like the manifest and mask containers: WAL needs shared
+        # memory, which network filesystems holding the drawers tree do not provide.
+        # Setting it also converts databases written in WAL mode by earlier versions
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        columns = ', '.join(
+            'full_id TEXT PRIMARY KEY' if col == 'full_id' else
+            f'{col} TEXT' if col in ('drawer_id', 'tray_id', 'mask_OK') else f'{col} REAL'
+            for col in MEASUREMENT_COLUMNS)
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS measurements ({columns})")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._uncommitted = 0
+
+        self._sync_from_csv()
+        self.processed_ids = {r[0] for r in self._db.execute("SELECT full_id FROM measurements")}
+        self.total_rows = len(self.processed_ids)
+        if self.total_rows:
+            logger.info(f"Loaded {self.total_rows} already processed images from CSV.")
+        else:
+            logger.info(f"No existing CSV found. Starting fresh.")
+
+    def _meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def _csv_signature(self):
+        if not os.path.exists(self.csv_path):
+            return None
+        stat = os.stat(self.csv_path)
+        return f"{stat.st_size} {stat.st_mtime_ns}"
+
+    def _sync_from_csv(self):
+        signature = self._csv_signature()
+        if signature == self._meta('csv_signature'):
+            return
+
+        # The CSV was removed, edited or written elsewhere: it is the reference
+        self._db.execute("DELETE FROM measurements")
+        if signature is not None:
+            df = pd.read_csv(self.csv_path, dtype={'full_id': str})
+            for prefix in ('len1', 'len2'):
+                legacy = f'{prefix}_points'
+                if legacy in df.columns:
+                    points = df[legacy].map(parse_legacy_points)
+                    for i, axis in enumerate(('x1', 'y1', 'x2', 'y2')):
+                        df[f'{prefix}_{axis}'] = points.map(lambda p, i=i: p[i] if p else None)
+            for col in MEASUREMENT_COLUMNS:
+                if col not in df.columns:
+                    df[col] = None
+            df = df.dropna(how='all', subset=MEASUREMENT_COLUMNS).dropna(subset=['full_id'])
+            df = df[MEASUREMENT_COLUMNS].astype(object).where(df[MEASUREMENT_COLUMNS].notna(), None)
+            self._db.executemany(self._insert_sql(), df.itertuples(index=False, name=None))
+            logger.info(f"Loaded {len(df)} rows from {os.path.basename(self.csv_path)} into the measurements database")
+        # Force a full export so the CSV is written in the current layout
+        self._set_meta('csv_signature', '')
+        self._set_meta('exported_rowid', -1)
+        self._db.commit()
+
+    def _insert_sql(self):
+        placeholders = ', '.join('?' * len(MEASUREMENT_COLUMNS))
+        return f"INSERT OR REPLACE INTO measurements ({', '.join(MEASUREMENT_COLUMNS)}) VALUES ({placeholders})"
+
+    def append(self, row):
+        """Record one measurement row (a dict keyed by MEASUREMENT_COLUMNS)."""
+        self._db.execute(self._insert_sql(), [row[col] for col in MEASUREMENT_COLUMNS])
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self._db.commit()
+            self._uncommitted = 0
+        if row['full_id'] not in self.processed_ids:
+            self.processed_ids.add(row['full_id'])
+            self.total_rows += 1
+
+    def discard(self, full_ids):
+        """Drop the rows of these full_ids so they are measured again; the next export is written in full."""
+        full_ids = [i for i in full_ids if i in self.processed_ids]
+        self._db.executemany("DELETE FROM measurements WHERE full_id = ?", [(i,) for i in full_ids])
+        self._set_meta('exported_rowid', -1)
+        self.processed_ids.difference_update(full_ids)
+        self.total_rows = len(self.processed_ids)
+        return len(full_ids)
+
+    def finish(self):
+        """Commit and export measurements.csv. Returns the total row count."""
+        self._db.commit()
+        exported = int(self._meta('exported_rowid', -1))
+        incremental = exported >= 0 and self._csv_signature() == self._meta('csv_signature')
+
+        query = f"SELECT rowid, {', '.join(MEASUREMENT_COLUMNS)} FROM measurements"
+        if incremental:
+            query += f" WHERE rowid > {exported}"
+        query += " ORDER BY rowid"
+
+        target = self.csv_path if incremental else self.csv_path + '.tmp'
+        with open(target, 'a' if incremental else 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            if not incremental:
+                writer.writerow(MEASUREMENT_COLUMNS)
+            for rowid, *values in self._db.execute(query):
+                writer.writerow(values)
+                exported = max(exported, rowid)
+        if not incremental:
+            os.replace(target, self.csv_path)
+
+        self._set_meta('exported_rowid', exported)
+        self._set_meta('csv_signature', self._csv_signature())
+        self._db.commit()
+        self._db.close()
+        logger.info(f"Updated measurements saved to: {self.csv_path}")
+        return self.total_rows
+
+def measured_ids(csv_path):
+    """full_ids that have a row in the measurements store of csv_path."""
+    db_path = os.path.splitext(csv_path)[0] + '.sqlite'
+    if not os.path.exists(db_path):
+        return []
+    db = sqlite3.connect(db_path)
+    try:
+        return [r[0] for r in db.execute("SELECT full_id FROM measurements")]
+    except sqlite3.Error:
+        return []
+    finally:
+        db.close()
+
+def discard_measurements(csv_path, full_ids):
+    """Remove the rows of these full_ids from the measurements store and CSV. Returns the number removed."""
+    if not os.path.exists(csv_path):
+        return 0
+    writer = MeasurementWriter(csv_path)
+    removed = writer.discard(full_ids)
+    writer.finish()
+    return removed
+
+def create_visualizations(csv_path, mask_dir, output_dir, visualization_mode, total_rows,
+                          sequential=False, max_workers=None):
+    """Create measurement visualizations according to the visualization mode."""
+    vis_output_dir = os.path.join(output_dir, "visualizations")
+
+    # Count existing visualizations
+    existing_vis_count = 0
+    if os.path.exists(vis_output_dir):
+        existing_vis_count = len([f for f in os.listdir(vis_output_dir)
+                                if f.endswith('_mapped.png')])
+
+    # Determine if we should create visualizations
+    should_create, max_to_create = should_create_visualizations(
+        visualization_mode, existing_vis_count, total_rows
+    )
+
+    if should_create:
+        log(f"Generating visualizations in {vis_output_dir} (mode: {visualization_mode})")
+        if max_to_create:
+            log(f"Will create up to {max_to_create} visualizations")
+        visualize_measurements(csv_path, mask_dir, vis_output_dir,
+                             visualization_mode, max_to_create,
+                             sequential=sequential, max_workers=max_workers)
+    else:
+        log(f"Skipping visualizations (mode: {visualization_mode})")
+
+def generate_csv_with_measurements(mask_dir, output_dir, csv_filename='measurements.csv', visualization_mode="on",
+                                   length_engine="compat", polygon_dir=None,
+                                   sequential=False, max_workers=None, chunk_size=64):
     """
     Generate or update a CSV file of measurements for all valid masks.
     Skip already processed images and append data for new ones.
@@ -149,146 +525,141 @@ def generate_csv_with_measurements(mask_dir, output_dir, csv_filename='measureme
         output_dir: Directory to save the CSV output
         csv_filename: Name of the output CSV file
         visualization_mode: "on", "off", or "rand_sample" for visualization control
+        length_engine: "compat" or "calipers" (see get_lengths)
+        polygon_dir: If given, measure from the outline_specimens JSONs in this
+                     directory instead of the mask PNGs (mask_dir is then only
+                     used for visualizations)
+        sequential: Measure in this process, one mask at a time
+        max_workers: Maximum number of worker processes
+        chunk_size: Masks measured per task; larger chunks mean less inter-process traffic
     """
     try:
+        if length_engine not in LENGTH_ENGINES:
+            log(f"Unknown measurement engine: {length_engine}, defaulting to 'compat'")
+            length_engine = "compat"
+
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
         
         # Ensure the output file path is valid
         csv_path = os.path.join(output_dir, csv_filename)
         
-        # Load existing measurements if the CSV exists
-        if os.path.exists(csv_path):
-            existing_df = pd.read_csv(csv_path)
-            processed_ids = set(existing_df['full_id'])
-            logger.info(f"Loaded {len(processed_ids)} already processed images from CSV.")
-        else:
-            existing_df = pd.DataFrame()
-            processed_ids = set()
-            logger.info(f"No existing CSV found. Starting fresh.")
-            
-        file_info = []
-        for root, _, files in os.walk(mask_dir):
-            for f in files:
-                if f.endswith('.png'):
-                    mask_path = os.path.join(root, f)
-                    full_id = f.replace('.png', '')
-                    if full_id in processed_ids:
-                        logger.info(f"Skipping already processed image: {full_id}")
-                        continue
-                        
-                    # Try to extract drawer_id and tray_id from standard naming
-                    # If it fails, use the filename as-is
-                    if '_tray_' in full_id and '_spec' in full_id:
-                        # Standard naming: drawer_id_tray_XX_spec_YY
-                        drawer_id = full_id.split('_tray_')[0]
-                        tray_id = full_id.split('_spec')[0]
-                    else:
-                        # Non-standard naming: use filename as full_id
-                        # For drawer_id and tray_id, try to extract meaningful parts or use "unknown"
-                        drawer_id = "custom_specimens"
-                        tray_id = "custom_specimens"
-                    
-                    file_info.append({
-                        'spec_filename': f,
-                        'full_id': full_id,
-                        'drawer_id': drawer_id,
-                        'tray_id': tray_id,
-                        'mask_OK': 'Y',
-                        'mask_path': mask_path
-                    })
-                    
-        df = pd.DataFrame(file_info)
-        
-        # Ensure required columns are present, even if DataFrame is empty
-        required_columns = ['full_id', 'drawer_id', 'tray_id', 
-                          'len1_px', 'len2_px', 'area_px', 
-                          'len1_points', 'len2_points', 
-                          'mask_OK']
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = pd.NA
-                
-        # Process masks with ThreadPoolExecutor
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for _, row in df.iterrows():
-                mask_path = row['mask_path']
-                futures.append((row['full_id'], executor.submit(process_mask, mask_path)))
-                
-            for full_id, future in futures:
-                try:
-                    len1_px, len1_points, len2_px, len2_points, area_px = future.result()
-                    if len1_px and len2_px and area_px:
-                        idx = df[df['full_id'] == full_id].index[0]
-                        df.at[idx, 'len1_px'] = len1_px
-                        df.at[idx, 'len2_px'] = len2_px
-                        df.at[idx, 'area_px'] = area_px
-                        
-                        # Save the endpoints as strings for later use
-                        df.at[idx, 'len1_points'] = str(len1_points)
-                        df.at[idx, 'len2_points'] = str(len2_points)
-                    else:
-                        # Mark as problematic mask if measurement failed
-                        idx = df[df['full_id'] == full_id].index[0]
-                        df.at[idx, 'mask_OK'] = 'N'
-                        
-                except Exception as e:
-                    logger.error(f"Error processing {full_id}: {e}")
-                    # Mark as problematic if exception occurred
-                    idx = df[df['full_id'] == full_id].index[0]
-                    df.at[idx, 'mask_OK'] = 'N'
-                    
-        # Concatenate new data with existing data
-        cols = ['full_id', 'drawer_id', 'tray_id',
-                'len1_px', 'len2_px', 'area_px', 
-                'len1_points', 'len2_points', 
-                'mask_OK']
-                
-        new_df = df[cols]
-        
-        if not existing_df.empty:
-            # Ensure existing data has the same columns
-            existing_cols = set(existing_df.columns)
-            for col in cols:
-                if col not in existing_cols:
-                    existing_df[col] = pd.NA
-            
-            existing_df = existing_df.dropna(how='all', subset=cols)
-            updated_df = pd.concat([existing_df[cols], new_df], ignore_index=True)
+        # Load the processed full_ids for skip logic
+        writer = MeasurementWriter(csv_path)
+        processed_ids = writer.processed_ids
+
+        if polygon_dir:
+            sources = (os.path.join(root, f) for root, _, files in os.walk(polygon_dir)
+                       for f in files if f.endswith('.json'))
         else:
-            updated_df = new_df
-            
-        updated_df.to_csv(csv_path, index=False)
-        logger.info(f"Updated measurements saved to: {csv_path}")
-        
+            sources = iter_masks(mask_dir)
+
+        pending = []
+        for path in sources:
+            full_id = os.path.splitext(os.path.basename(path))[0]
+            if full_id in processed_ids:
+                logger.info(f"Skipping already processed image: {full_id}")
+                continue
+            pending.append((full_id, path))
+
+        # Measure in chunks on a process pool (the contour and hull work holds
+        # the GIL), writing each chunk's rows as soon as it is done
+        chunk_size = max(1, chunk_size or 1)
+        chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        tasks = [([path for _, path in chunk], length_engine, bool(polygon_dir)) for chunk in chunks]
+
+        def record(index, results):
+            if not results:
+                logger.error(f"Error processing chunk {index + 1} of {len(chunks)}")
+                results = [None] * len(chunks[index])
+            for (full_id, _), result in zip(chunks[index], results):
+                writer.append(measurement_row(full_id, result))
+
+        try:
+            if chunks:
+                log(f"Measuring {len(pending)} specimens in {len(chunks)} chunks")
+            run_tasks(_measure_chunk, tasks, "measure_specimens", [None] * len(tasks),
+                      sequential=sequential, max_workers=max_workers, on_result=record)
+        finally:
+            total_rows = writer.finish()
+
         # Handle visualizations based on mode
-        vis_output_dir = os.path.join(output_dir, "visualizations")
-        
-        # Count existing visualizations
-        existing_vis_count = 0
-        if os.path.exists(vis_output_dir):
-            existing_vis_count = len([f for f in os.listdir(vis_output_dir) 
-                                    if f.endswith('_mapped.png')])
-        
-        # Determine if we should create visualizations
-        should_create, max_to_create = should_create_visualizations(
-            visualization_mode, existing_vis_count, len(updated_df)
-        )
-        
-        if should_create:
-            log(f"Generating visualizations in {vis_output_dir} (mode: {visualization_mode})")
-            if max_to_create:
-                log(f"Will create up to {max_to_create} visualizations")
-            visualize_measurements(csv_path, mask_dir, vis_output_dir, 
-                                 visualization_mode, max_to_create)
-        else:
-            log(f"Skipping visualizations (mode: {visualization_mode})")
-        
+        create_visualizations(csv_path, mask_dir, output_dir, visualization_mode, total_rows,
+                              sequential=sequential, max_workers=max_workers)
+
     except Exception as e:
         logger.error(f"Error generating measurements: {e}")
 
-def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="on", max_visualizations=None):
+# Longest side of a measurement map; large masks are drawn at reduced resolution,
+# small ones enlarged so the caption stays legible
+VISUALIZATION_MAX_SIZE = 1024
+VISUALIZATION_MIN_SIZE = 512
+
+def render_measurement_map(mask, full_id, len1_px, len2_px, endpoints, max_size=VISUALIZATION_MAX_SIZE):
+    """
+    Draw a mask with its len1 (red) and len2 (blue) lines and a caption strip.
+
+    Args:
+        mask: Grayscale mask array
+        endpoints: {'len1': (x1, y1, x2, y2) or None, 'len2': ...} in mask pixels
+
+    Returns:
+        BGR image, scaled so its longest side is between VISUALIZATION_MIN_SIZE and max_size
+    """
+    longest = max(mask.shape[:2])
+    scale = min(1.0, max_size / longest)
+    if longest * scale < VISUALIZATION_MIN_SIZE:
+        scale = min(VISUALIZATION_MIN_SIZE, max_size) / longest
+    if scale != 1.0:
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_NEAREST
+        mask = cv2.resize(mask, None, fx=scale, fy=scale, interpolation=interpolation)
+    image = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+
+    height, width = mask.shape[:2]
+    thickness = max(2, round(max(height, width) / 300))
+    for key, color in (('len1', (0, 0, 255)), ('len2', (255, 0, 0))):
+        points = endpoints.get(key)
+        if points is None:
+            continue
+        x1, y1, x2, y2 = (int(round(v * scale)) for v in points)
+        cv2.line(image, (x1, y1), (x2, y2), color, thickness, cv2.LINE_AA)
+
+    # Caption strip above the mask, sized to the image width
+    caption = f"{full_id}: len1_px={len1_px:.1f}, len2_px={len2_px:.1f}"
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    (text_w, text_h), _ = cv2.getTextSize(caption, font, 1.0, 2)
+    font_scale = min(1.0, (width - 20) / text_w) if text_w else 1.0
+    line_h = int(text_h * font_scale * 1.8) + 6
+    strip = np.full((line_h * 2, width, 3), 255, dtype=np.uint8)
+    cv2.putText(strip, caption, (10, line_h - 6), font, font_scale, (0, 0, 0), 1, cv2.LINE_AA)
+    x = 10
+    for label, color in (('Length 1', (0, 0, 255)), ('Length 2', (255, 0, 0))):
+        (label_w, _), _ = cv2.getTextSize(label, font, font_scale, 1)
+        cv2.line(strip, (x, 2 * line_h - line_h // 2), (x + 20, 2 * line_h - line_h // 2), color, 2)
+        cv2.putText(strip, label, (x + 26, 2 * line_h - 6), font, font_scale, (0, 0, 0), 1, cv2.LINE_AA)
+        x += label_w + 46
+    return np.vstack([strip, image])
+
+def _render_chunk(args):
+    """Pool entry point: render a chunk of measurement maps. Returns (created, skipped)."""
+    jobs, max_size = args
+    created = skipped = 0
+    for mask_path, output_path, full_id, len1_px, len2_px, endpoints in jobs:
+        try:
+            mask = read_mask(mask_path)
+            if mask is None:
+                logger.warning(f"Could not read mask for {full_id}, skipping visualization.")
+                skipped += 1
+                continue
+            cv2.imwrite(output_path, render_measurement_map(mask, full_id, len1_px, len2_px, endpoints, max_size))
+            created += 1
+        except Exception as e:
+            logger.warning(f"Error drawing measurement map for {full_id}: {e}")
+            skipped += 1
+    return created, skipped
+
+def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="on", max_visualizations=None,
+                           sequential=False, max_workers=None, chunk_size=16, max_size=VISUALIZATION_MAX_SIZE):
     """
     Visualize the measurements for rows in the CSV.
     
@@ -298,6 +669,10 @@ def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="o
         output_dir: Directory to save visualization images
         visualization_mode: "on", "off", or "rand_sample"
         max_visualizations: Maximum number of visualizations to create (for rand_sample mode)
+        sequential: Draw in this process, one map at a time
+        max_workers: Maximum number of worker processes
+        chunk_size: Maps drawn per task
+        max_size: Longest side of each map in pixels
     """
     try:
         # Load the CSV
@@ -307,7 +682,7 @@ def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="o
         os.makedirs(output_dir, exist_ok=True)
         
         # Get a list of all mask files with their full paths
-        mask_files = glob.glob(os.path.join(mask_dir, "**", "*.png"), recursive=True)
+        mask_files = iter_masks(mask_dir)
         
         # Create a mapping of full_id to mask path
         mask_map = {}
@@ -317,13 +692,8 @@ def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="o
             mask_map[full_id] = mask_path
         
         # Filter to only rows that have valid measurements and masks
-        valid_rows = []
-        for _, row in df.iterrows():
-            full_id = row['full_id']
-            if (full_id in mask_map and 
-                not pd.isna(row.get('len1_px')) and 
-                not pd.isna(row.get('len2_px'))):
-                valid_rows.append(row)
+        df = df[df['full_id'].isin(mask_map) & df['len1_px'].notna() & df['len2_px'].notna()]
+        valid_rows = list(df.itertuples(index=False))
         
         # Apply visualization mode selection
         if visualization_mode == "rand_sample" and max_visualizations:
@@ -331,13 +701,10 @@ def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="o
                 valid_rows = random.sample(valid_rows, max_visualizations)
                 log(f"Randomly selected {len(valid_rows)} specimens for visualization")
         
-        total_rows = len(valid_rows)
-        processed = 0
+        jobs = []
         skipped = 0
-        
-        # Process each selected row
         for row in valid_rows:
-            full_id = row['full_id']
+            full_id = row.full_id
             mask_path = mask_map[full_id]
             
             # Create output path that mirrors the input directory structure
@@ -351,50 +718,27 @@ def visualize_measurements(csv_path, mask_dir, output_dir, visualization_mode="o
             if os.path.exists(mapped_output_path):
                 skipped += 1
                 continue
-            
-            # Get measurements
-            len1_px = row.get('len1_px')
-            len2_px = row.get('len2_px')
-            
-            # Read the mask
-            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-            
-            if mask is None:
-                logger.warning(f"Could not read mask for {full_id}, skipping visualization.")
-                skipped += 1
-                continue
-                
-            # Create a figure
-            plt.figure(figsize=(10, 10))
-            plt.imshow(mask, cmap='gray')
-            plt.title(f"{full_id}: len1_px={len1_px:.1f}, len2_px={len2_px:.1f}")
-            plt.axis('off')
-            
-            # Add length annotations
-            try:
-                if not pd.isna(row['len1_points']):
-                    len1_points = eval(row['len1_points'], {"array": np.array, "int32": np.int32})
-                    plt.plot([len1_points[0][0], len1_points[1][0]],
-                             [len1_points[0][1], len1_points[1][1]], 'r-', linewidth=2, label='Length 1')
-                    
-                if not pd.isna(row['len2_points']):
-                    len2_points = eval(row['len2_points'], {"array": np.array, "int32": np.int32})
-                    plt.plot([len2_points[0][0], len2_points[1][0]],
-                             [len2_points[0][1], len2_points[1][1]], 'b-', linewidth=2, label='Length 2')
-                    
-                plt.legend()
-            except Exception as e:
-                logger.warning(f"Error plotting lengths for {full_id}: {e}")
-                
-            plt.savefig(mapped_output_path, bbox_inches='tight', dpi=300)
-            plt.close()
-            
-            processed += 1
-            # Log progress every 10 images
-            if processed % 10 == 0:
-                logger.info(f"Created {processed}/{total_rows} visualizations")
+
+            endpoints = {}
+            for prefix in ('len1', 'len2'):
+                points = tuple(getattr(row, f'{prefix}_{axis}') for axis in ('x1', 'y1', 'x2', 'y2'))
+                endpoints[prefix] = None if any(pd.isna(v) for v in points) else points
+            jobs.append((mask_path, mapped_output_path, full_id, row.len1_px, row.len2_px, endpoints))
+
+        tasks = [(jobs[i:i + chunk_size], max_size) for i in range(0, len(jobs), chunk_size)]
+        processed = 0
+        
+        def record(index, result):
+            nonlocal processed, skipped
+            created, failed = result if result else (0, len(tasks[index][0]))
+            processed += created
+            skipped += failed
+            logger.info(f"Created {processed}/{len(jobs)} visualizations")
+
+        run_tasks(_render_chunk, tasks, "visualize_measurements", [None] * len(tasks),
+                  sequential=sequential, max_workers=max_workers, on_result=record)
             
         log(f"Visualization complete. Created {processed} images, skipped {skipped}.")
         
     except Exception as e:
-        logger.error(f"Error during visualization: {e}")
\ No newline at end of file
+        logger.error(f"Error during visualization: {e}")
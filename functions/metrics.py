@@ -0,0 +1,306 @@
+"""
+metrics.py
+
+Prometheus metrics for long-running jobs (resources.metrics). The metrics
+can be served at http://<host>:<port>/metrics, written as a textfile for
+node_exporter's textfile collector, or both. Nothing is recorded unless
+one of them is switched on.
+
+Published series (all prefixed drawerdissect_):
+
+    items_total{step,status}          trays, specimens or images processed
+    item_seconds{step}                time per item (histogram)
+    phase_seconds{step,phase}         time per item in decode/infer/encode/write/network
+    step_runs_total{step,status}      step runs per drawer
+    step_seconds{step}                time per step run (histogram)
+    bytes_read_total{step}            bytes read and written by step runs
+    bytes_written_total{step}
+    inference_seconds{backend}        time per model prediction (histogram)
+    llm_request_seconds{provider}     time per LLM request (histogram)
+    llm_requests_total{provider,status}
+    llm_tokens_total{provider,direction}
+    retries_total{operation}          retried model requests, LLM calls and queue units
+    queue_depth{queue,state}          drawers waiting/running, steps waiting for a
+                                      resource slot, streaming stage queues, files
+                                      settling in --watch and work queue units
+
+Metrics live in the main process. Items and step totals come from the
+instrumentation events (functions/instrumentation.py), which already bring
+the records of tasks run on worker processes back to the main process, so
+work done in a process pool is counted once, without shared memory or
+locks between processes. Updates made in any other process are ignored.
+"""
+
+import atexit
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Sequence
+
+from logging_utils import log
+from functions import instrumentation
+
+PREFIX = "drawerdissect_"
+
+# Seconds; item and request latencies, then whole step runs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STEP_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+_state = {"pid": None}      # process the metrics were started in
+_registry = []              # metrics in the order they are rendered
+_gauges = {}                # queue name -> callable returning {state: depth}
+_gauges_lock = threading.Lock()
+
+
+def _active() -> bool:
+    return _state["pid"] == os.getpid()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _labels(names: Sequence[str], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A value that only goes up, per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not _active():
+            return
+        key = tuple(labels[n] for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, extra: str) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, k, extra)} {_number(v)}" for k, v in values]
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum, per combination of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}   # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        if not _active():
+            return
+        key = tuple(labels[n] for n in self.label_names)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block took."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, extra: str) -> list:
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, counts in values:
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                le = f'le="{bound:g}"' if bound != "+Inf" else 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, ','.join(filter(None, (extra, le))))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key, extra)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key, extra)} {counts[-2]}")
+        return lines
+
+
+ITEMS = Counter("items_total", "Items (trays, specimens, images) processed", ("step", "status"))
+ITEM_SECONDS = Histogram("item_seconds", "Time to process one item", ("step",))
+PHASE_SECONDS = Histogram("phase_seconds", "Time per item spent in one phase", ("step", "phase"))
+STEP_RUNS = Counter("step_runs_total", "Step runs per drawer", ("step", "status"))
+STEP_SECONDS = Histogram("step_seconds", "Time per step run of one drawer", ("step",), STEP_BUCKETS)
+BYTES_READ = Counter("bytes_read_total", "Bytes read by step runs", ("step",))
+BYTES_WRITTEN = Counter("bytes_written_total", "Bytes written by step runs", ("step",))
+INFERENCE_SECONDS = Histogram("inference_seconds", "Time per model prediction", ("backend",))
+LLM_SECONDS = Histogram("llm_request_seconds", "Time per LLM request", ("provider",))
+LLM_REQUESTS = Counter("llm_requests_total", "LLM requests", ("provider", "status"))
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens used", ("provider", "direction"))
+RETRIES = Counter("retries_total", "Retried operations", ("operation",))
+
+
+# ------------------------------------------------------------------
+# Queue depths
+# ------------------------------------------------------------------
+
+def track_queue(name: str, depths: Callable[[], Dict[str, int]]) -> None:
+    """Publish queue_depth{queue=name,state=...} from depths(), called on every scrape or write."""
+    if _active():
+        with _gauges_lock:
+            _gauges[name] = depths
+
+
+def untrack_queue(name: str) -> None:
+    with _gauges_lock:
+        _gauges.pop(name, None)
+
+
+def _render_queues(extra: str) -> list:
+    with _gauges_lock:
+        gauges = sorted(_gauges.items())
+    lines = []
+    for queue_name, depths in gauges:
+        try:
+            values = depths()
+        except Exception as e:  # a queue folder on a share that went away, etc.
+            log(f"Could not read the depth of queue {queue_name}: {e}")
+            continue
+        for state, depth in sorted(values.items()):
+            lines.append(f"{PREFIX}queue_depth{_labels(('queue', 'state'), (queue_name, state), extra)} {depth}")
+    return lines
+
+
+# ------------------------------------------------------------------
+# Instrumentation events
+# ------------------------------------------------------------------
+
+def _on_event(record: Dict) -> None:
+    """Count an item or step record from instrumentation (main process only)."""
+    event, step = record.get("event"), record.get("step")
+    if event == "item":
+        ITEMS.inc(step=step, status="ok" if record["ok"] else "failed")
+        ITEM_SECONDS.observe(record["seconds"], step=step)
+        for name, seconds in record["phases"].items():
+            PHASE_SECONDS.observe(seconds, step=step, phase=name)
+    elif event == "step":
+        STEP_RUNS.inc(step=step, status="ok" if record["ok"] else "failed")
+        STEP_SECONDS.observe(record["seconds"], step=step)
+        BYTES_READ.inc(record["read_bytes"] or 0, step=step)
+        BYTES_WRITTEN.inc(record["write_bytes"] or 0, step=step)
+
+
+# ------------------------------------------------------------------
+# Exporters
+# ------------------------------------------------------------------
+
+def render(extra_labels: Optional[Dict[str, str]] = None) -> str:
+    """All metrics in the Prometheus text format."""
+    extra = ",".join(f'{k}="{_escape(v)}"' for k, v in (extra_labels or {}).items())
+    lines = []
+    for metric in _registry:
+        samples = metric.render(extra)
+        if samples:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *samples]
+    queues = _render_queues(extra)
+    if queues:
+        lines += [f"# HELP {PREFIX}queue_depth Units waiting or running in a queue",
+                  f"# TYPE {PREFIX}queue_depth gauge", *queues]
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_textfile(path: str, labels: Dict[str, str]) -> None:
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(render(labels))
+        os.replace(tmp, path)
+    except OSError as e:
+        log(f"Could not write {path}: {e}")
+
+
+def start(settings: Dict) -> bool:
+    """
+    Start the exporters switched on in resources.metrics. Returns True if
+    metrics are being recorded.
+
+    The textfile is named drawerdissect_<host>_<pid>.prom and its series
+    carry a process label, so several workers can share one collector
+    folder; it is removed when the process exits.
+    """
+    if not settings["port"] and not settings["textfile_directory"]:
+        return False
+    _state["pid"] = os.getpid()
+    instrumentation.add_listener(_on_event)
+
+    if settings["port"]:
+        try:
+            server = ThreadingHTTPServer((settings["host"], settings["port"]), _Handler)
+        except OSError as e:
+            log(f"Could not serve metrics on {settings['host']}:{settings['port']}: {e}")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            log(f"Metrics:     http://{settings['host']}:{settings['port']}/metrics")
+
+    if settings["textfile_directory"]:
+        os.makedirs(settings["textfile_directory"], exist_ok=True)
+        host = socket.gethostname()
+        path = os.path.join(settings["textfile_directory"], f"drawerdissect_{host}_{os.getpid()}.prom")
+        labels = {"process": f"{host}:{os.getpid()}"}
+
+        def writer():
+            while True:
+                _write_textfile(path, labels)
+                time.sleep(settings["textfile_seconds"])
+
+        def remove():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        threading.Thread(target=writer, name="metrics-textfile", daemon=True).start()
+        atexit.register(remove)
+        log(f"Metrics:     {path} (every {settings['textfile_seconds']}s)")
+    return True
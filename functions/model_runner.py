@@ -25,8 +25,11 @@ Both backends return predictions in the same Roboflow-compatible JSON format:
 }
 """
 
+import os
 from pathlib import Path
 from logging_utils import log
+from functions.instrumentation import item, phase
+from functions.metrics import INFERENCE_SECONDS
 
 
 def get_device(device_setting: str = "auto") -> str:
@@ -71,13 +74,15 @@ class RoboflowModelRunner:
         classification models accept neither confidence nor overlap,
         so we fall back progressively.
         """
-        try:
-            return self._model.predict(image_path, confidence=confidence, overlap=overlap).json()
-        except TypeError:
+        with item(os.path.basename(image_path), image_path), phase("network", image_path), \
+                INFERENCE_SECONDS.time(backend="roboflow"):
             try:
-                return self._model.predict(image_path, confidence=confidence).json()
+                return self._model.predict(image_path, confidence=confidence, overlap=overlap).json()
             except TypeError:
-                return self._model.predict(image_path).json()
+                try:
+                    return self._model.predict(image_path, confidence=confidence).json()
+                except TypeError:
+                    return self._model.predict(image_path).json()
 
 
 class LocalModelRunner:
@@ -112,13 +117,15 @@ class LocalModelRunner:
         confidence and overlap follow the Roboflow 0-100 convention and are
         converted to 0-1 for ultralytics internally.
         """
-        results = self._model.predict(
-            source=image_path,
-            conf=confidence / 100.0,
-            iou=overlap / 100.0,
-            device=self._device,
-            verbose=False,
-        )
+        with item(os.path.basename(image_path), image_path), phase("infer", image_path), \
+                INFERENCE_SECONDS.time(backend="local"):
+            results = self._model.predict(
+                source=image_path,
+                conf=confidence / 100.0,
+                iou=overlap / 100.0,
+                device=self._device,
+                verbose=False,
+            )
 
         result = results[0]
         img_h, img_w = result.orig_shape
@@ -2,83 +2,85 @@ import os
 import cv2
 import numpy as np
 from logging_utils import log, log_found, log_progress
+from functions.resource_scheduler import run_tasks
+from functions.mask_store import read_mask, write_mask, iter_masks
 
-def fix_single_mask(mask_path, current, total):
+def keep_largest_component(mask):
+    """
+    Return a 0/255 mask holding only the largest connected component of `mask`,
+    found in a single labelling pass. Ties go to the lowest label.
+    Also returns the number of components found.
+    """
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+    if num_labels <= 1:
+        return np.zeros_like(mask), 0
+
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    return (labels == largest).astype(np.uint8) * 255, num_labels - 1
+
+def fix_single_mask(mask_path, current, total, only_changed=True):
     """
     Fix a binary mask by keeping only the largest connected component.
     This helps with multi-part segmentations.
-    
+
+    Args:
+        only_changed: Only rewrite the PNG if the result differs from the input
+
     Returns:
         bool: True if fixed, False if skipped or error
     """
     if 'checkpoint' in mask_path:
         return False
-        
+
     try:
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        mask = read_mask(mask_path)
         if mask is None:
             log(f"Could not read {mask_path}")
             return False
-            
-        num_labels, labels = cv2.connectedComponents(mask)
-        
-        if num_labels <= 2:  # Only background and one component
+
+        largest_component, components = keep_largest_component(mask)
+
+        if only_changed and np.array_equal(largest_component, mask):
             log_progress("fix_masks", current, total, f"Skipped (single component)")
             return False
-        
-        # Find the largest component
-        largest_component = np.zeros_like(mask)
-        max_size = 0
-        
-        for label in range(1, num_labels):
-            component = (labels == label).astype(np.uint8) * 255
-            size = np.sum(component)
-            if size > max_size:
-                max_size = size
-                largest_component = component
-        
-        # Save the fixed mask
-        cv2.imwrite(mask_path, largest_component)
-        log_progress("fix_masks", current, total, f"Fixed {os.path.basename(mask_path)}")
+
+        # Save the fixed mask where it came from (PNG or mask store)
+        write_mask(mask_path, largest_component)
+        log_progress("fix_masks", current, total, f"Fixed {os.path.basename(mask_path)} (kept 1 of {components} parts)")
         return True
-            
+
     except Exception as e:
         log(f"Error processing {mask_path}: {str(e)}")
         return False
 
-def fix_mask(mask_dir):
+def _fix_task(args):
+    """Pool entry point for fix_single_mask."""
+    mask_path, current, total, only_changed = args
+    return fix_single_mask(mask_path, current, total, only_changed)
+
+def fix_mask(mask_dir, sequential=False, max_workers=None, only_changed=True):
     """
     Fix all binary masks in the directory by keeping only the largest component in each.
-    
+
     Args:
-        mask_dir: Directory containing binary mask PNG files
+        mask_dir: Directory containing binary mask PNG files (or mask store containers)
+        sequential: Process one mask at a time
+        max_workers: Maximum number of parallel workers
+        only_changed: Only rewrite masks whose content changes
     """
     # Find all mask files
-    mask_files = []
-    for root, _, files in os.walk(mask_dir):
-        for f in files:
-            if f.endswith('.png') and 'checkpoint' not in f:
-                mask_path = os.path.join(root, f)
-                mask_files.append(mask_path)
-    
+    mask_files = [p for p in iter_masks(mask_dir) if 'checkpoint' not in os.path.basename(p)]
+
     if not mask_files:
         log("No mask files found to process")
         return
-        
+
     log_found("mask files", len(mask_files))
-    
-    # Process each mask
-    fixed = 0
-    skipped = 0
-    errors = 0
-    
-    for i, mask_path in enumerate(mask_files, 1):
-        try:
-            result = fix_single_mask(mask_path, i, len(mask_files))
-            if result:
-                fixed += 1
-            else:
-                skipped += 1
-        except Exception as e:
-            log(f"Error fixing {os.path.basename(mask_path)}: {str(e)}")
-            errors += 1
+
+    tasks = [(mask_path, i, len(mask_files), only_changed) for i, mask_path in enumerate(mask_files, 1)]
+    results = run_tasks(_fix_task, tasks, "fix_masks", mask_files,
+                        sequential=sequential, max_workers=max_workers)
+
+    fixed = sum(1 for r in results if r)
+    skipped = len(results) - fixed
+    log(f"fix_masks complete: {fixed} masks fixed, {skipped} unchanged or skipped")
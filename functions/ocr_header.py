@@ -9,6 +9,7 @@ from dataclasses import dataclass
 from typing import List, Tuple, Optional, Dict
 
 from functions.llm_client import build_llm_client
+from functions.metrics import RETRIES
 
 # Silence HTTP request logging
 logging.getLogger("httpx").disabled = True
@@ -130,6 +131,8 @@ class ImageTranscriber:
             except Exception as exc:
                 if attempt == self.max_retries - 1:
                     raise
+                if not self.llm_client.is_non_retryable_client_error(exc):
+                    RETRIES.inc(operation="llm_request")
                 if self.llm_client.is_rate_limit_error(exc):
                     await asyncio.sleep(self.retry_delay * (2 ** attempt))
                 elif self.llm_client.is_retryable_server_error(exc):
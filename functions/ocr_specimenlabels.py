@@ -31,6 +31,7 @@ from logging_utils import log, log_found
 
 from functions.model_runner import build_model_runner
 from functions.llm_client import build_llm_client
+from functions.metrics import RETRIES
 from functions.geocode_lookup import check_geocode_country, check_ambiguous_locality
 
 
@@ -58,6 +59,7 @@ def retry_with_backoff(func, max_retries=3, base_delay=2, max_delay=60):
                 delay = min(base_delay * (2 ** attempt) + random.uniform(0, 1), max_delay)
                 log(f"    Transient error (attempt {attempt + 1}/{max_retries + 1}), "
                     f"retrying in {delay:.1f}s: {e}")
+                RETRIES.inc(operation="bugcleaner")
                 time.sleep(delay)
             else:
                 raise
@@ -382,6 +384,7 @@ def call_claude_multicrop(
 
             if attempt < max_attempts - 1:
                 log(f"    Parse failed, retrying with corrective prompt...")
+                RETRIES.inc(operation="llm_parse")
                 retry_messages = [
                     {"role": "user", "content": content},
                     {"role": "assistant", "content": raw},
@@ -2,32 +2,17 @@ from PIL import Image, ImageFile
 import os
 import time
 from pathlib import Path
-from multiprocessing import Pool, cpu_count
 from typing import List, Set, Tuple, Optional
 
 # Import simplified logging
 from logging_utils import log, log_found, log_progress
+from functions.resource_scheduler import run_tasks
+from functions.instrumentation import phase
 
 # Allow PIL to handle very large images
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-def determine_optimal_workers(total_files: int, sequential: bool = False, max_workers: Optional[int] = None) -> int:
-    """
-    Determine optimal number of worker processes.
-    """
-    # If sequential processing is requested, use 1 worker
-    if sequential:
-        return 1
-        
-    # If max_workers is specified, respect that limit
-    if max_workers is not None:
-        return min(max_workers, total_files)
-    
-    # Default: Use half the available cores
-    cpu_cores = cpu_count()
-    return min(max(1, cpu_cores // 2), total_files)
-
 def resize_image(args: Tuple[str, str, Set[str], int, int]) -> bool:
     """
     Resize a single image file.
@@ -52,14 +37,17 @@ def resize_image(args: Tuple[str, str, Set[str], int, int]) -> bool:
                 img.draft('RGB', (1000, 1000))
             
             # Convert if needed
-            if img.mode not in ('RGB', 'L'):
-                img = img.convert('RGB')
+            with phase("decode"):
+                img.load()
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
             
             # Resize and save
             scale_factor = min(1000 / dim for dim in img.size)
             new_size = tuple(int(dim * scale_factor) for dim in img.size)
             resized = img.resize(new_size, Image.Resampling.BILINEAR)
-            resized.save(output_path, 'JPEG', quality=95, optimize=True, progressive=True)
+            with phase("encode"):
+                resized.save(output_path, 'JPEG', quality=95, optimize=True, progressive=True)
         
         log_progress("resize_drawers", current, total, filename)
         return True
@@ -91,7 +79,7 @@ def resize_drawer_images(
         output_dir: Directory to save resized images
         sequential: Process images one at a time (for memory constraints)
         max_workers: Maximum number of parallel workers
-        batch_size: Process in batches of this size (for memory constraints)
+        batch_size: Maximum number of images in flight at once (for memory constraints)
     """
     # Ensure output directory exists
     Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -113,18 +101,10 @@ def resize_drawer_images(
     if sequential:
         log("Processing images sequentially to conserve memory...")
         
-    num_workers = determine_optimal_workers(total_files, sequential, max_workers)
-    
     # Process images
     args = [(f, output_dir, completed_files, i+1, total_files) 
             for i, f in enumerate(file_paths)]
     
-    # Process in parallel or sequentially based on settings
-    if num_workers > 1 and not sequential:
-        with Pool(num_workers) as pool:
-            results = pool.map(resize_image, args)
-    else:
-        # Process sequentially
-        results = []
-        for arg in args:
-            results.append(resize_image(arg))
\ No newline at end of file
+    # Concurrency follows the estimated memory of each drawer scan
+    results = run_tasks(resize_image, args, "resize_drawers", file_paths,
+                        sequential=sequential, max_workers=max_workers, max_in_flight=batch_size)
\ No newline at end of file
@@ -2,30 +2,51 @@ from PIL import Image, ImageFile
 import os
 import time
 from pathlib import Path
-from multiprocessing import Pool, cpu_count
 from typing import List, Set, Tuple
+from logging_utils import log_progress
+from functions.resource_scheduler import run_tasks
+from functions.instrumentation import phase
 
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-def determine_optimal_workers(total_files: int) -> int:
+def save_resized(img: Image.Image, output_path) -> None:
+    """Scale an open tray image so its shorter side is 1000px and save it as JPEG."""
+    # Calculate dimensions once
+    scale_factor = min(1000 / dim for dim in img.size)
+    new_size = tuple(int(dim * scale_factor) for dim in img.size)
+    
+    # Resize with BILINEAR (faster than LANCZOS, good enough for downscaling)
+    resized = img.resize(new_size, Image.Resampling.BILINEAR)
+    
+    # Optimize save operation
+    with phase("encode"):
+        resized.save(
+            output_path,
+            'JPEG',
+            quality=95,
+            optimize=True,
+            progressive=True
+        )
+
+def resize_file(input_path, output_path) -> None:
     """
-    Determine optimal number of worker processes based on:
-    - Number of files to process
-    - Available CPU cores
+    Decode a tray image and save its 1000px version. JPEGs are decoded at
+    reduced size with draft mode, so this is the only way to get the same
+    bytes as resize_trays for them.
     """
-    cpu_cores = cpu_count()
-    
-    # For single file, don't parallelize
-    if total_files == 1:
-        return 1
+    with Image.open(input_path) as img:
+        # Use draft mode for faster loading
+        if hasattr(img, 'draft'):
+            img.draft('RGB', (1000, 1000))
         
-    # For large batches (>10 files), use up to 75% of cores
-    if total_files > 10:
-        return min(max(1, cpu_cores * 3 // 4), total_files)
-    
-    # For small batches (2-10 files), use up to 50% of cores
-    return min(max(1, cpu_cores // 2), total_files)
+        # Convert only if necessary
+        with phase("decode"):
+            img.load()
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+        
+        save_resized(img, output_path)
 
 def resize_image(args: Tuple[str, str, str, Set[str], int, int]) -> bool:
     """
@@ -48,47 +69,20 @@ def resize_image(args: Tuple[str, str, str, Set[str], int, int]) -> bool:
     
     # Check if file already exists
     if output_path.exists():
-        print(f"\rProcessing image {current}/{total} - Skipped {filename} (already exists)", 
-              end="", flush=True)
+        log_progress("resize_trays", current, total, f"Skipped {filename} (already exists)")
         return False
         
     try:
         start_time = time.time()
         
-        # Open and resize image with optimizations
-        with Image.open(input_path) as img:
-            # Use draft mode for faster loading
-            if hasattr(img, 'draft'):
-                img.draft('RGB', (1000, 1000))
-            
-            # Convert only if necessary
-            if img.mode not in ('RGB', 'L'):
-                img = img.convert('RGB')
-            
-            # Calculate dimensions once
-            scale_factor = min(1000 / dim for dim in img.size)
-            new_size = tuple(int(dim * scale_factor) for dim in img.size)
-            
-            # Resize with BILINEAR (faster than LANCZOS, good enough for downscaling)
-            resized = img.resize(new_size, Image.Resampling.BILINEAR)
-            
-            # Optimize save operation
-            resized.save(
-                output_path,
-                'JPEG',
-                quality=95,
-                optimize=True,
-                progressive=True
-            )
+        resize_file(input_path, output_path)
         
         duration = time.time() - start_time
-        print(f"\rProcessing image {current}/{total} - Completed {filename} in {duration:.1f}s", 
-              end="", flush=True)
+        log_progress("resize_trays", current, total, f"Completed {filename} in {duration:.1f}s")
         return True
             
     except Exception as e:
-        print(f"\rProcessing image {current}/{total} - Error with {filename}: {str(e)}", 
-              end="", flush=True)
+        log_progress("resize_trays", current, total, f"Error with {filename}: {str(e)}")
         return False
 
 def get_image_files(input_dir: str) -> List[str]:
@@ -119,16 +113,12 @@ def resize_tray_images(input_dir: str, output_dir: str) -> None:
     
     print(f"Found {total_files} images to process")
     
-    # Determine optimal number of workers
-    num_workers = determine_optimal_workers(total_files)
-    
-    # Process images
+    # Process images; concurrency follows the estimated memory of each tray
     args = [(f, input_dir, output_dir, set(), i+1, total_files) 
             for i, f in enumerate(file_paths)]
     
-    with Pool(num_workers) as pool:
-        results = pool.map(resize_image, args)
-        processed = sum(1 for r in results if r)
+    results = run_tasks(resize_image, args, "resize_trays", file_paths)
+    processed = sum(1 for r in results if r)
 
 
 
@@ -0,0 +1,391 @@
+"""
+resource_scheduler.py
+
+Memory-aware admission of image tasks, shared by the CPU-heavy steps.
+
+Each step used to pick its worker count from the file count and cpu_count(),
+and memory safety depended on hand-set step_overrides in config.yaml
+(e.g. crop_trays: sequential, batch_size 1). Here every task gets a memory
+estimate from the pixel count of its input image, read from the file header
+without decoding, times a per-step bytes-per-pixel factor. A task is only
+submitted while
+
+    memory in use when no step was running + estimates of running tasks
+
+stays under the configured ceiling, so a drawer of 40 small trays runs
+wide while a handful of 600 MP scans run one or two at a time.
+
+As tasks finish, the real increase in system memory is compared with what
+was estimated and the estimates are scaled to match, so the concurrency
+follows measured usage rather than the defaults below.
+
+The ceiling is shared by the whole process (MemoryBudget): when several
+drawers run steps at the same time (drawer_scheduler.py), every run_tasks
+call reserves its tasks from the same budget, so together they stay under
+the ceiling instead of each admitting tasks up to it.
+"""
+
+import functools
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import cpu_count
+from typing import Callable, List, Optional, Sequence
+from PIL import Image
+from logging_utils import log, worker_setup
+from functions import instrumentation
+
+Image.MAX_IMAGE_PIXELS = None
+
+GB = 1024 ** 3
+
+# Approximate peak bytes held per input pixel while one task runs
+STEP_BYTES_PER_PIXEL = {
+    "resize_drawers":      4,   # full decode unless the JPEG draft shortcut applies
+    "crop_trays":          7,   # decoded drawer + tray crops awaiting encode
+    "resize_trays":        4,
+    "tray_stage":          7,   # decoded tray + shared copy + crops
+    "create_transparency": 14,  # RGB specimen, mask, RGBA result and white-background copy
+    "cutout_stage":        10,  # RGB specimen edited in place, masks and RGBA result
+}
+DEFAULT_BYTES_PER_PIXEL = 4
+
+# Interpreter, libraries and buffers of one worker process, independent of image size
+WORKER_OVERHEAD_BYTES = 150 * 1024 ** 2
+
+# Threads of a network-bound step (requests to Roboflow) at most
+MAX_NETWORK_WORKERS = 32
+
+_settings = {
+    "memory_limit_gb": None,   # hard ceiling; None = memory_fraction of physical memory
+    "memory_fraction": 0.75,
+    "bytes_per_pixel": {},     # per-step overrides of STEP_BYTES_PER_PIXEL
+}
+
+
+def configure(settings: dict) -> None:
+    """Apply resources.scheduler settings from config.yaml."""
+    _settings.update({k: v for k, v in settings.items() if k in _settings})
+
+
+def read_image_pixels(path: str) -> Optional[int]:
+    """Return width * height from the image header, without decoding pixel data."""
+    try:
+        with Image.open(path) as img:
+            return img.width * img.height
+    except Exception:
+        return None
+
+
+def system_memory() -> tuple:
+    """Return (total, available) physical memory in bytes."""
+    try:
+        info = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                info[key] = int(value.split()[0]) * 1024
+        return info["MemTotal"], info.get("MemAvailable", info["MemFree"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        page = os.sysconf("SC_PAGE_SIZE")
+        return os.sysconf("SC_PHYS_PAGES") * page, os.sysconf("SC_AVPHYS_PAGES") * page
+    except (ValueError, OSError, AttributeError):
+        return None, None
+
+
+def memory_ceiling() -> Optional[int]:
+    """The memory budget in bytes, or None when it cannot be determined."""
+    if _settings["memory_limit_gb"]:
+        return int(_settings["memory_limit_gb"] * GB)
+    total, _ = system_memory()
+    return int(total * _settings["memory_fraction"]) if total else None
+
+
+class MemoryBudget:
+    """
+    The memory ceiling shared by every run_tasks call of the process.
+
+    Calls reserve their worker overhead while they run and an estimate per
+    task while it runs. A task is admitted while memory in use when the
+    budget was last idle + reservations stays under the ceiling; a task
+    larger than the whole budget still runs when no other task does.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.ceiling = None
+        self.total = None
+        self.baseline = 0       # memory in use outside the reservations, taken when idle
+        self.overhead = 0       # reserved for worker processes
+        self.reserved = 0       # overheads plus the (corrected) estimates of admitted tasks
+        self.estimated = 0      # uncorrected estimates of admitted tasks
+        self.tasks = 0          # admitted tasks
+        self.users = 0          # run_tasks calls (and holds) using the budget
+        self.correction = 1.0
+
+    def open(self, overhead: int = 0) -> Optional[int]:
+        """Start using the budget with overhead bytes reserved. Returns the ceiling (None = unknown)."""
+        with self._cond:
+            if self.users == 0:
+                self.ceiling = memory_ceiling()
+                self.total, available = system_memory()
+                self.baseline = (self.total - available) if available is not None else 0
+            self.users += 1
+            self.overhead += overhead
+            self.reserved += overhead
+            return self.ceiling
+
+    def close(self, overhead: int = 0) -> None:
+        with self._cond:
+            self.users -= 1
+            self.overhead -= overhead
+            self.reserved -= overhead
+            self._cond.notify_all()
+
+    def admit(self, estimate: int, wait: bool = True) -> Optional[int]:
+        """
+        Reserve room for one task, waiting for other tasks to finish if wait
+        is set. Returns the bytes reserved, or None if it does not fit now.
+        """
+        with self._cond:
+            while True:
+                amount = int(self.correction * estimate)
+                if (self.ceiling is None or self.tasks == 0
+                        or self.baseline + self.reserved + amount <= self.ceiling):
+                    self.reserved += amount
+                    self.estimated += estimate
+                    self.tasks += 1
+                    return amount
+                if not wait:
+                    return None
+                self._cond.wait(timeout=1.0)
+
+    def release(self, amount: int, estimate: int) -> None:
+        with self._cond:
+            self.reserved -= amount
+            self.estimated -= estimate
+            self.tasks -= 1
+            self._cond.notify_all()
+
+    def headroom(self) -> Optional[int]:
+        """Bytes not yet reserved, or None when there is no ceiling."""
+        with self._cond:
+            return None if self.ceiling is None else self.ceiling - self.baseline - self.reserved
+
+    def observe(self) -> None:
+        """Scale the estimates to the memory the admitted tasks actually hold."""
+        _, available = system_memory()
+        with self._cond:
+            if self.ceiling is None or not self.estimated or available is None or self.total is None:
+                return
+            observed = (self.total - available) - self.baseline - self.overhead
+            ratio = max(0.5, min(4.0, observed / self.estimated))
+            self.correction = 0.7 * self.correction + 0.3 * ratio
+
+
+_budget = MemoryBudget()
+
+
+def worker_cap(total_tasks: int, sequential: bool = False, max_workers: Optional[int] = None,
+               network: bool = False) -> int:
+    """
+    Upper bound on parallel workers, before memory is taken into account:
+    75% of the cores, or for network-bound steps (threads mostly waiting on
+    model requests) two per core up to 32.
+    """
+    if sequential:
+        return 1
+    if max_workers is not None:
+        cap = max_workers
+    elif network:
+        cap = min(MAX_NETWORK_WORKERS, cpu_count() * 2)
+    else:
+        cap = max(1, cpu_count() * 3 // 4)
+    return max(1, min(cap, total_tasks))
+
+
+def estimate_task_bytes(step: str, image_path: Optional[str]) -> int:
+    """Estimated peak memory of one task of `step` working on `image_path`."""
+    per_pixel = _settings["bytes_per_pixel"].get(step, STEP_BYTES_PER_PIXEL.get(step, DEFAULT_BYTES_PER_PIXEL))
+    pixels = read_image_pixels(image_path) if image_path else None
+    return int((pixels or 0) * per_pixel)
+
+
+def _plan_in_flight(step: str, image_paths: Sequence[Optional[str]], workers: int) -> tuple:
+    """(tasks that fit in the shared budget at once, estimate of the largest task)."""
+    if not image_paths:
+        return workers, 0
+    largest = max(estimate_task_bytes(step, p) for p in image_paths)
+    _budget.open()
+    try:
+        headroom = _budget.headroom()
+    finally:
+        _budget.close()
+    if headroom is None:
+        return workers, largest
+    headroom -= workers * WORKER_OVERHEAD_BYTES
+    return max(1, min(workers, headroom // (largest or 1))), largest
+
+
+def plan_in_flight(step: str, image_paths: Sequence[Optional[str]], workers: int) -> int:
+    """
+    How many tasks of `step` fit in memory at once, for executors that
+    manage their own submission (e.g. the shared-memory tray stage).
+    """
+    return _plan_in_flight(step, image_paths, workers)[0]
+
+
+@contextmanager
+def reserve_in_flight(step: str, image_paths: Sequence[Optional[str]], workers: int):
+    """
+    plan_in_flight for a block that runs those tasks itself: yields the
+    number of tasks to keep in flight and holds their memory and the worker
+    overhead in the shared budget until the block ends.
+    """
+    in_flight, largest = _plan_in_flight(step, image_paths, workers)
+    overhead = workers * WORKER_OVERHEAD_BYTES
+    _budget.open(overhead)
+    reserved = _budget.admit(in_flight * largest)
+    try:
+        yield in_flight
+    finally:
+        _budget.release(reserved, in_flight * largest)
+        _budget.close(overhead)
+
+
+def run_tasks(func: Callable, tasks: List, step: str, image_paths: Sequence[Optional[str]],
+              sequential: bool = False, max_workers: Optional[int] = None,
+              max_in_flight: Optional[int] = None, use_threads: bool = False,
+              network: bool = False,
+              on_result: Optional[Callable[[int, object], None]] = None) -> List:
+    """
+    Run func over tasks, admitting new tasks only while their estimated
+    memory fits in the budget shared with other run_tasks calls.
+
+    Args:
+        func:          Worker function taking one task (must be picklable unless use_threads)
+        tasks:         Task arguments, in order
+        step:          Step name, selects the bytes-per-pixel factor
+        image_paths:   Input image of each task (same order as tasks), used for the estimate
+        sequential:    Run tasks one at a time in this process
+        max_workers:   Upper limit on workers (None = 75% of cores)
+        max_in_flight: Upper limit on tasks running at once, e.g. from --batch-size
+        use_threads:   Use a thread pool instead of processes
+        network:       Tasks mostly wait on requests; allows more workers (see worker_cap)
+        on_result:     Called in the parent as on_result(index, result), in task
+                       order, as soon as a task and all tasks before it are done.
+                       Results handed to it are not kept, so memory stays bounded
+
+    A task that raises is logged and its result is False, whether it ran in
+    this process or in a pool, so one bad image does not stop the step.
+
+    Returns:
+        Results in task order (all None when on_result is given)
+    """
+    if not tasks:
+        return []
+
+    # With the run log on, each task is measured as one item (see instrumentation.py)
+    measured = instrumentation.enabled()
+    names = [os.path.basename(p) if p else f"task_{i + 1}" for i, p in enumerate(image_paths)]
+
+    def unwrap(index, result):
+        if not measured:
+            return result
+        result, record = result
+        instrumentation.record_item(record, image_paths[index])
+        return result
+
+    measure = functools.partial(instrumentation.measure_item, func)
+
+    workers = worker_cap(len(tasks), sequential, max_workers, network)
+    estimates = [estimate_task_bytes(step, p) for p in image_paths]
+    if workers == 1:
+        _budget.open()
+        try:
+            call = (lambda i: unwrap(i, measure(names[i], tasks[i]))) if measured else (lambda i: func(tasks[i]))
+
+            def run(index):
+                reserved = _budget.admit(estimates[index])
+                try:
+                    return call(index)
+                except Exception as e:
+                    log(f"Error in {step} task {index + 1}: {e}")
+                    return False
+                finally:
+                    _budget.release(reserved, estimates[index])
+
+            if not on_result:
+                return [run(index) for index in range(len(tasks))]
+            for index in range(len(tasks)):
+                on_result(index, run(index))
+            return [None] * len(tasks)
+        finally:
+            _budget.close()
+
+    limit = min(workers, max_in_flight) if max_in_flight else workers
+    overhead = 0 if use_threads else workers * WORKER_OVERHEAD_BYTES
+    ceiling = _budget.open(overhead)
+
+    log(f"Running {len(tasks)} tasks on up to {limit} workers"
+        + (f" within {ceiling / GB:.1f} GB (shared by concurrent steps)" if ceiling else ""))
+
+    results = [None] * len(tasks)
+    finished = [False] * len(tasks)
+    next_result = 0  # first task not yet passed to on_result
+    running = {}  # future -> (task index, bytes reserved)
+    next_task = 0
+    peak = 0
+
+    if use_threads:
+        executor = ThreadPoolExecutor(max_workers=workers, **worker_setup())
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, **worker_setup())
+    try:
+        with executor:
+            while next_task < len(tasks) or running:
+                # Admit as many tasks as the budget allows; with none of ours
+                # running, wait until other steps free enough of it
+                while next_task < len(tasks) and len(running) < limit:
+                    reserved = _budget.admit(estimates[next_task], wait=not running)
+                    if reserved is None:
+                        break
+                    if measured:
+                        future = executor.submit(measure, names[next_task], tasks[next_task])
+                    else:
+                        future = executor.submit(func, tasks[next_task])
+                    running[future] = (next_task, reserved)
+                    next_task += 1
+                peak = max(peak, len(running))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index, reserved = running.pop(future)
+                    _budget.release(reserved, estimates[index])
+                    try:
+                        results[index] = unwrap(index, future.result())
+                    except Exception as e:
+                        log(f"Error in {step} task {index + 1}: {e}")
+                        results[index] = False
+                    finished[index] = True
+
+                # Compare the memory actually held by the still-running tasks with their estimate
+                if ceiling is not None:
+                    _budget.observe()
+
+                while next_result < len(tasks) and finished[next_result]:
+                    if on_result:
+                        on_result(next_result, results[next_result])
+                        results[next_result] = None
+                    next_result += 1
+    finally:
+        for index, reserved in running.values():
+            _budget.release(reserved, estimates[index])
+        _budget.close(overhead)
+
+    log(f"{step}: at most {peak} tasks ran at once (estimate correction x{_budget.correction:.2f})")
+    return results
@@ -0,0 +1,300 @@
+"""
+streaming.py
+
+Streaming execution for the middle of the pipeline. In the default mode
+process_images runs one step over every image of a drawer before starting
+the next, so the first outline_specimens call waits until every tray has
+been cropped.
+
+Here units of work (trays, then specimens) flow through the step graph as
+soon as their inputs exist:
+
+    resize_trays -> find_traylabels / find_specimens -> tray crops
+        -> outline_specimens -> create_masks
+
+Stages are connected by bounded queues. CPU-bound stages hand their work to
+a shared process pool; inference stages run in threads, so image work and
+network/GPU work overlap. Every stage reuses the per-item function of the
+regular step and its skip logic, so outputs are identical and a streamed
+run can be resumed by a normal one (and vice versa).
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from logging_utils import log, current_drawer, flush_progress, set_drawer, worker_setup
+from functions.metrics import track_queue, untrack_queue
+from functions.resize_trays import resize_image
+from functions.tray_stage import build_tray_job, has_pending_outputs, fused_tray_task, SUPPORTED_FORMATS
+from functions.infer_beetles import process_image as outline_specimen
+from functions.create_masks import process_mask as rasterize_mask
+from functions.resource_scheduler import worker_cap
+
+# Steps that can take part in a streamed section, in pipeline order
+STREAM_STEPS = [
+    "resize_trays", "find_traylabels", "find_specimens",
+    "crop_labels", "crop_specimens", "create_traymaps",
+    "outline_specimens", "create_masks",
+]
+
+TRAY_STREAM_STEPS = set(STREAM_STEPS[:6])
+
+_DONE = object()
+
+
+class _Stage:
+    """A pool of threads that pulls units from an inbox and pushes results downstream."""
+
+    def __init__(self, name, func, workers, inbox, outbox=None, stats=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.downstream_workers = 1
+        self.stats = stats
+        self.drawer = current_drawer()  # progress of the stage threads counts for this drawer
+        self._finished = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def _run(self):
+        set_drawer(self.drawer)
+        while True:
+            unit = self.inbox.get()
+            if unit is _DONE:
+                break
+            try:
+                for out in self.func(unit) or ():
+                    if self.outbox is not None:
+                        self.outbox.put(out)
+                if self.stats:
+                    self.stats.record(self.name)
+            except Exception as e:
+                log(f"[stream] {self.name} error: {e}")
+
+        # The last worker to finish tells every downstream worker to stop
+        with self._lock:
+            self._finished += 1
+            last = self._finished == self.workers
+        if last and self.outbox is not None:
+            for _ in range(self.downstream_workers):
+                self.outbox.put(_DONE)
+
+
+class StreamStats:
+    """Per-stage completion counts and time to first result."""
+
+    def __init__(self, final_stage):
+        self.start = time.time()
+        self.final_stage = final_stage
+        self.first_result = None
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage):
+        with self._lock:
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            if stage == self.final_stage and self.first_result is None:
+                self.first_result = time.time() - self.start
+                log(f"[stream] First {stage} result after {self.first_result:.1f}s")
+
+    def summary(self):
+        parts = [f"{stage}: {count}" for stage, count in self.counts.items()]
+        log(f"[stream] Units completed per stage - {', '.join(parts) or 'none'}")
+        if self.first_result is not None:
+            log(f"[stream] Time to first {self.final_stage} result: {self.first_result:.1f}s")
+
+
+def _mirror(root, input_dir, output_dir):
+    relative_path = os.path.relpath(root, input_dir)
+    return output_dir if relative_path == "." else os.path.join(output_dir, relative_path)
+
+
+def _predict_to_json(runner, image_path, json_path, confidence, overlap):
+    """Run a detector on one image unless its JSON already exists."""
+    if os.path.exists(json_path):
+        return
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    prediction = runner.predict(image_path, confidence=confidence, overlap=overlap)
+    with open(json_path, "w") as f:
+        json.dump(prediction, f)
+
+
+def stream_drawer(dirs, steps, runners, params, cpu_workers=None, inference_workers=4, queue_size=32):
+    """
+    Run the streamable steps for one drawer with overlapping stages.
+
+    Args:
+        dirs:              Mapping of drawer_subdirs keys to absolute paths
+        steps:             Requested steps (only those in STREAM_STEPS are used)
+        runners:           Model runners keyed by model name ("label", "tray", "mask")
+        params:            Model parameters keyed like "tray_confidence", "tray_overlap", ...
+        cpu_workers:       Processes shared by CPU-bound stages (None = worker_cap's default)
+        inference_workers: Threads per inference stage
+        queue_size:        Maximum number of units waiting between two stages
+    """
+    steps = [s for s in STREAM_STEPS if s in steps]
+    if not steps:
+        return
+
+    cpu_workers = cpu_workers or worker_cap(cpu_count())
+    tray_outputs = {
+        {"resize_trays": "resize", "crop_labels": "labels",
+         "crop_specimens": "specimens", "create_traymaps": "traymaps"}[s]
+        for s in steps if s in ("resize_trays", "crop_labels", "crop_specimens", "create_traymaps")
+    }
+
+    log(f"[stream] Streaming {', '.join(steps)} with {cpu_workers} CPU workers, "
+        f"{inference_workers} inference threads per stage, queue size {queue_size}")
+
+    pool = ProcessPoolExecutor(max_workers=cpu_workers, **worker_setup())
+    stage_funcs = []
+
+    # ---------------- tray stages ----------------
+    spec_counter = itertools.count(1)
+
+    def resize_stage(tray):
+        args = (tray["tray_path"], dirs["trays"], dirs["resized_trays"], set(), tray["index"], tray["total"])
+        pool.submit(resize_image, args).result()
+        yield tray
+
+    def detect_stage(tray):
+        resized = tray["resized_file"]
+        if not os.path.exists(resized):
+            log(f"[stream] Skipped {tray['base_name']} (no resized image)")
+            return
+        rel = os.path.relpath(os.path.dirname(resized), dirs["resized_trays"])
+        detectors = []
+        if "find_traylabels" in steps:
+            detectors.append(("find_traylabels", "label", dirs["label_coordinates"], "_1000_label.json"))
+        if "find_specimens" in steps:
+            detectors.append(("find_specimens", "tray", dirs["resized_trays_coordinates"], "_1000.json"))
+        # Each detector on its own, so a failed label request still lets the
+        # tray's specimens through (and the other way round)
+        for step, model, output_dir, suffix in detectors:
+            try:
+                _predict_to_json(runners[model], resized,
+                                 os.path.normpath(os.path.join(output_dir, rel, tray["base_name"] + suffix)),
+                                 params[f"{model}_confidence"], params[f"{model}_overlap"])
+            except Exception as e:
+                log(f"[stream] {step} error on {tray['base_name']}: {e}")
+        yield tray
+
+    def crop_stage(tray):
+        rel = os.path.relpath(os.path.dirname(tray["resized_file"]), dirs["resized_trays"])
+        label_json = os.path.join(dirs["label_coordinates"], rel, f"{tray['base_name']}_1000_label.json")
+        specimen_json = os.path.join(dirs["resized_trays_coordinates"], rel, f"{tray['base_name']}_1000.json")
+        job = build_tray_job(
+            tray["tray_path"], dirs["trays"], dirs["resized_trays"], dirs["labels"], dirs["specimens"],
+            tray_outputs - {"resize"},
+            label_json=os.path.normpath(label_json) if os.path.exists(label_json) else None,
+            specimen_json=os.path.normpath(specimen_json) if os.path.exists(specimen_json) else None,
+            guides_dir=dirs["guides"],
+        )
+        if has_pending_outputs(job):
+            pool.submit(fused_tray_task, (job, tray["index"], tray["total"])).result()
+        yield tray
+
+    def specimens_of(tray):
+        folder = os.path.join(dirs["specimens"], tray["tray_num"])
+        if not os.path.isdir(folder):
+            return
+        for file in sorted(os.listdir(folder)):
+            if file.startswith(f"{tray['base_name']}_spec_") and file.lower().endswith(SUPPORTED_FORMATS):
+                yield {"root": folder, "file": file, "index": next(spec_counter), "total": None}
+
+    # ---------------- specimen stages ----------------
+    def outline_stage(spec):
+        args = (runners["mask"], dirs["specimens"], dirs["mask_coordinates"], spec["root"], spec["file"],
+                params["beetle_confidence"], spec["index"], spec["total"])
+        outline_specimen(args)
+        yield spec
+
+    def mask_stage(spec):
+        json_dir = _mirror(spec["root"], dirs["specimens"], dirs["mask_coordinates"])
+        json_path = os.path.join(json_dir, os.path.splitext(spec["file"])[0] + ".json")
+        if not os.path.exists(json_path):
+            return
+        png_dir = _mirror(spec["root"], dirs["specimens"], dirs["mask_png"])
+        os.makedirs(png_dir, exist_ok=True)
+        png_path = os.path.join(png_dir, os.path.splitext(spec["file"])[0] + ".png")
+        pool.submit(rasterize_mask, (json_path, png_path, spec["index"], spec["total"],
+                                    params.get("mask_store", False))).result()
+        yield spec
+
+    # Assemble the chain for the requested steps
+    tray_level = any(s in TRAY_STREAM_STEPS for s in steps)
+    if "resize_trays" in steps:
+        stage_funcs.append(("resize_trays", resize_stage, cpu_workers))
+    if {"find_traylabels", "find_specimens"} & set(steps):
+        stage_funcs.append(("detect", detect_stage, inference_workers))
+    if tray_outputs - {"resize"}:
+        stage_funcs.append(("tray_crops", crop_stage, cpu_workers))
+    specimen_level = {"outline_specimens", "create_masks"} & set(steps)
+    if tray_level and specimen_level:
+        stage_funcs.append(("specimens", lambda tray: specimens_of(tray), 1))
+    if "outline_specimens" in steps:
+        stage_funcs.append(("outline_specimens", outline_stage, inference_workers))
+    if "create_masks" in steps:
+        stage_funcs.append(("create_masks", mask_stage, cpu_workers))
+
+    stats = StreamStats(final_stage=stage_funcs[-1][0])
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stage_funcs) + 1)]
+    stages = [
+        _Stage(name, func, workers, queues[i],
+               queues[i + 1] if i + 1 < len(stage_funcs) else None, stats)
+        for i, (name, func, workers) in enumerate(stage_funcs)
+    ]
+    for upstream, downstream in zip(stages, stages[1:]):
+        upstream.downstream_workers = downstream.workers
+
+    track_queue("stream", lambda: {stage.name: stage.inbox.qsize() for stage in stages})
+    try:
+        for stage in stages:
+            stage.start()
+
+        # Feed the first stage; put() blocks when it falls behind
+        source_dir = dirs["trays"] if tray_level else dirs["specimens"]
+        sources = [
+            (root, file)
+            for root, _, files in os.walk(source_dir)
+            for file in sorted(files)
+            if file.lower().endswith(SUPPORTED_FORMATS)
+        ]
+        log(f"[stream] Found {len(sources)} {'trays' if tray_level else 'specimens'} to stream")
+
+        for i, (root, file) in enumerate(sources, 1):
+            if tray_level:
+                unit = build_tray_job(os.path.join(root, file), dirs["trays"], dirs["resized_trays"],
+                                      dirs["labels"], dirs["specimens"], set())
+            else:
+                unit = {"root": root, "file": file}
+            unit.update(index=i, total=len(sources))
+            queues[0].put(unit)
+
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+        for stage in stages:
+            stage.join()
+    finally:
+        untrack_queue("stream")
+        pool.shutdown()
+
+    flush_progress(current_drawer())  # end this drawer's progress lines
+    stats.summary()
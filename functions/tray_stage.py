@@ -0,0 +1,426 @@
+"""
+tray_stage.py
+
+Tray-level image outputs (resize_trays, crop_labels, crop_specimens,
+create_traymaps) all start from the same tray image. Run as separate steps,
+each one reopens and decodes every tray again.
+
+Two executors are provided:
+
+- shared: each tray is decoded once into a multiprocessing.shared_memory
+  block. The resize, label-crop and specimen-crop jobs for that tray run in
+  worker processes that build their image from the block instead of
+  decoding the file again; the block is released as soon as the tray's jobs
+  finish. Single-band and CMYK pixels are used in place, while RGB
+  trays are copied once per job into PIL's own pixel layout.
+- fused:  each tray is one worker task that decodes the tray once and writes
+  every pending output for it (including the traymap) before moving on.
+
+Output filenames and folder layout are identical to the individual steps,
+so skip logic and the status report are unaffected. Both executors convert
+image modes the way the individual steps do: transparent modes are
+flattened to RGB for every output, and the resized image is RGB or L.
+Resized JPEG trays come from resize_trays' own reduced-size decode of the
+file, a small extra read that keeps their bytes identical to that step's.
+"""
+
+import os
+import json
+import re
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageFile
+from logging_utils import log, log_found, log_progress, worker_setup
+from functions.crop_labels import LABEL_CLASSES, crop_label_regions
+from functions.crop_specimens import sort_annotations_by_row, crop_specimen_regions
+from functions.resize_trays import save_resized, resize_file
+from functions.specimen_guide import draw_guide
+from functions.file_index import index_for
+from functions.resource_scheduler import worker_cap, reserve_in_flight, run_tasks
+
+Image.MAX_IMAGE_PIXELS = None
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+# Formats resize_trays decodes at reduced size (PIL draft mode)
+DRAFT_FORMATS = ('.jpg', '.jpeg')
+
+# Outputs the tray stage knows how to produce, keyed by the step that normally owns them
+STAGE_OUTPUTS = {
+    "resize_trays": "resize",
+    "crop_labels": "labels",
+    "crop_specimens": "specimens",
+    "create_traymaps": "traymaps",
+}
+
+
+def _has_files(folder):
+    return os.path.isdir(folder) and any(
+        os.path.isfile(os.path.join(folder, f)) for f in os.listdir(folder)
+    )
+
+
+def parse_tray_name(base_name):
+    """Split a tray stem like 'drawer_01_tray_03' into ('drawer_01', '03')."""
+    match = re.search(r'(.+)_tray_(\d+)$', base_name)
+    if match:
+        return match.group(1), match.group(2)
+    return '_'.join(base_name.split('_')[:-2]), base_name.split('_')[-1]
+
+
+def build_tray_job(tray_path, trays_dir, resized_trays_dir, labels_dir, specimens_dir, outputs,
+                   label_json=None, specimen_json=None, guides_dir=None):
+    """
+    Describe the pending tray-level outputs for a single tray.
+
+    Args:
+        tray_path:     Full-size tray image
+        outputs:       Subset of {"resize", "labels", "specimens", "traymaps"} to consider
+        label_json:    Label detection JSON for this tray, if it exists
+        specimen_json: Specimen detection JSON for this tray, if it exists
+
+    Returns:
+        dict: Job description; has_pending_outputs() tells whether there is work to do
+    """
+    root, file = os.path.split(tray_path)
+    base_name, ext = os.path.splitext(file)
+    drawer_name, tray_num = parse_tray_name(base_name)
+
+    job = {
+        'tray_path': tray_path,
+        'base_name': base_name,
+        'drawer_name': drawer_name,
+        'tray_num': tray_num,
+        'ext': ext,
+        'resized_path': None,
+        'label_json': None,
+        'label_folder': None,
+        'specimen_json': None,
+        'specimen_folder': None,
+        'resized_file': None,
+        'guide_path': None,
+    }
+
+    relative_path = os.path.relpath(root, trays_dir)
+    resized_file = os.path.normpath(
+        os.path.join(resized_trays_dir, relative_path, f"{base_name}_1000.jpg"))
+    job['resized_file'] = resized_file
+    if 'resize' in outputs and not os.path.exists(resized_file):
+        job['resized_path'] = resized_file
+
+    if label_json and 'labels' in outputs:
+        label_folder = os.path.join(labels_dir, tray_num)
+        if not any(os.path.exists(os.path.join(label_folder, f"{base_name}_{c}.jpg"))
+                   for c in LABEL_CLASSES):
+            job['label_json'] = label_json
+            job['label_folder'] = label_folder
+
+    if specimen_json and 'specimens' in outputs:
+        specimen_folder = os.path.join(specimens_dir, tray_num)
+        if not _has_files(specimen_folder):
+            job['specimen_json'] = specimen_json
+            job['specimen_folder'] = specimen_folder
+
+    if specimen_json and 'traymaps' in outputs and guides_dir:
+        guide_path = os.path.normpath(
+            os.path.join(guides_dir, relative_path, f"{base_name}_guide.jpg"))
+        if not os.path.exists(guide_path):
+            job['specimen_json'] = job['specimen_json'] or specimen_json
+            job['guide_path'] = guide_path
+
+    return job
+
+
+def has_pending_outputs(job):
+    return bool(job['resized_path'] or job['label_json'] or job['specimen_folder'] or job['guide_path'])
+
+
+def find_tray_jobs(trays_dir, resized_trays_dir, specimen_coordinates_dir,
+                   label_coordinates_dir, labels_dir, specimens_dir, outputs, guides_dir=None):
+    """
+    Work out which outputs are still pending for each tray.
+
+    Args:
+        outputs: Subset of {"resize", "labels", "specimens", "traymaps"} to consider
+
+    Returns:
+        list of dicts, one per tray with at least one pending output
+    """
+    needs_specimen_jsons = 'specimens' in outputs or 'traymaps' in outputs
+    specimen_index = index_for(specimen_coordinates_dir) if needs_specimen_jsons else None
+    label_index = index_for(label_coordinates_dir) if 'labels' in outputs else None
+
+    jobs = []
+    for root, _, files in os.walk(trays_dir):
+        for file in sorted(files):
+            base_name, ext = os.path.splitext(file)
+            if ext.lower() not in SUPPORTED_FORMATS:
+                continue
+
+            job = build_tray_job(
+                os.path.join(root, file), trays_dir, resized_trays_dir, labels_dir, specimens_dir, outputs,
+                label_json=label_index.find(f"{base_name}_1000_label.json") if label_index else None,
+                specimen_json=specimen_index.find(f"{base_name}_1000.json") if specimen_index else None,
+                guides_dir=guides_dir,
+            )
+            if has_pending_outputs(job):
+                jobs.append(job)
+
+    return jobs
+
+
+def _flatten_transparency(img):
+    """Convert transparent images to RGB, as crop_labels and crop_specimens do; other modes are kept."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        return img.convert('RGB')
+    return img
+
+
+def _decode_into_shared(tray_path):
+    """
+    Decode a tray image once and copy its pixels into a new shared memory
+    block. Returns the block and the layout needed to rebuild the image:
+    (mode, size, byte count, palette).
+    """
+    with Image.open(tray_path) as img:
+        img = _flatten_transparency(img)
+        img.load()
+        data = img.tobytes()
+        layout = (img.mode, img.size, len(data), img.getpalette() if img.mode == 'P' else None)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    return shm, layout
+
+
+def _attach_shared(name):
+    # Workers must not register the block with the resource tracker; the parent owns it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _run_output(kind, img, job):
+    """Produce one tray output from an open PIL image. Shared by every tray-stage executor."""
+    if kind == 'resize':
+        os.makedirs(os.path.dirname(job['resized_path']), exist_ok=True)
+        if job['ext'].lower() in DRAFT_FORMATS:
+            # resize_trays decodes JPEGs at reduced size, which gives different pixels
+            # than resizing the full decode; do the same for identical output
+            resize_file(job['tray_path'], job['resized_path'])
+        else:
+            # resize_trays keeps RGB and L and converts everything else
+            save_resized(img if img.mode in ('RGB', 'L') else img.convert('RGB'), job['resized_path'])
+        return 1
+
+    if kind == 'labels':
+        with open(job['label_json'], 'r') as f:
+            data = json.load(f)
+        if not data.get('predictions'):
+            return 0
+        os.makedirs(job['label_folder'], exist_ok=True)
+        return len(crop_label_regions(img, data, job['label_folder'], job['base_name']))
+
+    if kind == 'traymap':
+        with open(job['specimen_json'], 'r') as f:
+            data = json.load(f)
+        sorted_annotations = sort_annotations_by_row(data.get('predictions', []))
+        with Image.open(job['resized_file']) as resized:
+            if resized.mode in ('RGBA', 'LA') or (resized.mode == 'P' and 'transparency' in resized.info):
+                resized = resized.convert('RGB')
+            guide_img = draw_guide(resized, sorted_annotations)
+        os.makedirs(os.path.dirname(job['guide_path']), exist_ok=True)
+        guide_img.save(job['guide_path'], quality=95)
+        return len(sorted_annotations)
+
+    if kind == 'specimens':
+        with open(job['specimen_json'], 'r') as f:
+            data = json.load(f)
+        resized_dimensions = data.get('image', {})
+        if not all(key in resized_dimensions for key in ['width', 'height']):
+            log(f"Skipped {job['base_name']}: Missing image dimensions in JSON")
+            return 0
+        sorted_annotations = sort_annotations_by_row(data.get('predictions', []))
+        os.makedirs(job['specimen_folder'], exist_ok=True)
+        crop_specimen_regions(img, sorted_annotations, resized_dimensions, job['specimen_folder'],
+                              job['drawer_name'], job['tray_num'], job['ext'])
+        return len(sorted_annotations)
+
+    raise ValueError(f"Unknown tray output: {kind}")
+
+
+def _shared_output_job(args):
+    """Worker entry point: attach to a decoded tray and produce one output from its pixels."""
+    kind, shm_name, layout, job = args
+    mode, size, nbytes, palette = layout
+    try:
+        shm = _attach_shared(shm_name)
+    except FileNotFoundError:
+        log(f"Error processing {job['base_name']}: shared tray buffer is gone")
+        return kind, False
+    view = shm.buf[:nbytes]
+    img = None
+    try:
+        img = Image.frombuffer(mode, size, view, 'raw', mode, 0, 1)
+        if palette is not None:
+            img.putpalette(palette)
+        _run_output(kind, img, job)
+        ok = True
+    except Exception as e:
+        # Handled here so the traceback (which holds the image) is gone before the buffer is released
+        log(f"Error processing {job['base_name']} ({kind}): {str(e)}")
+        ok = False
+    # Drop every reference into the buffer before closing it
+    del img
+    view.release()
+    shm.close()
+    return kind, ok
+
+
+def _job_outputs(job):
+    kinds = []
+    if job['resized_path']:
+        kinds.append('resize')
+    if job['label_json']:
+        kinds.append('labels')
+    if job['specimen_folder']:
+        kinds.append('specimens')
+    if job['guide_path']:
+        kinds.append('traymap')
+    return kinds
+
+
+def _process_tray_shared(pool, job, current, total):
+    """Decode one tray into shared memory, fan its outputs out to the pool, then release it."""
+    try:
+        shm, layout = _decode_into_shared(job['tray_path'])
+    except Exception as e:
+        log(f"Error decoding {job['base_name']}: {str(e)}")
+        return False
+
+    try:
+        futures = [pool.submit(_shared_output_job, (kind, shm.name, layout, job))
+                   for kind in _job_outputs(job)]
+        results = [f.result() for f in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    done = [kind for kind, ok in results if ok]
+    log_progress("tray_stage", current, total, f"Processed {job['base_name']} ({', '.join(done) or 'nothing'})")
+    return len(done) == len(results)
+
+
+def run_shared_tray_stage(trays_dir, resized_trays_dir, specimen_coordinates_dir,
+                          label_coordinates_dir, labels_dir, specimens_dir,
+                          steps=("resize_trays", "crop_labels", "crop_specimens"),
+                          sequential=False, max_workers=None):
+    """
+    Produce tray-level outputs with a single decode per tray.
+
+    Args:
+        trays_dir:                Directory containing full-size tray images
+        resized_trays_dir:        Directory for the 1000px tray images
+        specimen_coordinates_dir: Directory containing specimen detection JSONs
+        label_coordinates_dir:    Directory containing label detection JSONs
+        labels_dir:               Directory where cropped labels are saved
+        specimens_dir:            Directory where cropped specimens are saved
+        steps:                    Which of resize_trays / crop_labels / crop_specimens to run
+        sequential:               Keep only one tray resident at a time
+        max_workers:              Maximum number of worker processes
+    """
+    outputs = {STAGE_OUTPUTS[s] for s in steps if s in STAGE_OUTPUTS}
+    jobs = find_tray_jobs(trays_dir, resized_trays_dir, specimen_coordinates_dir,
+                          label_coordinates_dir, labels_dir, specimens_dir, outputs)
+
+    if not jobs:
+        log("No pending tray outputs")
+        return
+
+    log_found("trays", len(jobs))
+
+    num_workers = worker_cap(len(jobs), sequential, max_workers)
+    # Each in-flight tray holds one decoded buffer; cap residency by the shared memory budget
+    with reserve_in_flight("tray_stage", [job['tray_path'] for job in jobs], num_workers) as trays_in_flight, \
+            ProcessPoolExecutor(max_workers=num_workers, **worker_setup()) as pool, \
+            ThreadPoolExecutor(max_workers=trays_in_flight, **worker_setup()) as decoders:
+        log(f"Processing trays with {num_workers} workers, {trays_in_flight} trays resident at a time")
+        results = list(decoders.map(
+            lambda item: _process_tray_shared(pool, item[1], item[0], len(jobs)),
+            enumerate(jobs, 1),
+        ))
+
+    processed = sum(1 for r in results if r)
+    log(f"tray_stage complete: {processed} trays processed, {len(jobs) - processed} with errors")
+
+
+def fused_tray_task(args):
+    """Worker entry point: decode one tray and write every pending output for it."""
+    job, current, total = args
+    kinds = _job_outputs(job)
+    done = []
+
+    def produce(kind, img):
+        # Like the individual steps, one failed output does not stop the others
+        try:
+            _run_output(kind, img, job)
+            done.append(kind)
+        except Exception as e:
+            log(f"Error processing {job['base_name']} ({kind}): {str(e)}")
+
+    full_size_kinds = [k for k in kinds if k != 'traymap']
+    if full_size_kinds:
+        try:
+            with Image.open(job['tray_path']) as img:
+                img = _flatten_transparency(img)
+                img.load()
+                for kind in full_size_kinds:
+                    produce(kind, img)
+        except Exception as e:
+            log(f"Error processing {job['base_name']}: {str(e)}")
+            return False
+
+    # The traymap is drawn on the 1000px image, which is written above if it was missing
+    if 'traymap' in kinds:
+        produce('traymap', None)
+
+    log_progress("tray_stage", current, total, f"Processed {job['base_name']} ({', '.join(done) or 'nothing'})")
+    return len(done) == len(kinds)
+
+
+def run_fused_tray_stage(trays_dir, resized_trays_dir, specimen_coordinates_dir,
+                         label_coordinates_dir, labels_dir, specimens_dir, guides_dir,
+                         steps=("resize_trays", "crop_labels", "crop_specimens", "create_traymaps"),
+                         sequential=False, max_workers=None):
+    """
+    Produce all tray-level outputs with one worker task and one decode per tray.
+
+    Args:
+        trays_dir:                Directory containing full-size tray images
+        resized_trays_dir:        Directory for the 1000px tray images
+        specimen_coordinates_dir: Directory containing specimen detection JSONs
+        label_coordinates_dir:    Directory containing label detection JSONs
+        labels_dir:               Directory where cropped labels are saved
+        specimens_dir:            Directory where cropped specimens are saved
+        guides_dir:               Directory where traymaps are saved
+        steps:                    Which tray-level steps to cover
+        sequential:               Process one tray at a time
+        max_workers:              Maximum number of worker processes
+    """
+    outputs = {STAGE_OUTPUTS[s] for s in steps if s in STAGE_OUTPUTS}
+    jobs = find_tray_jobs(trays_dir, resized_trays_dir, specimen_coordinates_dir,
+                          label_coordinates_dir, labels_dir, specimens_dir, outputs,
+                          guides_dir=guides_dir)
+
+    if not jobs:
+        log("No pending tray outputs")
+        return
+
+    log_found("trays", len(jobs))
+
+    tasks = [(job, i, len(jobs)) for i, job in enumerate(jobs, 1)]
+    results = run_tasks(fused_tray_task, tasks, "tray_stage", [job['tray_path'] for job in jobs],
+                        sequential=sequential, max_workers=max_workers)
+
+    processed = sum(1 for r in results if r)
+    log(f"tray_stage complete: {processed} trays processed, {len(tasks) - processed} with errors")
@@ -0,0 +1,340 @@
+"""
+watch_daemon.py
+
+Continuous ingestion for an imaging station (process_images.py --watch).
+
+The daemon watches the unsorted folder for drawer images. A new file is only
+taken once it is completely written: its size and mtime must stay the same
+for settle_seconds and, for JPEG and PNG, it must end with the image end
+marker. Finished images are sorted into drawer folders like at start-up
+(discover_and_sort_drawers) and each drawer is queued on a DrawerScheduler,
+which runs up to parallel_drawers drawers at a time under the usual
+resource budget. An image arriving for a drawer that is queued or running
+sends that drawer through the pipeline again once it is done.
+
+On Linux, inotify wakes the daemon as soon as a file is closed or moved into
+the folder. The folder is also rescanned every poll_seconds, which is all
+that happens without inotify and what catches files written over network
+shares (writes from other machines raise no inotify events).
+
+Everything runs in one process, so model runners and LLM clients built for
+the first drawer are reused for the next. Per-drawer caches (file indexes,
+manifest and mask container connections) are released when a drawer is done.
+
+Queue depth (files settling, drawers waiting and running) and throughput
+(drawers done, per hour, average time per drawer) are logged every
+status_seconds and written to a JSON status file.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from logging_utils import log
+from functions.drawer_management import discover_and_sort_drawers
+from functions.drawer_scheduler import DrawerScheduler
+from functions.file_index import forget_indexes
+from functions.manifest import close_manifest, is_complete
+from functions.mask_store import close_containers
+from functions.metrics import track_queue, untrack_queue
+
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+
+# inotify events that can mean a new or finished file
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+
+class InotifyWatch:
+    """Wakes on new or finished files in one folder (Linux only; raises OSError elsewhere)."""
+
+    def __init__(self, path: str):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("C library not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout: float) -> bool:
+        """Block until an event arrives or timeout passes. Returns True on an event."""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class WatchDaemon:
+    """
+    Sort and process drawer images as they arrive in the unsorted folder.
+
+    Args:
+        config:   DrawerDissectConfig
+        plan:     Callable(drawer_id) -> steps to run for a newly sorted
+                  drawer, or None to leave it alone
+        run_step: Callable(drawer_id, step) that runs one step
+        scheduling: config.scheduling_settings (default: read from config)
+    """
+
+    def __init__(self, config, plan: Callable[[str], Optional[List[str]]],
+                 run_step: Callable[[str, str], None], scheduling: Optional[dict] = None):
+        self.config = config
+        self.plan = plan
+        self.settings = config.watch_settings
+        self.unsorted_dir = config.unsorted_directory
+        self.status_file = self.settings["status_file"] or os.path.join(
+            os.path.dirname(os.path.abspath(self.unsorted_dir)), "watch_status.json")
+        self.scheduler = DrawerScheduler(run_step, scheduling or config.scheduling_settings)
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._settling: Dict[str, tuple] = {}   # file name -> ((size, mtime_ns), first seen with it)
+        self._incomplete_logged = set()
+        self._queued: Dict[str, float] = {}     # drawer -> time queued (waiting or running)
+        self._again = set()                     # drawers to run again once done
+        self._finished = deque()                # (finish time, seconds from queued to done)
+        self.done = self.failed = self.files_sorted = 0
+        self.started_at = time.time()
+        self.mode = "poll"
+
+    # ------------------------------------------------------------------
+    # Watching
+    # ------------------------------------------------------------------
+
+    def _ready_files(self) -> List[str]:
+        """Images in the unsorted folder that have finished being written."""
+        now = time.time()
+        present = {}
+        try:
+            with os.scandir(self.unsorted_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or not entry.name.lower().endswith(SUPPORTED_FORMATS):
+                        continue
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            present[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError as e:
+            log(f"Could not read {self.unsorted_dir}: {e}")
+            return []
+
+        ready = []
+        with self._lock:
+            self._settling = {name: seen for name, seen in self._settling.items() if name in present}
+            for name, signature in present.items():
+                seen = self._settling.get(name)
+                if seen is None or seen[0] != signature:
+                    self._settling[name] = (signature, now)
+                elif now - seen[1] >= self.settings["settle_seconds"]:
+                    if is_complete(os.path.join(self.unsorted_dir, name)):
+                        ready.append(name)
+                    elif name not in self._incomplete_logged:
+                        self._incomplete_logged.add(name)
+                        log(f"{name} stopped changing but looks truncated; waiting for the rest of it")
+            for name in ready:
+                del self._settling[name]
+                self._incomplete_logged.discard(name)
+        return sorted(ready)
+
+    def _next_wait(self) -> float:
+        """Seconds until the next scan: the poll interval, or sooner when a settling file may be ready."""
+        wait = self.settings["poll_seconds"]
+        with self._lock:
+            for _, first_seen in self._settling.values():
+                wait = min(wait, first_seen + self.settings["settle_seconds"] - time.time() + 0.1)
+        return max(0.5, wait)
+
+    # ------------------------------------------------------------------
+    # Drawers
+    # ------------------------------------------------------------------
+
+    def _queue(self, drawer_id: str) -> None:
+        # Claim the drawer in the same locked block as the check, so a new image
+        # seen while it is being planned cannot submit it a second time
+        with self._lock:
+            if drawer_id in self._queued:
+                self._again.add(drawer_id)
+                log(f"{drawer_id} got a new image while queued; it will run again when done")
+                return
+            self._queued[drawer_id] = time.time()
+        try:
+            steps = self.plan(drawer_id)
+        except Exception:
+            self._release(drawer_id)
+            raise
+        if not steps:
+            log(f"Not processing {drawer_id}: no steps to run")
+            if self._release(drawer_id) and not self._stop.is_set():
+                self._queue(drawer_id)
+            return
+        log(f"Queued {drawer_id} ({len(steps)} steps)")
+        future = self.scheduler.submit(drawer_id, steps)
+        future.add_done_callback(lambda f, d=drawer_id: self._drawer_done(d, f))
+
+    def _release(self, drawer_id: str) -> bool:
+        """Drop the claim on a drawer that was not submitted. Returns True if it got a new image meanwhile."""
+        with self._lock:
+            self._queued.pop(drawer_id, None)
+            again = drawer_id in self._again
+            self._again.discard(drawer_id)
+        return again
+
+    def _drawer_done(self, drawer_id: str, future) -> None:
+        if future.cancelled():
+            return
+        ok = future.exception() is None and future.result()
+        drawer_path = self.config.get_drawer_path(drawer_id)
+        forget_indexes(drawer_path)
+        close_manifest(drawer_path)
+        close_containers(drawer_path)
+        with self._lock:
+            queued = self._queued.pop(drawer_id, time.time())
+            self._finished.append((time.time(), time.time() - queued))
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            again = drawer_id in self._again
+            self._again.discard(drawer_id)
+        log(f"Finished {drawer_id} in {(time.time() - queued) / 60:.1f} min" + ("" if ok else " (with errors)"))
+        if again and not self._stop.is_set():
+            self._queue(drawer_id)
+
+    # ------------------------------------------------------------------
+    # Status
+    # ------------------------------------------------------------------
+
+    def status(self) -> dict:
+        """Queue depth and throughput so far."""
+        now = time.time()
+        running = sorted(self.scheduler.running)
+        with self._lock:
+            while self._finished and now - self._finished[0][0] > 24 * 3600:
+                self._finished.popleft()
+            last_hour = sum(1 for t, _ in self._finished if now - t <= 3600)
+            durations = [d for _, d in self._finished]
+            status = {
+                "updated_at": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+                "watching": os.path.abspath(self.unsorted_dir),
+                "mode": self.mode,
+                "queue": {
+                    "files_settling": len(self._settling),
+                    "drawers_waiting": len(self._queued) - len(running),
+                    "drawers_running": running,
+                },
+                "throughput": {
+                    "files_sorted": self.files_sorted,
+                    "drawers_done": self.done,
+                    "drawers_failed": self.failed,
+                    "drawers_last_hour": last_hour,
+                    "drawers_per_hour": round((self.done + self.failed) * 3600 / max(now - self.started_at, 1), 2),
+                    "avg_drawer_minutes": round(sum(durations) / len(durations) / 60, 1) if durations else None,
+                },
+            }
+        return status
+
+    def report(self) -> None:
+        """Log the status line and write the status file."""
+        status = self.status()
+        queue, throughput = status["queue"], status["throughput"]
+        avg = throughput["avg_drawer_minutes"]
+        log(f"watch: {queue['files_settling']} file(s) settling, {queue['drawers_waiting']} drawer(s) waiting, "
+            f"{len(queue['drawers_running'])} running | {throughput['drawers_done']} done, "
+            f"{throughput['drawers_failed']} failed, {throughput['drawers_last_hour']} in the last hour"
+            + (f", {avg} min per drawer" if avg is not None else ""))
+        try:
+            tmp = self.status_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(status, f, indent=2)
+            os.replace(tmp, self.status_file)
+        except OSError as e:
+            log(f"Could not write {self.status_file}: {e}")
+
+    # ------------------------------------------------------------------
+    # Main loop
+    # ------------------------------------------------------------------
+
+    def stop(self) -> None:
+        """Ask the loop to end after the current scan."""
+        self._stop.set()
+
+    def run(self) -> None:
+        """
+        Watch until interrupted (Ctrl+C or SIGTERM) or stop() is called.
+        Running drawers are finished first; queued ones are left for a later run.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        watch = None
+        if self.settings["mode"] in ("auto", "inotify"):
+            try:
+                watch = InotifyWatch(self.unsorted_dir)
+                self.mode = "inotify"
+            except OSError as e:
+                if self.settings["mode"] == "inotify":
+                    raise
+                log(f"inotify unavailable ({e}); polling every {self.settings['poll_seconds']}s")
+
+        log(f"Watching {self.unsorted_dir} ({self.mode}, rescan every {self.settings['poll_seconds']}s, "
+            f"files settle for {self.settings['settle_seconds']}s); press Ctrl+C to stop")
+        next_report = 0.0
+        track_queue("watch", lambda: {"files_settling": len(self._settling)})
+        try:
+            while not self._stop.is_set():
+                ready = self._ready_files()
+                if ready:
+                    with self._lock:
+                        self.files_sorted += len(ready)
+                    for drawer_id in discover_and_sort_drawers(self.config, ready):
+                        self._queue(drawer_id)
+                if time.time() >= next_report:
+                    self.report()
+                    next_report = time.time() + self.settings["status_seconds"]
+                if watch is not None:
+                    watch.wait(self._next_wait())
+                else:
+                    self._stop.wait(self._next_wait())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log("Stopping watch")
+            self._stop.set()
+            if watch is not None:
+                watch.close()
+            with self._lock:
+                waiting = [d for d in self._queued if d not in self.scheduler.running]
+            if waiting:
+                log(f"Not starting queued drawers (already sorted; run process_images.py to finish them): "
+                    f"{', '.join(waiting)}")
+            if self.scheduler.running:
+                log(f"Waiting for running drawers to finish: {', '.join(sorted(self.scheduler.running))}")
+            self.scheduler.shutdown(cancel_waiting=True)
+            untrack_queue("watch")
+            self.report()
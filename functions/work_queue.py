@@ -0,0 +1,408 @@
+"""
+work_queue.py
+
+A work queue kept as plain files on the filesystem that holds drawers/, so
+several nodes can process one collection without a broker
+(process_images.py --enqueue / --worker / --queue-status).
+
+Each unit of work is one step (or fused stage) of one drawer, stored as a
+JSON file that moves between four folders under the queue directory:
+
+    pending/   waiting to be leased
+    leased/    being run; the file name carries the worker id
+    done/      finished
+    failed/    gave up after max_attempts (or an earlier step of the drawer did)
+
+Every state change is a rename, which is atomic on local and network
+filesystems: of several workers renaming the same pending file only one
+succeeds, and the others move on. A unit is only leased once the previous
+step of its drawer is in done/, so a drawer's steps keep their order while
+different drawers run on different nodes at the same time. One drawer is
+therefore only ever written by one worker, which keeps its manifest and
+mask containers single-writer.
+
+Leases are kept alive by touching the leased file every heartbeat_seconds.
+A unit whose file has not been touched for lease_seconds (worker killed,
+node lost) is moved back to pending by whichever worker notices first and
+counts as a failed attempt. A step that raises goes back to pending until it
+has failed max_attempts times; then it and the rest of its drawer's steps go
+to failed/. Lease ages compare file times with the local clock, so node
+clocks must roughly agree (NTP); keep lease_seconds well above the skew.
+
+Steps skip outputs that already exist, so a unit that runs twice (e.g. a
+worker that lost its lease but finished anyway) does no harm.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from logging_utils import log
+from functions.metrics import RETRIES
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+def worker_id() -> str:
+    """Identifier of this worker process: <host>-<pid>."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def unit_name(stamp: str, drawer_id: str, index: int, step: str) -> str:
+    return f"{stamp}__{drawer_id}__{index:02d}_{step}"
+
+
+def parse_unit_name(name: str) -> tuple:
+    """(stamp, drawer_id, index, step) of a unit file name without extension."""
+    stamp, rest = name.split("__", 1)
+    drawer_id, tail = rest.rsplit("__", 1)
+    index, step = tail.split("_", 1)
+    return stamp, drawer_id, int(index), step
+
+
+class WorkQueue:
+    """
+    The queue directory and the operations on it.
+
+    Args:
+        directory: Queue directory (created if missing)
+        settings:  config.queue_settings
+    """
+
+    def __init__(self, directory: str, settings: Dict):
+        self.directory = directory
+        self.settings = settings
+        for state in STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    # ------------------------------------------------------------------
+    # Files
+    # ------------------------------------------------------------------
+
+    def _dir(self, state: str) -> str:
+        return os.path.join(self.directory, state)
+
+    def _names(self, state: str) -> List[str]:
+        """Unit files in a state folder, oldest first (hidden in-progress files excluded)."""
+        try:
+            return sorted(f for f in os.listdir(self._dir(state)) if f.endswith(".json") and not f.startswith("."))
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _base(filename: str) -> str:
+        """Unit name of a file in any state (leased files end in @<worker>.json)."""
+        return filename[:-len(".json")].split("@", 1)[0]
+
+    def _move(self, src: str, state: str, update: Optional[Callable[[dict], None]] = None) -> Optional[dict]:
+        """
+        Move a unit file to a state folder, optionally changing its contents.
+
+        The file is first renamed to a hidden name in the target folder, which
+        claims it (a concurrent move of the same file fails), then rewritten
+        and renamed to its final name. Returns the unit, or None if another
+        worker moved the file first.
+        """
+        name = self._base(os.path.basename(src))
+        claimed = os.path.join(self._dir(state), f".{name}.{uuid.uuid4().hex[:8]}")
+        try:
+            os.rename(src, claimed)
+        except FileNotFoundError:
+            return None
+        with open(claimed) as f:
+            unit = json.load(f)
+        if update:
+            update(unit)
+            with open(claimed, "w") as f:
+                json.dump(unit, f, indent=2)
+        os.rename(claimed, os.path.join(self._dir(state), f"{name}.json"))
+        return unit
+
+    # ------------------------------------------------------------------
+    # Coordinator
+    # ------------------------------------------------------------------
+
+    def enqueue(self, drawer_id: str, steps: List[str], members: Optional[Dict[str, List[str]]] = None) -> bool:
+        """
+        Add one unit per step of a drawer. Returns False (and adds nothing) if
+        the drawer still has pending or leased units; done and failed units of
+        earlier enqueues are replaced.
+
+        members maps grouped stages (e.g. tray_stage) to the steps they run;
+        they are stored in the unit so every worker runs the same ones.
+        """
+        for state in ("pending", "leased"):
+            if any(parse_unit_name(self._base(f))[1] == drawer_id for f in self._names(state)):
+                log(f"{drawer_id} is already queued")
+                return False
+        for state in ("done", "failed"):
+            for f in self._names(state):
+                if parse_unit_name(self._base(f))[1] == drawer_id:
+                    os.remove(os.path.join(self._dir(state), f))
+
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        names = [unit_name(stamp, drawer_id, i, step) for i, step in enumerate(steps)]
+        now = time.time()
+        for i, (name, step) in enumerate(zip(names, steps)):
+            unit = {
+                "drawer": drawer_id,
+                "step": step,
+                "members": (members or {}).get(step),
+                "after": names[i - 1] if i else None,
+                "attempts": 0,
+                "errors": [],
+                "enqueued_at": now,
+            }
+            tmp = os.path.join(self._dir("pending"), f".{name}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(unit, f, indent=2)
+            os.rename(tmp, os.path.join(self._dir("pending"), f"{name}.json"))
+        return True
+
+    def requeue_failed(self) -> int:
+        """Move every failed unit back to pending with its attempts reset. Returns the count."""
+        def reset(unit):
+            unit["attempts"] = 0
+        return sum(1 for f in self._names("failed")
+                   if self._move(os.path.join(self._dir("failed"), f), "pending", reset) is not None)
+
+    def counts(self) -> Dict[str, int]:
+        """Number of units in each state."""
+        return {state: len(self._names(state)) for state in STATES}
+
+    def status(self) -> Dict:
+        """Unit counts per state, per drawer, and the current leases with their age."""
+        now = time.time()
+        counts, drawers, leases = {}, {}, []
+        for state in STATES:
+            names = self._names(state)
+            counts[state] = len(names)
+            for f in names:
+                _, drawer_id, _, step = parse_unit_name(self._base(f))
+                drawers.setdefault(drawer_id, {s: 0 for s in STATES})[state] += 1
+                if state == "leased":
+                    try:
+                        age = now - os.stat(os.path.join(self._dir(state), f)).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    leases.append({"drawer": drawer_id, "step": step,
+                                   "worker": f[:-len(".json")].split("@", 1)[1], "heartbeat_age": age})
+        return {"counts": counts, "drawers": drawers, "leases": leases}
+
+    # ------------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------------
+
+    def reclaim_expired(self) -> int:
+        """Move leases whose heartbeat is older than lease_seconds back to pending (or failed)."""
+        reclaimed = 0
+        now = time.time()
+        for f in self._names("leased"):
+            path = os.path.join(self._dir("leased"), f)
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age <= self.settings["lease_seconds"]:
+                continue
+            owner = f[:-len(".json")].split("@", 1)[1]
+            if self._retry_or_fail(path, f"lease of {owner} expired ({age:.0f}s without heartbeat)"):
+                reclaimed += 1
+        return reclaimed
+
+    def lease(self, worker: str, resources: Optional[set] = None,
+              resource_of: Callable[[str], str] = lambda step: "cpu") -> Optional[tuple]:
+        """
+        Lease the oldest runnable unit: pending, its previous step done, and
+        (if resources is given) of one of those resource classes.
+
+        Returns:
+            (leased path, unit) or None if nothing is runnable
+        """
+        done = {self._base(f) for f in self._names("done")}
+        for f in self._names("pending"):
+            name = self._base(f)
+            step = parse_unit_name(name)[3]
+            if resources and resource_of(step) not in resources:
+                continue
+            src = os.path.join(self._dir("pending"), f)
+            try:
+                with open(src) as fh:
+                    unit = json.load(fh)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if unit["after"] and unit["after"] not in done:
+                continue
+            leased = os.path.join(self._dir("leased"), f"{name}@{worker}.json")
+            try:
+                # Touch first so the lease starts with a fresh heartbeat
+                os.utime(src)
+                os.rename(src, leased)
+            except FileNotFoundError:
+                continue
+            return leased, unit
+        return None
+
+    @staticmethod
+    def heartbeat(leased: str) -> bool:
+        """Renew a lease. Returns False if it was lost (reclaimed by another worker)."""
+        try:
+            os.utime(leased)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, leased: str, worker: str, seconds: float) -> bool:
+        """Move a leased unit to done. Returns False if the lease was lost meanwhile."""
+        def finish(unit):
+            unit["attempts"] += 1
+            unit.update(worker=worker, finished_at=time.time(), seconds=round(seconds, 1))
+        return self._move(leased, "done", finish) is not None
+
+    def release(self, leased: str) -> bool:
+        """Give a leased unit back to pending without counting an attempt."""
+        return self._move(leased, "pending") is not None
+
+    def has_work(self, resources: Optional[set] = None,
+                 resource_of: Callable[[str], str] = lambda step: "cpu") -> bool:
+        """True while units are leased or pending (of the given resource classes)."""
+        if self._names("leased"):
+            return True
+        return any(not resources or resource_of(parse_unit_name(self._base(f))[3]) in resources
+                   for f in self._names("pending"))
+
+    def fail(self, leased: str, error: str) -> bool:
+        """Record a failed attempt of a leased unit. Returns False if the lease was lost meanwhile."""
+        return self._retry_or_fail(leased, error)
+
+    def _retry_or_fail(self, path: str, error: str) -> bool:
+        """Put a leased unit back in pending, or in failed (with its drawer's later steps) once out of attempts."""
+        try:
+            with open(path) as f:
+                attempts = json.load(f)["attempts"] + 1
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        def record(unit):
+            unit["attempts"] += 1
+            unit["errors"].append(error)
+
+        exhausted = attempts >= self.settings["max_attempts"]
+        unit = self._move(path, "failed" if exhausted else "pending", record)
+        if unit is None:
+            return False
+        if not exhausted:
+            log(f"{unit['drawer']} {unit['step']}: {error}; will retry (attempt {attempts}/{self.settings['max_attempts']})")
+            RETRIES.inc(operation="queue_unit")
+            return True
+
+        log(f"{unit['drawer']} {unit['step']}: {error}; giving up after {attempts} attempts")
+        failed_name = self._base(os.path.basename(path))
+
+        def skipped(later):
+            later["errors"].append(f"not run: {unit['step']} failed")
+        for f in self._names("pending"):
+            if parse_unit_name(self._base(f))[:2] == parse_unit_name(failed_name)[:2]:
+                self._move(os.path.join(self._dir("pending"), f), "failed", skipped)
+        return True
+
+
+class Heartbeat:
+    """Touch a leased unit every interval until stopped; `lost` is set if the lease disappears."""
+
+    def __init__(self, leased: str, interval: float):
+        self.leased = leased
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not WorkQueue.heartbeat(self.leased):
+                self.lost = True
+                log(f"Lost the lease on {os.path.basename(self.leased)}; another worker may run it again")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue: WorkQueue, run_step: Callable[[str, str], None], resources: Optional[set] = None,
+               resource_of: Callable[[str], str] = lambda step: "cpu", until_empty: bool = False) -> Dict[str, int]:
+    """
+    Lease and run units until interrupted (or, with until_empty, until no
+    pending or leased units are left).
+
+    Args:
+        run_step:    Callable(drawer_id, step, members) that runs one step
+                     (members: steps of a grouped stage, None for other steps)
+        resources:   Only lease steps of these resource classes (None = all)
+        resource_of: Callable(step) -> resource class
+        until_empty: Exit once the queue has nothing left to run
+
+    Returns:
+        Counts of units done, failed and lost by this worker
+    """
+    worker = worker_id()
+    settings = queue.settings
+    counts = {"done": 0, "failed": 0, "lost": 0}
+    log(f"Worker {worker} on {queue.directory}"
+        + (f" (resources: {', '.join(sorted(resources))})" if resources else ""))
+
+    idle_logged = False
+    path = None
+    try:
+        while True:
+            reclaimed = queue.reclaim_expired()
+            if reclaimed:
+                log(f"Reclaimed {reclaimed} expired lease(s)")
+            leased = queue.lease(worker, resources, resource_of)
+            if leased is None:
+                if until_empty and not queue.has_work(resources, resource_of):
+                    log("Queue is empty")
+                    break
+                if not idle_logged:
+                    log("Nothing to run; waiting for work")
+                    idle_logged = True
+                time.sleep(settings["poll_seconds"])
+                continue
+
+            idle_logged = False
+            path, unit = leased
+            drawer_id, step = unit["drawer"], unit["step"]
+            members = f" ({', '.join(unit['members'])})" if unit.get("members") else ""
+            log(f"[{drawer_id}] Running {step}{members} (attempt {unit['attempts'] + 1})")
+            start = time.time()
+            error = None
+            with Heartbeat(path, settings["heartbeat_seconds"]) as beat:
+                try:
+                    run_step(drawer_id, step, unit.get("members"))
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    log(f"[{drawer_id}] Error in {step}: {error}")
+
+            if error is None and queue.complete(path, worker, time.time() - start):
+                counts["done"] += 1
+            elif error is not None and queue.fail(path, error):
+                counts["failed"] += 1
+            else:
+                counts["lost"] += 1
+                if not beat.lost:
+                    log(f"[{drawer_id}] {step} was reclaimed by another worker before it finished")
+            path = None
+    except KeyboardInterrupt:
+        log("Stopping worker")
+        if path is not None and queue.release(path):
+            log(f"Returned {os.path.basename(path)} to the queue")
+    return counts
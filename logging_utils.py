@@ -1,10 +1,81 @@
+"""
+logging_utils.py
+
+Console output for the pipeline: log(), log_found(), log_progress() and
+StepTimer.
+
+Once start_progress() has been called (process_images.py does this for
+processing runs), progress and messages go through one aggregator in the
+main process instead of being printed by whoever calls them:
+
+- Worker processes put their log_progress() and log() calls on a
+  multiprocessing queue; threads of the main process hand them over
+  directly. Nothing is printed per item.
+- The aggregator counts finished items per drawer and step and redraws
+  one progress line per running step (count, percentage, rate and ETA)
+  every refresh_seconds. Progress is tagged with the drawer of the
+  StepTimer it runs under, which worker processes and threads started with
+  worker_setup() take over, so drawers running the same step at once keep
+  separate counts. When stdout is not a terminal (e.g. redirected to a
+  file for an overnight job) it prints a plain line every plain_seconds
+  instead. Messages are printed between redraws, so lines from different
+  workers no longer run into each other.
+- Every progress call is also written to a JSON lines event log (one line
+  per item: time, drawer, step, process, item number, total and message).
+
+Process pools started before start_progress(), or created with the spawn
+method without worker_setup(), fall back to printing directly.
+"""
+
+import atexit
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
 import time
-from typing import Optional
+from typing import Dict, Optional
+
+
+_progress = {
+    "aggregator": None,   # ProgressAggregator, in the main process only
+    "queue": None,        # multiprocessing queue workers send events on
+    "main_pid": None,     # process that owns the aggregator
+    "line_open": False,   # without the aggregator: a counter was printed in place
+}
+
+# Drawer the current thread reports progress for (set by StepTimer and worker_setup)
+_scope = threading.local()
+
+
+def current_drawer() -> Optional[str]:
+    """Drawer whose step this thread is working on, if any."""
+    return getattr(_scope, "drawer", None)
+
+
+def set_drawer(drawer: Optional[str]) -> None:
+    """Count this thread's progress for a drawer (for threads not started through worker_setup)."""
+    _scope.drawer = drawer
+
+
+def _send(event: tuple) -> bool:
+    """Pass an event to the aggregator. Returns False if there is none to pass it to."""
+    if _progress["main_pid"] is None:
+        return False
+    if os.getpid() == _progress["main_pid"]:
+        _progress["aggregator"].handle(event)
+        return True
+    if _progress["queue"] is not None:
+        _progress["queue"].put(event)
+        return True
+    return False
 
 
 def log(message: str) -> None:
     """Print a message to the console."""
-    print(message)
+    if not _send(("log", message)):
+        print(message)
 
 
 def log_found(item_type: str, count: int) -> None:
@@ -12,40 +83,286 @@ def log_found(item_type: str, count: int) -> None:
     log(f"Found {count} {item_type} to process")
 
 
-def log_progress(step: str, current: int, total: int, message: Optional[str] = None) -> None:
+def log_progress(step: str, current: int, total: Optional[int], message: Optional[str] = None) -> None:
     """
-    Show a progress counter that updates in place on the same line.
-    Moves to a new line when the last item is reached.
+    Report one finished (or skipped) item of a step.
+
+    With the aggregator running, the progress line is redrawn at a fixed
+    rate from the number of items reported, so items may finish in any
+    order. Without it, the counter is printed in place on the same line and
+    moves to a new line when the last item is reached.
+    Pass total=None when the number of items is not known in advance.
     """
+    if _send(("progress", current_drawer(), step, current, total, message, os.getpid(), time.time())):
+        return
+    counter = f"{current}/{total}" if total is not None else f"{current}"
     if message:
-        print(f"\rProcessing {current}/{total} - {message}", end="", flush=True)
+        print(f"\rProcessing {counter} - {message}", end="", flush=True)
     else:
-        print(f"\rProcessing {current}/{total}", end="", flush=True)
+        print(f"\rProcessing {counter}", end="", flush=True)
 
+    _progress["line_open"] = current != total
     if current == total:
         print()
 
 
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressAggregator:
+    """
+    Counts progress events per (drawer, step) and renders them at a fixed
+    rate. Use start_progress() rather than creating one directly.
+    """
+
+    def __init__(self, refresh_seconds: float = 0.5, plain_seconds: float = 30,
+                 event_log: Optional[str] = None, stream=None):
+        self.stream = stream or sys.stdout
+        self.interactive = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.refresh_seconds = refresh_seconds if self.interactive else plain_seconds
+        self.event_log = event_log
+        self.queue = multiprocessing.Queue()
+        self._steps: Dict[tuple, dict] = {}  # (drawer, step) -> done, total, message, started
+        self._events = []                   # event log lines not yet written
+        self._line_width = 0                # length of the progress line on screen
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    # Events
+    # ------------------------------------------------------------------
+
+    def handle(self, event: tuple) -> None:
+        if event[0] == "log":
+            with self._lock:
+                self._clear()
+                print(event[1], file=self.stream, flush=True)
+            return
+        _, drawer, step, current, total, message, pid, when = event
+        key = (drawer, step)
+        with self._lock:
+            if self.event_log:
+                self._events.append(json.dumps({"time": round(when, 3), "drawer": drawer, "step": step,
+                                                "pid": pid, "item": current, "total": total,
+                                                "message": message}))
+            state = self._steps.get(key)
+            if state is None:
+                state = self._steps[key] = {"done": 0, "started": when, "shown": 0.0}
+            state["done"] += 1
+            state["total"] = total
+            state["message"] = message
+            if total is not None and state["done"] >= total:
+                self._finish(key)
+
+    def _drain(self) -> None:
+        """Handle every event waiting on the queue."""
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            except (EOFError, OSError):
+                return
+            self.handle(event)
+
+    # ------------------------------------------------------------------
+    # Rendering
+    # ------------------------------------------------------------------
+
+    def _status(self, key: tuple, now: float) -> str:
+        state = self._steps[key]
+        done, total = state["done"], state["total"]
+        elapsed = max(now - state["started"], 1e-6)
+        rate = done / elapsed
+        drawer, step = key
+        name = f"{drawer}/{step}" if drawer else step
+        text = f"Processing {name} {done}/{total}" if total is not None else f"Processing {name} {done}"
+        if total:
+            text += f" ({100 * done / total:.0f}%)"
+        text += f" {rate:.1f}/s" if rate >= 1 else f" {elapsed / max(done, 1):.1f}s each"
+        if total and 0 < done < total:
+            text += f" ETA {_duration((total - done) / rate)}"
+        return text
+
+    def _clear(self) -> None:
+        """Remove the progress line so a message can be printed in its place."""
+        if self._line_width:
+            self.stream.write("\r" + " " * self._line_width + "\r")
+            self._line_width = 0
+
+    def _render(self) -> None:
+        now = time.time()
+        with self._lock:
+            active = [s for s in self._steps if self._steps[s]["done"] > self._steps[s]["shown"]
+                      or self.interactive]
+            if not active:
+                return
+            parts = []
+            for key in active:
+                status = self._status(key, now)
+                message = self._steps[key]["message"]
+                parts.append(f"{status} - {message}" if message and len(active) == 1 else status)
+                self._steps[key]["shown"] = self._steps[key]["done"]
+            line = " | ".join(parts)
+            if self.interactive:
+                padding = max(0, self._line_width - len(line))
+                self.stream.write("\r" + line + " " * padding)
+                self._line_width = len(line)
+                self.stream.flush()
+            else:
+                print(line, file=self.stream, flush=True)
+
+    def _finish(self, key: tuple) -> None:
+        """Print the final state of a step on its own line and stop showing it."""
+        status = self._status(key, time.time())
+        message = self._steps[key]["message"]
+        del self._steps[key]
+        self._clear()
+        print(f"{status} - {message}" if message else status, file=self.stream, flush=True)
+
+    def _write_events(self) -> None:
+        with self._lock:
+            lines, self._events = self._events, []
+        if lines:
+            try:
+                with open(self.event_log, "a") as f:
+                    f.write("\n".join(lines) + "\n")
+            except OSError as e:
+                self.handle(("log", f"Could not write {self.event_log}: {e}"))
+
+    def _run(self) -> None:
+        next_render = time.time() + self.refresh_seconds
+        while not self._stop.is_set():
+            timeout = max(0.0, next_render - time.time())
+            try:
+                event = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+            except (EOFError, OSError):
+                return
+            if event is not None:
+                self.handle(event)
+            if time.time() >= next_render:
+                self._render()
+                self._write_events()
+                next_render = time.time() + self.refresh_seconds
+
+    # ------------------------------------------------------------------
+    # Control
+    # ------------------------------------------------------------------
+
+    def flush(self, drawer: Optional[str] = None) -> None:
+        """
+        Handle queued events and end the open progress lines of one drawer's
+        step (at the end of the step), or every open line if drawer is None.
+        """
+        self._drain()
+        with self._lock:
+            for key in list(self._steps):
+                if drawer is None or key[0] == drawer:
+                    self._finish(key)
+        self._write_events()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+
+def start_progress(settings: Dict, event_log: Optional[str] = None) -> None:
+    """
+    Route progress and messages of this process and its workers through one
+    aggregator (resources.progress). Call before any process pool is created.
+
+    Args:
+        settings:  refresh_seconds, plain_seconds
+        event_log: JSON lines file for one event per item (None = no event log)
+    """
+    if _progress["aggregator"] is not None:
+        return
+    aggregator = ProgressAggregator(settings["refresh_seconds"], settings["plain_seconds"], event_log)
+    _progress.update(aggregator=aggregator, queue=aggregator.queue, main_pid=os.getpid())
+    aggregator.start()
+    atexit.register(stop_progress)
+
+
+def stop_progress() -> None:
+    """Print what is left and go back to printing directly."""
+    aggregator = _progress["aggregator"]
+    if aggregator is None or os.getpid() != _progress["main_pid"]:
+        return
+    aggregator.stop()
+    _progress.update(aggregator=None, queue=None, main_pid=None)
+
+
+def flush_progress(drawer: Optional[str] = None) -> None:
+    """End the open progress lines (only those of one drawer if given)."""
+    if _progress["aggregator"] is not None and os.getpid() == _progress["main_pid"]:
+        _progress["aggregator"].flush(drawer)
+    elif _progress["line_open"]:
+        print()
+        _progress["line_open"] = False
+
+
+def _attach_progress(progress_queue, main_pid, drawer) -> None:
+    _progress.update(queue=progress_queue, main_pid=main_pid)
+    _scope.drawer = drawer
+
+
+def worker_setup() -> Dict:
+    """
+    Keyword arguments for ProcessPoolExecutor or ThreadPoolExecutor that
+    connect its workers to the aggregator and tag their progress with the
+    drawer of the step creating the pool. Forked workers inherit the
+    connection anyway; this is what makes it work with the spawn start
+    method (macOS, Windows).
+    """
+    if _progress["queue"] is None or os.getpid() != _progress["main_pid"]:
+        return {}
+    return {"initializer": _attach_progress,
+            "initargs": (_progress["queue"], _progress["main_pid"], current_drawer())}
+
+
 class StepTimer:
     """
     Context manager (a 'with' block) that logs when a step starts,
     how long it took, and any errors that occurred.
 
+    With a drawer, progress reported inside the block is counted for that
+    drawer, and only its progress lines are ended when the block exits.
+
     Usage:
-        with StepTimer("find_trays"):
+        with StepTimer("find_trays_drawer_01", drawer="drawer_01"):
             ... do the work ...
     """
 
-    def __init__(self, step_name: str):
+    def __init__(self, step_name: str, drawer: Optional[str] = None):
         self.step_name = step_name
+        self.drawer = drawer
         self.start_time = None
+        self._outer_drawer = None
 
     def __enter__(self):
         self.start_time = time.time()
+        self._outer_drawer = current_drawer()
+        if self.drawer is not None:
+            _scope.drawer = self.drawer
         log(f"Starting {self.step_name}...")
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        flush_progress(self.drawer)
+        _scope.drawer = self._outer_drawer
         if self.start_time:
             duration = time.time() - self.start_time
             log(f"{self.step_name} complete! Total time: {duration:.2f}s")
@@ -3,9 +3,12 @@ import time
 import argparse
 import shutil
 import csv
+import json
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from config import DrawerDissectConfig
-from logging_utils import log, StepTimer
+from logging_utils import log, StepTimer, start_progress
 from functions.model_runner import build_model_runner
 from functions.drawer_management import (
     get_drawers_to_process, validate_drawer_structure,
@@ -20,15 +23,29 @@ from functions.crop_labels import crop_labels
 from functions.infer_trays import infer_tray_images
 from functions.crop_specimens import crop_specimens_from_trays
 from functions.specimen_guide import create_specimen_guides
+from functions.tray_stage import run_shared_tray_stage, run_fused_tray_stage
+from functions.mask_stage import run_fused_mask_stage, MASK_STAGE_STEPS
+from functions.cutout_stage import run_fused_cutout_stage, CUTOUT_STAGE_STEPS
+from functions.streaming import stream_drawer, STREAM_STEPS
+from functions.drawer_scheduler import DrawerScheduler, STEP_RESOURCE_CLASS
+from functions.watch_daemon import WatchDaemon
+from functions.work_queue import WorkQueue, run_worker
+from functions.manifest import manifest_for, open_snapshot, item_id, parent_item, MANIFEST_NAME, SQLITE_SIDECARS
+from functions.mask_store import iter_masks, CONTAINER_NAME as MASK_CONTAINER_NAME
+from functions import resource_scheduler
 from functions.infer_beetles import infer_beetles
 from functions.create_masks import create_masks
 from functions.multipolygon_fixer import fix_mask
-from functions.measure import generate_csv_with_measurements
+from functions.measure import generate_csv_with_measurements, measured_ids, discard_measurements
 from functions.censor_background import censor_background
 from functions.infer_pins import infer_pins
 from functions.create_pinmask import create_pinmask
 from functions.create_transparency import create_transparency
 from functions.ocr_header import process_image_folder
+from functions.llm_client import meter_usage
+from functions.instrumentation import start_run, step_record, profile_step
+from functions import metrics
+from functions.metrics import track_queue
 from functions.ocr_specimenlabels import process_tray_context
 from functions.merge_data import merge_data
 
@@ -45,9 +62,166 @@ def _model_param(args_val, config, model_key: str, param: str, default: float =
     return default
 
 
-def run_step_for_drawer(step, config, drawer_id, args):
-    """Run a single pipeline step for a single drawer."""
-    with StepTimer(f"{step}_{drawer_id}"):
+def _mask_store_enabled(config) -> bool:
+    """True when binary masks go to per-tray containers (processing.mask_storage: "store")."""
+    return config.processing_flags.get("mask_storage", "png") == "store"
+
+
+def _step_params(config, args) -> str:
+    """Settings a step run depends on, as recorded in the drawer manifest."""
+    model_args = {k: v for k, v in sorted(vars(args).items()) if k.endswith(("_confidence", "_overlap"))}
+    return json.dumps({"processing": config.processing_flags, "deployment": config.deployment,
+                       "models": model_args}, sort_keys=True, default=str)
+
+
+def _model_identity(config, model_key: str):
+    """What identifies the model behind model_key: its Roboflow project and version, or its weights file."""
+    if config.deployment == "roboflow":
+        return {k: v for k, v in config.roboflow_models.get(model_key, {}).items()
+                if k not in ("confidence", "overlap")}
+    try:
+        weights = config.get_local_weights_path(model_key)
+        stat = os.stat(weights)
+    except (FileNotFoundError, OSError):
+        return None
+    return {"weights": weights, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _derivation_params(config, args, key) -> str:
+    """Settings the files of a derived folder depend on besides their input files."""
+    settings = {}
+    if key in DIR_MODELS:
+        model_key, arg_prefix, uses_overlap = DIR_MODELS[key]
+        settings = {
+            "deployment": config.deployment,
+            "model": _model_identity(config, model_key),
+            "confidence": _model_param(getattr(args, f"{arg_prefix}_confidence", None),
+                                       config, model_key, "confidence"),
+        }
+        if uses_overlap:
+            settings["overlap"] = _model_param(getattr(args, f"{arg_prefix}_overlap", None),
+                                               config, model_key, "overlap")
+    elif key == "measurements":
+        settings = {
+            "engine": config.processing_flags.get("measurement_engine", "compat"),
+            "source": config.processing_flags.get("measurement_source", "raster"),
+        }
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+def _derived_outputs(step):
+    """Output folders of a step that it makes (not just rewrites), with the folders they derive from."""
+    for key in STEP_DIRS[step][1]:
+        if key in DERIVED_DIRS and step in DERIVED_DIRS[key][1]:
+            yield key, DERIVED_DIRS[key][0]
+
+
+def _invalidate_outputs(manifest, config, drawer_id, step, args):
+    """Remove the step's outputs whose inputs or settings changed since they were made."""
+    for key, inputs in _derived_outputs(step):
+        stale_rows = manifest.invalidate(key, inputs, _derivation_params(config, args, key))
+        if stale_rows and key == "measurements":
+            csv_path = os.path.join(config.get_drawer_directory(drawer_id, "measurements"), "measurements.csv")
+            removed = discard_measurements(csv_path, stale_rows)
+            log(f"measurements: removed {removed} out-of-date row(s); they are measured again where the mask remains")
+
+
+def _record_outputs(manifest, config, drawer_id, step, args, run_id):
+    """Record the inputs and settings the step's outputs were made from."""
+    for key, inputs in _derived_outputs(step):
+        rows = None
+        if key == "measurements":
+            rows = measured_ids(os.path.join(config.get_drawer_directory(drawer_id, "measurements"),
+                                             "measurements.csv"))
+        manifest.record(key, inputs, _derivation_params(config, args, key), run_id,
+                        rows=rows, drawer_level=key in DRAWER_LEVEL_DIRS)
+
+
+def run_step_for_drawer(step, config, drawer_id, args, members=None):
+    """
+    Run a single pipeline step for a single drawer. For a grouped stage,
+    members are the steps it runs (default: stage_members of the steps given
+    on the command line).
+
+    With processing.manifest on, the run and its outputs are recorded in the
+    drawer's manifest, local CPU steps that are up to date since their last
+    run are skipped, and outputs whose inputs or settings changed since they
+    were made are removed first so the step makes them again (see
+    functions/manifest.py). Each run also records how many items it
+    processed and, for transcription steps, its token usage (see --plan).
+    """
+    if not config.processing_flags.get("manifest", True) or step not in STEP_DIRS:
+        _run_step(step, config, drawer_id, args, members)
+        return
+
+    manifest = manifest_for(config.get_drawer_path(drawer_id), config.get_drawer_directories(drawer_id))
+    if (step in MANIFEST_SKIP_STEPS and not getattr(args, "rerun", False)
+            and manifest.up_to_date(step, _step_params(config, args), *STEP_DIRS[step])):
+        log(f"{step} is up to date for {drawer_id} (nothing changed since its last run)")
+        return
+
+    _run_recorded(manifest, config, drawer_id, args, [step],
+                  lambda: _run_step(step, config, drawer_id, args, members))
+
+
+def _run_recorded(manifest, config, drawer_id, args, steps, run):
+    """
+    Call run() as a run of each of the steps in the drawer manifest (one
+    step, or the steps of a streamed section, which run together).
+
+    Outputs of the steps whose inputs or settings changed are removed first.
+    After a successful run the steps' outputs, the status summary and the
+    number of items each step processed are recorded; a failed run is only
+    marked failed, and the original error propagates.
+    """
+    params = _step_params(config, args)
+    run_ids = {step: manifest.begin(step, params, *STEP_DIRS[step]) for step in steps}
+    affected = list(dict.fromkeys(s for step in steps for s in _status_steps(step)))
+    usage = None
+    try:
+        for step in steps:
+            _invalidate_outputs(manifest, config, drawer_id, step, args)
+        before = _drawer_status(config, drawer_id, manifest, steps=affected)
+        if any(STEP_RESOURCE_CLASS.get(step) == "llm" for step in steps):
+            with meter_usage() as meter:
+                try:
+                    run()
+                finally:
+                    usage = meter.to_dict()
+        else:
+            run()
+    except BaseException:
+        # Outputs of a failed run are not recorded as derivations, and a
+        # failure to mark the run must not hide the step's own error
+        for step, run_id in run_ids.items():
+            try:
+                manifest.finish(run_id, step, *STEP_DIRS[step], ok=False)
+            except Exception as e:
+                log(f"Could not record the failed {step} run of {drawer_id} in its manifest: {e}")
+        raise
+
+    for step, run_id in run_ids.items():
+        manifest.finish(run_id, step, *STEP_DIRS[step])
+        _record_outputs(manifest, config, drawer_id, step, args, run_id)
+    after = _update_status(manifest, config, drawer_id, affected)
+    for step, run_id in run_ids.items():
+        manifest.record_work(run_id, _units_done(step, before, after),
+                             usage if STEP_RESOURCE_CLASS.get(step) == "llm" else None)
+
+
+def _profiled(args, drawer_id, step):
+    """--profile: profile this step run (see instrumentation.profile_step)."""
+    mode = getattr(args, "profile", None)
+    return profile_step(drawer_id, step, mode) if mode else nullcontext()
+
+
+def _run_step(step, config, drawer_id, args, members=None):
+    """Run a single pipeline step for a single drawer (members: steps of a grouped stage)."""
+    if step in STAGE_MEMBERS and members is None:
+        members = stage_members(step, determine_steps(args), config)
+    with StepTimer(f"{step}_{drawer_id}", drawer=drawer_id), \
+            step_record(step, drawer_id, config.get_drawer_path(drawer_id)), \
+            _profiled(args, drawer_id, step):
         mem = config.get_memory_config(step)
         sequential = args.sequential if args.sequential is not None else mem.get("sequential", False)
         max_workers = args.max_workers if args.max_workers is not None else mem.get("max_workers")
@@ -121,6 +295,26 @@ def run_step_for_drawer(step, config, drawer_id, args):
                 config.get_drawer_directory(d, "specimens"),
             )
 
+        elif step == "tray_stage":
+            mode = config.processing_flags.get("tray_stage", "separate")
+            tray_dirs = (
+                config.get_drawer_directory(d, "trays"),
+                config.get_drawer_directory(d, "resized_trays"),
+                config.get_drawer_directory(d, "resized_trays_coordinates"),
+                config.get_drawer_directory(d, "label_coordinates"),
+                config.get_drawer_directory(d, "labels"),
+                config.get_drawer_directory(d, "specimens"),
+            )
+            if mode == "fused":
+                run_fused_tray_stage(
+                    *tray_dirs, config.get_drawer_directory(d, "guides"),
+                    steps=members, sequential=sequential, max_workers=max_workers,
+                )
+            else:
+                run_shared_tray_stage(
+                    *tray_dirs, steps=members, sequential=sequential, max_workers=max_workers,
+                )
+
         elif step == "create_traymaps":
             create_specimen_guides(
                 config.get_drawer_directory(d, "resized_trays"),
@@ -140,16 +334,39 @@ def run_step_for_drawer(step, config, drawer_id, args):
             create_masks(
                 config.get_drawer_directory(d, "mask_coordinates"),
                 config.get_drawer_directory(d, "mask_png"),
+                store=_mask_store_enabled(config),
             )
 
         elif step == "fix_masks":
-            fix_mask(config.get_drawer_directory(d, "mask_png"))
+            fix_mask(
+                config.get_drawer_directory(d, "mask_png"),
+                sequential=sequential, max_workers=max_workers,
+                only_changed=config.processing_flags.get("fix_masks_only_changed", True),
+            )
 
         elif step == "measure_specimens":
             generate_csv_with_measurements(
                 config.get_drawer_directory(d, "mask_png"),
                 config.get_drawer_directory(d, "measurements"),
                 visualization_mode=config.processing_flags.get("measurement_visualizations", "on"),
+                length_engine=config.processing_flags.get("measurement_engine", "compat"),
+                polygon_dir=(config.get_drawer_directory(d, "mask_coordinates")
+                             if config.processing_flags.get("measurement_source", "raster") == "polygon" else None),
+                sequential=sequential, max_workers=max_workers,
+                chunk_size=mem.get("chunk_size", 64),
+            )
+
+        elif step == "mask_stage":
+            run_fused_mask_stage(
+                config.get_drawer_directory(d, "mask_coordinates"),
+                config.get_drawer_directory(d, "mask_png"),
+                config.get_drawer_directory(d, "measurements"),
+                steps=members, sequential=sequential, max_workers=max_workers,
+                length_engine=config.processing_flags.get("measurement_engine", "compat"),
+                polygon_source=config.processing_flags.get("measurement_source", "raster") == "polygon",
+                visualization_mode=config.processing_flags.get("measurement_visualizations", "on"),
+                only_changed=config.processing_flags.get("fix_masks_only_changed", True),
+                store=_mask_store_enabled(config),
             )
 
         elif step == "censor_background":
@@ -159,6 +376,18 @@ def run_step_for_drawer(step, config, drawer_id, args):
                 config.get_drawer_directory(d, "no_background"),
             )
 
+        elif step == "cutout_stage":
+            run_fused_cutout_stage(
+                config.get_drawer_directory(d, "specimens"),
+                config.get_drawer_directory(d, "mask_png"),
+                config.get_drawer_directory(d, "no_background"),
+                config.get_drawer_directory(d, "full_masks"),
+                config.get_drawer_directory(d, "transparencies"),
+                config.get_drawer_directory(d, "whitebg_specimens"),
+                steps=members,
+                sequential=sequential, max_workers=max_workers, batch_size=batch_size,
+            )
+
         elif step == "outline_pins":
             infer_pins(
                 config.get_drawer_directory(d, "no_background"),
@@ -174,6 +403,7 @@ def run_step_for_drawer(step, config, drawer_id, args):
                 config.get_drawer_directory(d, "mask_png"),
                 config.get_drawer_directory(d, "pin_coordinates"),
                 config.get_drawer_directory(d, "full_masks"),
+                store=_mask_store_enabled(config),
             )
 
         elif step == "create_transparency":
@@ -251,6 +481,75 @@ def run_step_for_drawer(step, config, drawer_id, args):
             )
 
 
+def run_drawer_streaming(config, drawer_id, drawer_steps, args):
+    """
+    Run a drawer's steps with the streamable middle section (resize_trays
+    through create_masks) executed as overlapping stages instead of
+    one-step-at-a-time barriers. Steps before and after it run as usual.
+    """
+    streamed = [s for s in drawer_steps if s in STREAM_STEPS]
+    if not streamed:
+        for step in drawer_steps:
+            log(f"Running {step} for {drawer_id}")
+            run_step_for_drawer(step, config, drawer_id, args)
+        return
+
+    first = ALL_STEPS.index(streamed[0])
+    before = [s for s in drawer_steps if s not in STREAM_STEPS and ALL_STEPS.index(s) < first]
+    after = [s for s in drawer_steps if s not in STREAM_STEPS and s not in before]
+
+    for step in before:
+        log(f"Running {step} for {drawer_id}")
+        run_step_for_drawer(step, config, drawer_id, args)
+
+    log(f"Streaming {', '.join(streamed)} for {drawer_id}")
+    if config.processing_flags.get("manifest", True):
+        # Recorded like the steps it replaces, so their derivations, skip
+        # checks and the cached status stay current
+        manifest = manifest_for(config.get_drawer_path(drawer_id), config.get_drawer_directories(drawer_id))
+        _run_recorded(manifest, config, drawer_id, args, streamed,
+                      lambda: _run_streamed(config, drawer_id, streamed, args))
+    else:
+        _run_streamed(config, drawer_id, streamed, args)
+
+    for step in after:
+        log(f"Running {step} for {drawer_id}")
+        run_step_for_drawer(step, config, drawer_id, args)
+
+
+def _run_streamed(config, drawer_id, streamed, args):
+    """Run the streamable steps of a drawer as overlapping stages (see functions/streaming.py)."""
+    with StepTimer(f"stream_{drawer_id}", drawer=drawer_id), \
+            step_record("stream", drawer_id, config.get_drawer_path(drawer_id)), \
+            _profiled(args, drawer_id, "stream"):
+        runners, params = {}, {}
+        if "find_traylabels" in streamed:
+            runners["label"] = build_model_runner(config, "label")
+            params["label_confidence"] = _model_param(args.label_confidence, config, "label", "confidence")
+            params["label_overlap"] = _model_param(args.label_overlap, config, "label", "overlap")
+        if "find_specimens" in streamed:
+            runners["tray"] = build_model_runner(config, "tray")
+            params["tray_confidence"] = _model_param(args.tray_confidence, config, "tray", "confidence")
+            params["tray_overlap"] = _model_param(args.tray_overlap, config, "tray", "overlap")
+        if "outline_specimens" in streamed:
+            runners["mask"] = build_model_runner(config, "mask")
+            params["beetle_confidence"] = _model_param(args.beetle_confidence, config, "mask", "confidence")
+        params["mask_store"] = _mask_store_enabled(config)
+
+        settings = config.streaming_settings
+        dirs = {
+            key: config.get_drawer_directory(drawer_id, key)
+            for key in ("trays", "resized_trays", "resized_trays_coordinates", "label_coordinates",
+                        "labels", "specimens", "guides", "mask_coordinates", "mask_png")
+        }
+        stream_drawer(
+            dirs, streamed, runners, params,
+            cpu_workers=args.max_workers if args.max_workers is not None else settings["cpu_workers"],
+            inference_workers=settings["inference_workers"],
+            queue_size=settings["queue_size"],
+        )
+
+
 # ---------------------------------------------------------------------------
 # Argument parsing
 # ---------------------------------------------------------------------------
@@ -265,6 +564,87 @@ ALL_STEPS = [
     "transcribe_specimens", "merge_data",
 ]
 
+# Tray-level image steps that can share a single decode per tray (processing.tray_stage)
+TRAY_STAGE_STEPS = {
+    "shared": ("resize_trays", "crop_labels", "crop_specimens"),
+    "fused":  ("resize_trays", "crop_labels", "crop_specimens", "create_traymaps"),
+}
+
+# Folders each step (or grouped stage) reads and writes, by directories.drawer_subdirs key
+STEP_DIRS = {
+    "resize_drawers":       (["fullsize"], ["resized"]),
+    "find_trays":           (["resized"], ["coordinates"]),
+    "crop_trays":           (["fullsize", "resized", "coordinates"], ["trays"]),
+    "resize_trays":         (["trays"], ["resized_trays"]),
+    "find_traylabels":      (["resized_trays"], ["label_coordinates"]),
+    "crop_labels":          (["trays", "resized_trays", "label_coordinates"], ["labels"]),
+    "find_specimens":       (["resized_trays"], ["resized_trays_coordinates"]),
+    "crop_specimens":       (["trays", "resized_trays", "resized_trays_coordinates"], ["specimens"]),
+    "create_traymaps":      (["resized_trays", "resized_trays_coordinates"], ["guides"]),
+    "tray_stage":           (["trays", "resized_trays_coordinates", "label_coordinates"],
+                             ["resized_trays", "labels", "specimens", "guides"]),
+    "outline_specimens":    (["specimens"], ["mask_coordinates"]),
+    "create_masks":         (["mask_coordinates"], ["mask_png"]),
+    "fix_masks":            (["mask_png"], ["mask_png"]),
+    "measure_specimens":    (["mask_png", "mask_coordinates"], ["measurements"]),
+    "mask_stage":           (["mask_coordinates"], ["mask_png", "measurements"]),
+    "censor_background":    (["specimens", "mask_png"], ["no_background"]),
+    "outline_pins":         (["no_background"], ["pin_coordinates"]),
+    "create_pinmask":       (["mask_png", "pin_coordinates"], ["full_masks"]),
+    "create_transparency":  (["no_background", "full_masks"], ["transparencies", "whitebg_specimens"]),
+    "cutout_stage":         (["specimens", "mask_png", "full_masks"],
+                             ["no_background", "transparencies", "whitebg_specimens"]),
+    "transcribe_barcodes":  (["labels"], ["tray_level"]),
+    "transcribe_geocodes":  (["labels"], ["tray_level"]),
+    "transcribe_taxonomy":  (["labels"], ["tray_level"]),
+    "transcribe_specimens": (["resized_trays", "resized_trays_coordinates", "specimens", "tray_level"],
+                             ["tray_context"]),
+    "merge_data":           (["specimens", "measurements", "tray_level", "tray_context", "labels"], ["data"]),
+}
+
+# How the files of each folder are made, for content-based invalidation:
+# folder key -> (folders they are made from, steps that make them). Files are
+# matched to their inputs per tray or specimen (see functions/manifest.py);
+# fix_masks only rewrites masks, so it is not listed as making them.
+DERIVED_DIRS = {
+    "resized":                   (["fullsize"], {"resize_drawers"}),
+    "coordinates":               (["resized"], {"find_trays"}),
+    "trays":                     (["fullsize", "coordinates"], {"crop_trays"}),
+    "resized_trays":             (["trays"], {"resize_trays", "tray_stage"}),
+    "label_coordinates":         (["resized_trays"], {"find_traylabels"}),
+    "labels":                    (["trays", "label_coordinates"], {"crop_labels", "tray_stage"}),
+    "resized_trays_coordinates": (["resized_trays"], {"find_specimens"}),
+    "specimens":                 (["trays", "resized_trays_coordinates"], {"crop_specimens", "tray_stage"}),
+    "guides":                    (["resized_trays", "resized_trays_coordinates"], {"create_traymaps", "tray_stage"}),
+    "mask_coordinates":          (["specimens"], {"outline_specimens"}),
+    "mask_png":                  (["mask_coordinates"], {"create_masks", "mask_stage"}),
+    "measurements":              (["mask_png", "mask_coordinates"], {"measure_specimens", "mask_stage"}),
+    "no_background":             (["specimens", "mask_png"], {"censor_background", "cutout_stage"}),
+    "pin_coordinates":           (["no_background"], {"outline_pins"}),
+    "full_masks":                (["mask_png", "pin_coordinates"], {"create_pinmask"}),
+    "transparencies":            (["no_background", "full_masks"], {"create_transparency", "cutout_stage"}),
+    "whitebg_specimens":         (["no_background", "full_masks"], {"create_transparency", "cutout_stage"}),
+}
+
+# Folders of whole-drawer files; elsewhere only per-tray and per-specimen files are tracked
+DRAWER_LEVEL_DIRS = {"resized", "coordinates"}
+
+# Detection folders -> (model key, CLI argument prefix, whether overlap is passed)
+DIR_MODELS = {
+    "coordinates":               ("drawer", "drawer", True),
+    "label_coordinates":         ("label", "label", True),
+    "resized_trays_coordinates": ("tray", "tray", True),
+    "mask_coordinates":          ("mask", "beetle", False),
+    "pin_coordinates":           ("pin", "pin", False),
+}
+
+# Steps skipped when the manifest shows nothing changed since a run that had
+# nothing to do. Inference and LLM steps always run, since their failures can
+# be transient; merge_data always rebuilds its output.
+MANIFEST_SKIP_STEPS = {
+    step for step, resource in STEP_RESOURCE_CLASS.items() if resource == "cpu"
+} - {"merge_data"}
+
 SPECIMEN_ONLY_STEPS = {
     "outline_specimens", "create_masks", "fix_masks", "measure_specimens",
     "censor_background", "outline_pins", "create_pinmask", "create_transparency",
@@ -289,10 +669,40 @@ def parse_arguments():
                               help="Show status report and exit")
     drawer_group.add_argument("--write-report", action="store_true",
                               help="Write CSV status report to status_reports/")
+    drawer_group.add_argument("--verify", action="store_true",
+                              help="With --status, rescan every drawer's files instead of reading the cached summary")
 
     proc_group = parser.add_argument_group("Processing Options")
     proc_group.add_argument("--rerun", action="store_true",
                             help="Overwrite existing outputs (requires confirmation)")
+    proc_group.add_argument("--parallel-drawers", type=int, dest="parallel_drawers",
+                            help="Run up to this many drawers at once (see resources.scheduling)")
+    proc_group.add_argument("--stream", action="store_true",
+                            help="Stream trays and specimens through resize_trays..create_masks "
+                                 "instead of finishing each step for the whole drawer first")
+    proc_group.add_argument("--plan", action="store_true",
+                            help="Show how many items each selected step would process per drawer, "
+                                 "with time and LLM token estimates from past runs, and exit")
+    proc_group.add_argument("--profile", nargs="?", const="cprofile", choices=["cprofile", "sample"],
+                            help="Profile each step and save the profile next to the run log: cprofile "
+                                 "(default; this process only) or sample (py-spy; includes worker processes)")
+    proc_group.add_argument("--watch", action="store_true",
+                            help="Keep running: sort and process new images as they arrive in unsorted/ "
+                                 "(see resources.watch)")
+
+    queue_group = parser.add_argument_group("Work Queue (several nodes sharing drawers/)")
+    queue_group.add_argument("--enqueue", action="store_true",
+                             help="Add the selected drawers and steps to the shared work queue and exit")
+    queue_group.add_argument("--worker", action="store_true",
+                             help="Run steps from the shared work queue until interrupted")
+    queue_group.add_argument("--worker-resources", type=str, dest="worker_resources",
+                             help="With --worker, only take steps of these classes (e.g. cpu,llm)")
+    queue_group.add_argument("--until-empty", action="store_true", dest="until_empty",
+                             help="With --worker, exit once nothing is left to run")
+    queue_group.add_argument("--queue-status", action="store_true", dest="queue_status",
+                             help="Show the work queue and exit")
+    queue_group.add_argument("--requeue-failed", action="store_true", dest="requeue_failed",
+                             help="Move failed work queue units back to pending and exit")
 
     mem_group = parser.add_argument_group("Memory Management")
     seq_group = mem_group.add_mutually_exclusive_group()
@@ -335,6 +745,94 @@ def determine_steps(args):
     return result
 
 
+def group_tray_stage_steps(steps, config):
+    """
+    Collapse tray-level image steps into a single 'tray_stage' entry when
+    processing.tray_stage is 'shared' or 'fused'. The grouped stage runs where
+    the last of its members would have run, so detections are available by then.
+    """
+    mode = config.processing_flags.get("tray_stage", "separate")
+    if mode not in TRAY_STAGE_STEPS:
+        return steps
+
+    members = [s for s in steps if s in TRAY_STAGE_STEPS[mode]]
+    # Detection steps read the resized trays, so resizing can only join the
+    # group when no detection step is scheduled in this run
+    if "resize_trays" in members and ({"find_traylabels", "find_specimens"} & set(steps)):
+        members.remove("resize_trays")
+    if len(members) < 2:
+        return steps
+
+    last = max(steps.index(s) for s in members)
+    return [
+        "tray_stage" if i == last else s
+        for i, s in enumerate(steps)
+        if s not in members or i == last
+    ]
+
+
+def group_mask_stage_steps(steps, config):
+    """
+    Collapse create_masks, fix_masks and measure_specimens into a single
+    'mask_stage' entry when processing.mask_stage is 'fused', so each mask is
+    built, fixed and measured in memory and written once.
+    """
+    if config.processing_flags.get("mask_stage", "separate") != "fused":
+        return steps
+
+    members = [s for s in steps if s in MASK_STAGE_STEPS]
+    if len(members) < 2:
+        return steps
+
+    last = max(steps.index(s) for s in members)
+    return [
+        "mask_stage" if i == last else s
+        for i, s in enumerate(steps)
+        if s not in members or i == last
+    ]
+
+
+def group_cutout_stage_steps(steps, config):
+    """
+    Collapse censor_background and create_transparency into a single
+    'cutout_stage' entry when processing.cutout_stage is 'fused', so each
+    specimen crop is decoded once for all three cutout images.
+    """
+    if config.processing_flags.get("cutout_stage", "separate") != "fused":
+        return steps
+
+    members = [s for s in steps if s in CUTOUT_STAGE_STEPS]
+    if len(members) < 2:
+        return steps
+    # Pin detection reads the no-background images and create_transparency
+    # needs the pin masks, so the steps cannot merge across the pin steps
+    first, last = min(steps.index(s) for s in members), max(steps.index(s) for s in members)
+    if {"outline_pins", "create_pinmask"} & set(steps[first:last]):
+        return steps
+
+    return [
+        "cutout_stage" if i == last else s
+        for i, s in enumerate(steps)
+        if s not in members or i == last
+    ]
+
+
+def group_stage_steps(steps, config):
+    """Apply the configured tray, mask and cutout step grouping."""
+    steps = group_mask_stage_steps(group_tray_stage_steps(steps, config), config)
+    return group_cutout_stage_steps(steps, config)
+
+
+def stage_members(stage, steps, config):
+    """The steps a grouped stage entry stands for when `steps` (ungrouped) are grouped."""
+    grouped = group_stage_steps(steps, config)
+    if stage == "tray_stage":
+        candidates = TRAY_STAGE_STEPS.get(config.processing_flags.get("tray_stage", "separate"), ())
+    else:
+        candidates = STAGE_MEMBERS[stage]
+    return [s for s in steps if s in candidates and s not in grouped]
+
+
 def confirm_rerun(steps_to_run, drawers):
     print(f"\n{'='*60}\nRERUN CONFIRMATION\n{'='*60}")
     print(f"  Steps:   {', '.join(steps_to_run)}")
@@ -426,6 +924,9 @@ NESTED_OUTPUT_STEPS = {
     "censor_background", "outline_pins", "create_pinmask", "create_transparency",
 }
 
+# Drawers rescanned at once by --status --verify (the scans mostly wait on storage)
+STATUS_SCAN_WORKERS = 8
+
 SENTINEL_FILES = {
     "measure_specimens":      "measurements.csv",
     "transcribe_barcodes":    "unit_barcodes.csv",
@@ -435,38 +936,231 @@ SENTINEL_FILES = {
 }
 
 
-def _has_output(config, drawer_id, step) -> tuple:
+# Work units counted per step in the status report: step -> (folder the work
+# comes from, unit). Units are "file", "drawer", "tray" or "specimen"; steps
+# not listed only report whether their output exists.
+STATUS_UNITS = {
+    "resize_drawers":      ("fullsize", "file"),
+    "find_trays":          ("resized", "file"),
+    "crop_trays":          ("coordinates", "drawer"),
+    "resize_trays":        ("trays", "tray"),
+    "find_traylabels":     ("resized_trays", "tray"),
+    "crop_labels":         ("label_coordinates", "tray"),
+    "find_specimens":      ("resized_trays", "tray"),
+    "crop_specimens":      ("resized_trays_coordinates", "tray"),
+    "create_traymaps":     ("resized_trays_coordinates", "tray"),
+    "outline_specimens":   ("specimens", "specimen"),
+    "create_masks":        ("mask_coordinates", "specimen"),
+    "measure_specimens":   ("mask_png", "specimen"),
+    "censor_background":   ("mask_png", "specimen"),
+    "outline_pins":        ("no_background", "specimen"),
+    "create_pinmask":      ("pin_coordinates", "specimen"),
+    "create_transparency": ("full_masks", "specimen"),
+}
+
+# Transcription steps count trays by their rows in the step's CSV:
+# step -> (folder the work comes from, file suffix there, CSV folder, CSV
+# name, column that is filled in once the tray is done)
+TRANSCRIPTION_UNITS = {
+    "transcribe_barcodes":  ("labels", "_barcode.jpg", "tray_level", "unit_barcodes.csv", "unit_barcode"),
+    "transcribe_geocodes":  ("labels", "_geocode.jpg", "tray_level", "geocodes.csv", "geocode"),
+    "transcribe_taxonomy":  ("labels", "_label.jpg", "tray_level", "taxonomy.csv", "full_transcription"),
+    "transcribe_specimens": ("resized_trays_coordinates", ".json", "tray_context", "specimen_localities.csv", "tray"),
+}
+
+
+def _has_output_in(step, files) -> tuple:
     """
-    Return (has_output: bool, extra: str | None) for a given step.
+    Return (has_output: bool, extra: str | None) for a step from the files of
+    its output folder (folder-relative, '/'-separated).
     extra carries the merge timestamp when relevant.
     """
-    output_path = config.get_drawer_directory(drawer_id, STEP_OUTPUT_DIRS[step])
-
-    if not os.path.exists(output_path):
-        return False, None
-
     if step == "merge_data":
-        dirs = [d for d in os.listdir(output_path)
-                if os.path.isdir(os.path.join(output_path, d))]
-        return bool(dirs), max(dirs) if dirs else None
+        dirs = sorted({f.split('/')[0] for f in files if '/' in f})
+        return bool(dirs), dirs[-1] if dirs else None
 
     if step in SENTINEL_FILES:
-        return os.path.exists(os.path.join(output_path, SENTINEL_FILES[step])), None
+        return SENTINEL_FILES[step] in files, None
 
     if step in NESTED_OUTPUT_STEPS:
-        for subdir in os.listdir(output_path):
-            subdir_path = os.path.join(output_path, subdir)
-            if os.path.isdir(subdir_path) and any(
-                os.path.isfile(os.path.join(subdir_path, f))
-                for f in os.listdir(subdir_path)
-            ):
-                return True, None
-        return False, None
+        return any(f.count('/') == 1 for f in files), None
+
+    return any('/' not in f for f in files), None
+
+
+def _units(files, unit) -> set:
+    """Work units (trays, specimens, drawers or files) among a folder's files."""
+    if unit == "file":
+        return set(files)
+    units = set()
+    for f in files:
+        item = item_id(f)
+        parent = parent_item(item)
+        grandparent = parent_item(parent) if parent else None
+        if unit == "drawer":
+            units.add(grandparent or parent or item)
+        elif unit == "tray" and parent:
+            units.add(parent if grandparent else item)
+        elif unit == "specimen" and grandparent:
+            units.add(item)
+    return units
+
+
+def _transcribed(config, drawer_id, step) -> set:
+    """Trays with a finished row in a transcription step's CSV."""
+    _, _, csv_key, csv_name, column = TRANSCRIPTION_UNITS[step]
+    path = os.path.join(config.get_drawer_directory(drawer_id, csv_key), csv_name)
+    if not os.path.exists(path):
+        return set()
+    key = "tray" if column == "tray" else "tray_id"
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row[key] for row in csv.DictReader(f)
+                if row.get(key) and row.get(column) not in (None, "", "ERROR")}
+
+
+def _list_folder(root, nested) -> list:
+    """Files under root (folder-relative, '/'-separated), leaving out nested drawer folders."""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if os.path.normpath(os.path.join(dirpath, d)) not in nested]
+        rel = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        files.extend(f if rel == '.' else f"{rel}/{f}" for f in filenames if not f.endswith(SQLITE_SIDECARS))
+    return files
+
+
+def _status_dirs(step) -> set:
+    """Folders the status of a step is taken from: its output folder and the folder its work comes from."""
+    keys = {STEP_OUTPUT_DIRS[step]}
+    if step in STATUS_UNITS:
+        keys.add(STATUS_UNITS[step][0])
+    if step in TRANSCRIPTION_UNITS:
+        keys.add(TRANSCRIPTION_UNITS[step][0])
+    return keys
+
+
+def _status_steps(step) -> list:
+    """Steps whose status a run of step can change: those whose status folders it writes."""
+    if step not in STEP_DIRS:
+        return []
+    outputs = set(STEP_DIRS[step][1])
+    return [s for s in STEP_OUTPUT_DIRS if _status_dirs(s) & outputs]
+
+
+def _drawer_files(config, drawer_id, manifest=None, full=False, keys=None) -> dict:
+    """
+    Folder key -> files of the given folders (default: every folder the
+    status report reads). From the manifest (brought up to date first;
+    full=True stats every file) or, if none is given, from a walk of the
+    folders. Masks kept in masks.sqlite containers are listed under their
+    PNG names.
+    """
+    directories = config.get_drawer_directories(drawer_id)
+    if keys is None:
+        keys = set().union(*(_status_dirs(step) for step in STEP_OUTPUT_DIRS))
+    files = {}
+    for key in keys:
+        if manifest is not None:
+            manifest.sync(key, full=full)
+            files[key] = manifest.files(key)
+        else:
+            root = os.path.normpath(directories[key])
+            nested = {os.path.normpath(p) for k, p in directories.items() if k != key}
+            files[key] = _list_folder(root, nested)
+        for f in [f for f in files[key] if f.split('/')[-1] == MASK_CONTAINER_NAME]:
+            folder = os.path.dirname(f)
+            for png in iter_masks(os.path.join(directories[key], folder)):
+                files[key].append('/'.join(filter(None, (folder, os.path.basename(png)))))
+    return files
+
+
+def _drawer_status(config, drawer_id, manifest=None, full=False, steps=None) -> dict:
+    """
+    Completion of every step (or of the given steps) for a drawer: step ->
+    {"state": "complete", "partial" or "missing", "done": items done,
+    "total": items to do (None when not counted), "extra": merge timestamp}.
+    Only the folders those steps are counted from are read.
+    """
+    steps = list(STEP_OUTPUT_DIRS) if steps is None else steps
+    files = _drawer_files(config, drawer_id, manifest, full,
+                          keys=set().union(*(_status_dirs(step) for step in steps)))
+    measured = set()
+    if "measure_specimens" in steps:
+        measured = set(measured_ids(os.path.join(config.get_drawer_directory(drawer_id, "measurements"),
+                                                 "measurements.csv")))
+    status = {}
+    for step in steps:
+        key = STEP_OUTPUT_DIRS[step]
+        has, extra = _has_output_in(step, files[key])
+        done = total = None
+        if step in STATUS_UNITS:
+            source_key, unit = STATUS_UNITS[step]
+            source = _units(files[source_key], unit)
+            output = measured if step == "measure_specimens" else _units(files[key], unit)
+            # Names only line up between folders for trays and specimens
+            done = len(output & source) if unit in ("tray", "specimen") else min(len(output), len(source))
+            total = len(source)
+        elif step in TRANSCRIPTION_UNITS:
+            source_key, suffix = TRANSCRIPTION_UNITS[step][:2]
+            source = {item_id(f) for f in files[source_key] if f.endswith(suffix)}
+            done = len(_transcribed(config, drawer_id, step) & source)
+            total = len(source)
+        if total:
+            state = "complete" if done >= total else "partial" if done or has else "missing"
+        else:
+            state = "complete" if has else "missing"
+        status[step] = {"state": state, "done": done, "total": total or None, "extra": extra}
+    return status
+
+
+def _update_status(manifest, config, drawer_id, steps) -> dict:
+    """
+    Refresh the given steps in the completion summary --status reads from
+    the drawer manifest, and return their status. Without a complete
+    summary to update, --status builds one the next time it is shown.
+    """
+    status = _drawer_status(config, drawer_id, manifest, steps=steps)
+    summary, _ = manifest.load_summary("status")
+    if summary is not None and set(summary) == set(STEP_OUTPUT_DIRS):
+        summary.update(status)
+        manifest.save_summary("status", summary)
+    return status
 
-    return any(os.path.isfile(os.path.join(output_path, f)) for f in os.listdir(output_path)), None
 
+def _load_drawer_status(config, drawer_id, verify=False) -> tuple:
+    """
+    (status, time it was taken) for a drawer: the summary cached in its
+    manifest, or a fresh one when there is none or verify is set (a full
+    rescan). Without the manifest the folders are walked.
+    """
+    if not config.processing_flags.get("manifest", True):
+        return _drawer_status(config, drawer_id), time.time()
+    cached = os.path.exists(os.path.join(config.get_drawer_path(drawer_id), MANIFEST_NAME))
+    manifest = manifest_for(config.get_drawer_path(drawer_id), config.get_drawer_directories(drawer_id))
+    if cached and not verify:
+        status, updated_at = manifest.load_summary("status")
+        if status is not None and set(status) == set(STEP_OUTPUT_DIRS):
+            return status, updated_at
+    status = _drawer_status(config, drawer_id, manifest, full=verify)
+    manifest.save_summary("status", status)
+    return status, time.time()
+
+
+def _format_step(step, entry) -> str:
+    if entry["total"] is None:
+        return step
+    if entry["state"] == "partial":
+        return f"{step} {entry['done']}/{entry['total']} ({100 * entry['done'] // entry['total']}%)"
+    return f"{step} {entry['done']}/{entry['total']}"
+
+
+def generate_status_report(config, write_report=False, verify=False):
+    """
+    Log the completion of every step for every drawer.
 
-def generate_status_report(config, write_report=False):
+    By default each drawer's summary comes from its manifest, where the
+    pipeline refreshes it after every step run. verify rescans every file
+    of every drawer instead, several drawers at a time.
+    """
     discover_and_sort_drawers(config)
     available_drawers = config.get_existing_drawers()
 
@@ -474,39 +1168,47 @@ def generate_status_report(config, write_report=False):
         log("No drawers found")
         return
 
+    def load(drawer_id):
+        try:
+            return _load_drawer_status(config, drawer_id, verify)
+        except Exception as e:
+            log(f"Could not read status of {drawer_id}: {e}")
+            return None, None
+
+    workers = min(len(available_drawers), STATUS_SCAN_WORKERS if verify else 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(load, available_drawers))
+
     log("=" * 80)
-    log("DRAWER STATUS REPORT")
+    log("DRAWER STATUS REPORT" + (" (verified)" if verify else ""))
     log("=" * 80)
 
     report_data = []
 
-    for drawer_id in available_drawers:
+    for drawer_id, (status, updated_at) in zip(available_drawers, results):
         drawer_type = "specimen-only" if is_specimen_only_drawer(config, drawer_id) else "standard"
-        log(f"\n{drawer_id} ({drawer_type}):")
+        as_of = f", as of {datetime.fromtimestamp(updated_at):%Y-%m-%d %H:%M}" if updated_at else ""
+        log(f"\n{drawer_id} ({drawer_type}{as_of}):")
         log("-" * 40)
 
-        complete, missing = [], []
+        status = status or {}
         drawer_status = {"drawer_id": drawer_id}
-
+        by_state = {"complete": [], "partial": [], "missing": []}
         for step in STEP_OUTPUT_DIRS:
-            try:
-                has, extra = _has_output(config, drawer_id, step)
-                if has:
-                    complete.append(step)
-                    drawer_status[step] = "complete"
-                    if extra:
-                        drawer_status["merge_data_timestamp"] = extra
-                else:
-                    missing.append(step)
-                    drawer_status[step] = "missing"
-            except Exception:
-                missing.append(step)
-                drawer_status[step] = "missing"
-
-        if complete:
-            log(f"  Complete: {', '.join(complete)}")
-        if missing:
-            log(f"  Missing:  {', '.join(missing)}")
+            entry = status.get(step, {"state": "missing", "done": None, "total": None, "extra": None})
+            by_state[entry["state"]].append(_format_step(step, entry))
+            drawer_status[step] = entry["state"]
+            drawer_status[f"{step}_done"] = entry["done"]
+            drawer_status[f"{step}_total"] = entry["total"]
+            if entry["extra"]:
+                drawer_status["merge_data_timestamp"] = entry["extra"]
+
+        if by_state["complete"]:
+            log(f"  Complete: {', '.join(by_state['complete'])}")
+        if by_state["partial"]:
+            log(f"  Partial:  {', '.join(by_state['partial'])}")
+        if by_state["missing"]:
+            log(f"  Missing:  {', '.join(by_state['missing'])}")
         if "merge_data_timestamp" in drawer_status:
             log(f"  Most recent merge: {drawer_status['merge_data_timestamp']}")
 
@@ -522,7 +1224,9 @@ def _write_status_csv(report_data):
     os.makedirs("status_reports", exist_ok=True)
     timestamp = datetime.now().strftime("%d_%m_%Y_%H_%M")
     path = os.path.join("status_reports", f"status_report_{timestamp}.csv")
-    fieldnames = ["drawer_id"] + list(STEP_OUTPUT_DIRS) + ["merge_data_timestamp"]
+    fieldnames = (["drawer_id"] + list(STEP_OUTPUT_DIRS) + ["merge_data_timestamp"]
+                  + [f"{step}_{count}" for step in list(STATUS_UNITS) + list(TRANSCRIPTION_UNITS)
+                     for count in ("done", "total")])
     with open(path, "w", newline="") as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
         writer.writeheader()
@@ -530,19 +1234,356 @@ def _write_status_csv(report_data):
     log(f"Status report written to {path}")
 
 
+# ---------------------------------------------------------------------------
+# Planning (--plan)
+# ---------------------------------------------------------------------------
+
+# Steps run together as one grouped stage
+STAGE_MEMBERS = {
+    "tray_stage":   TRAY_STAGE_STEPS["fused"],
+    "mask_stage":   MASK_STAGE_STEPS,
+    "cutout_stage": CUTOUT_STAGE_STEPS,
+}
+
+
+def _units_done(step, before, after):
+    """Trays, specimens or files a run processed, from the drawer status before and after it (None if unknown)."""
+    if step == "merge_data":
+        return 1
+    # These redo every item on each run
+    if step == "fix_masks":
+        return after["create_masks"]["done"]
+    if step == "transcribe_geocodes":
+        return after[step]["total"] or 0
+    counts = [after[m]["done"] - ((before.get(m) or {}).get("done") or 0)
+              for m in STAGE_MEMBERS.get(step, (step,)) if after.get(m, {}).get("done") is not None]
+    return max([0] + counts) if counts else None
+
+
+def _step_unit(step) -> str:
+    if step in STAGE_MEMBERS:
+        step = STAGE_MEMBERS[step][-1]
+    if step in STATUS_UNITS:
+        return STATUS_UNITS[step][1]
+    if step in TRANSCRIPTION_UNITS:
+        return "tray"
+    return "drawer" if step == "merge_data" else "specimen"
+
+
+def _pending_units(step, members, status, average_totals, produced) -> tuple:
+    """
+    (items the step would process, whether that is an estimate). Items whose
+    source folder an earlier step of the plan still has to fill are estimated
+    from the average of the other drawers.
+    """
+    if step == "merge_data":
+        return 1, False
+    if step == "fix_masks":
+        members = ["create_masks"]
+    pending, estimated = 0, False
+    for member in members:
+        entry = status.get(member) or {}
+        total, done = entry.get("total"), entry.get("done") or 0
+        if step == "fix_masks" or member == "transcribe_geocodes":
+            count = total or 0
+        else:
+            count = (total or 0) - done
+        source_key = (STATUS_UNITS.get(member) or TRANSCRIPTION_UNITS.get(member) or (None,))[0]
+        if not total and source_key in produced and average_totals.get(member):
+            count, estimated = round(average_totals[member]), True
+        pending = max(pending, count)
+    return pending, estimated
+
+
+def _work_history(config) -> tuple:
+    """
+    From every drawer's manifest: step -> [seconds, items, input tokens,
+    output tokens, items with token counts] over recorded runs, and step ->
+    average number of items per drawer.
+    """
+    history, totals = {}, {}
+    for drawer_id in config.get_existing_drawers():
+        # A read-only copy: planning must not create or migrate manifests
+        manifest = open_snapshot(config.get_drawer_path(drawer_id), config.get_drawer_directories(drawer_id))
+        if manifest is None:
+            continue
+        try:
+            for step, seconds, units, usage in manifest.work_history():
+                if not units or not seconds:
+                    continue
+                entry = history.setdefault(step, [0.0, 0, 0, 0, 0])
+                entry[0] += seconds
+                entry[1] += units
+                if usage:
+                    entry[2] += usage["input_tokens"]
+                    entry[3] += usage["output_tokens"]
+                    entry[4] += units
+            status, _ = manifest.load_summary("status")
+        finally:
+            manifest.close()
+        for step, entry in (status or {}).items():
+            if entry.get("total"):
+                totals.setdefault(step, []).append(entry["total"])
+    return history, {step: sum(t) / len(t) for step, t in totals.items()}
+
+
+def _seconds_per_unit(step, history):
+    """Recorded seconds per item of a step; for a stage without history, the sum over its steps."""
+    if step in history:
+        return history[step][0] / history[step][1]
+    rates = [history[m][0] / history[m][1] for m in STAGE_MEMBERS.get(step, ()) if m in history]
+    return sum(rates) if rates else None
+
+
+def _format_estimate(seconds) -> str:
+    if seconds is None:
+        return "?"
+    h, rem = divmod(int(round(seconds)), 3600)
+    m, s = divmod(rem, 60)
+    if h:
+        return f"{h}h {m:02d}m"
+    return f"{m}m {s:02d}s" if m else f"{s}s"
+
+
+def _step_enabled(config, step) -> bool:
+    """Transcription steps only run when switched on under processing (taxonomy is on by default)."""
+    if step not in TRANSCRIPTION_UNITS:
+        return True
+    return config.processing_flags.get(step, step == "transcribe_taxonomy")
+
+
+def generate_plan(config, specified, steps_to_run, args):
+    """
+    Log how many items each selected step would process per drawer, with
+    time estimates from the recorded throughput of past runs and token
+    estimates for transcription steps from their recorded usage. Nothing is
+    run, moved, decoded or written: counts come from an in-memory copy of
+    each drawer's manifest (brought up to date with one stat per folder, or
+    every file with verify), folder listings for drawers without one, and
+    the transcription CSVs.
+    """
+    unsorted = [f for f in os.listdir(config.unsorted_directory) if not f.startswith('.')]
+    drawers = config.get_existing_drawers()
+    if specified:
+        missing = [d for d in specified if d not in drawers]
+        if missing:
+            log(f"Warning: Specified drawers not found: {', '.join(missing)}")
+        drawers = [d for d in specified if d in drawers]
+    if not drawers:
+        log("No drawers to plan")
+        return
+
+    history, average_totals = _work_history(config)
+    use_manifest = config.processing_flags.get("manifest", True)
+    params = _step_params(config, args)
+    llm = config.llm_config
+    total_seconds, total_in, total_out = 0.0, 0, 0
+    no_history, any_estimated = set(), False
+
+    log("=" * 80)
+    log("PLAN (dry run; nothing is processed)")
+    log("=" * 80)
+    for drawer_id in drawers:
+        steps = _plan_drawer(config, drawer_id, steps_to_run)
+        if not steps:
+            continue
+        manifest = (open_snapshot(config.get_drawer_path(drawer_id), config.get_drawer_directories(drawer_id))
+                    if use_manifest else None)
+        status = _drawer_status(config, drawer_id, manifest, full=args.verify)
+
+        log(f"\n{drawer_id}:")
+        log(f"  {'Step':<24} {'Pending':>10}  {'Unit':<9} {'Time':>9} {'Tokens in/out':>18}")
+        log("  " + "-" * 74)
+        produced, drawer_seconds = set(), 0.0
+        for step in steps:
+            members = [m for m in STAGE_MEMBERS.get(step, ()) if m in steps_to_run] or [step]
+            note = ""
+            if not _step_enabled(config, step):
+                pending, estimated, note = 0, False, "disabled"
+            elif (manifest is not None and step in MANIFEST_SKIP_STEPS and not args.rerun
+                  and manifest.up_to_date(step, params, *STEP_DIRS[step])):
+                pending, estimated, note = 0, False, "up to date"
+            else:
+                pending, estimated = _pending_units(step, members, status, average_totals, produced)
+            produced.update(STEP_DIRS.get(step, ([], []))[1])
+            any_estimated = any_estimated or estimated
+
+            seconds = tokens = None
+            if pending:
+                rate = _seconds_per_unit(step, history)
+                if rate is None:
+                    no_history.add(step)
+                else:
+                    seconds = pending * rate
+                    drawer_seconds += seconds
+                entry = history.get(step)
+                if STEP_RESOURCE_CLASS.get(step) == "llm" and entry and entry[4]:
+                    tokens = (round(pending * entry[2] / entry[4]), round(pending * entry[3] / entry[4]))
+                    total_in += tokens[0]
+                    total_out += tokens[1]
+
+            count = f"{'~' if estimated else ''}{pending}"
+            tokens_str = f"{tokens[0]:,}/{tokens[1]:,}" if tokens else ""
+            log(f"  {step:<24} {count:>10}  {_step_unit(step):<9} "
+                f"{_format_estimate(seconds) if pending else '':>9} {tokens_str:>18}  {note}".rstrip())
+        total_seconds += drawer_seconds
+        log(f"  {'':<24} {'':>10}  {'':<9} {_format_estimate(drawer_seconds):>9}")
+        if manifest is not None:
+            manifest.close()
+
+    log("\n" + "=" * 80)
+    log(f"Drawers: {len(drawers)}   Estimated time: {_format_estimate(total_seconds)} one drawer at a time")
+    parallel = args.parallel_drawers or config.scheduling_settings["parallel_drawers"]
+    if parallel > 1 and len(drawers) > 1:
+        log(f"  about {_format_estimate(total_seconds / min(parallel, len(drawers)))} "
+            f"with {parallel} drawers at once (if their steps overlap well)")
+    if total_in or total_out:
+        log(f"LLM tokens: ~{total_in:,} in / ~{total_out:,} out ({llm['model']})")
+        if llm.get("input_price_per_mtok") is not None and llm.get("output_price_per_mtok") is not None:
+            cost = (total_in * llm["input_price_per_mtok"] + total_out * llm["output_price_per_mtok"]) / 1e6
+            log(f"LLM cost: ~{cost:,.2f} (llm.input_price_per_mtok / output_price_per_mtok)")
+    if no_history:
+        log(f"No recorded runs yet for {', '.join(sorted(no_history))}; their time is left out")
+    if any_estimated:
+        log("~ = estimated from the average of the other drawers (the folder it reads is filled earlier in the plan)")
+    if unsorted:
+        log(f"{len(unsorted)} image(s) in {config.unsorted_directory} are not yet sorted into drawers and not counted")
+    log("=" * 80)
+
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
 
+def _drawer_steps(config, drawer_id, steps_to_run):
+    """Ungrouped steps to run for a drawer, or None if it cannot be processed."""
+    if not validate_drawer_structure(config, drawer_id):
+        log(f"Skipping invalid drawer: {drawer_id}")
+        return None
+    if is_specimen_only_drawer(config, drawer_id):
+        steps_to_run = [s for s in steps_to_run if s in SPECIMEN_ONLY_STEPS]
+    return steps_to_run or None
+
+
+def _plan_drawer(config, drawer_id, steps_to_run):
+    """Steps to run for a drawer, grouped into stages, or None if it cannot be processed."""
+    steps = _drawer_steps(config, drawer_id, steps_to_run)
+    return group_stage_steps(steps, config) if steps else None
+
+
+def run_watch(config, args):
+    """Sort and process new drawer images as they arrive until interrupted."""
+    steps_to_run = determine_steps(args)
+    scheduling = config.scheduling_settings
+    if args.parallel_drawers is not None:
+        scheduling["parallel_drawers"] = args.parallel_drawers
+    if args.rerun or args.stream:
+        log("--watch ignores --rerun and --stream")
+
+    log("DrawerDissect Pipeline (watch)")
+    log("==============================")
+    log(f"Deployment:  {config.deployment}")
+    log(f"Steps:       {', '.join(steps_to_run)}")
+
+    daemon = WatchDaemon(
+        config,
+        lambda drawer_id: _plan_drawer(config, drawer_id, steps_to_run),
+        lambda drawer_id, step: run_step_for_drawer(step, config, drawer_id, args),
+        scheduling,
+    )
+    daemon.run()
+
+
+def _work_queue(config):
+    settings = config.queue_settings
+    directory = settings["directory"] or os.path.join(os.path.dirname(config.unsorted_directory), ".queue")
+    return WorkQueue(directory, settings)
+
+
+def enqueue_drawers(config, drawers, steps_to_run):
+    """Add each drawer's steps to the shared work queue."""
+    queue = _work_queue(config)
+    added = 0
+    for drawer_id in drawers:
+        drawer_steps = _drawer_steps(config, drawer_id, steps_to_run)
+        if not drawer_steps:
+            continue
+        steps = group_stage_steps(drawer_steps, config)
+        # Workers run exactly these members, whatever steps they were started with
+        members = {step: stage_members(step, drawer_steps, config) for step in steps if step in STAGE_MEMBERS}
+        if queue.enqueue(drawer_id, steps, members):
+            log(f"Queued {drawer_id}: {', '.join(steps)}")
+            added += 1
+    log(f"Added {added} drawer(s) to {queue.directory}")
+
+
+def run_queue_worker(config, args):
+    """Lease and run units from the shared work queue."""
+    resources = None
+    if args.worker_resources:
+        resources = {r.strip() for r in args.worker_resources.split(",")}
+        unknown = resources - set(STEP_RESOURCE_CLASS.values())
+        if unknown:
+            raise ValueError(f"Unknown resource classes: {', '.join(sorted(unknown))}")
+    queue = _work_queue(config)
+    track_queue("work_queue", queue.counts)
+    counts = run_worker(
+        queue,
+        lambda drawer_id, step, members: run_step_for_drawer(step, config, drawer_id, args, members),
+        resources=resources,
+        resource_of=lambda step: STEP_RESOURCE_CLASS.get(step, "cpu"),
+        until_empty=args.until_empty,
+    )
+    log(f"Worker finished: {counts['done']} done, {counts['failed']} failed, {counts['lost']} lost")
+
+
+def show_queue_status(config):
+    queue = _work_queue(config)
+    status = queue.status()
+    counts = status["counts"]
+    log(f"Work queue: {queue.directory}")
+    log(f"  {counts['pending']} pending, {counts['leased']} leased, {counts['done']} done, {counts['failed']} failed")
+    if status["drawers"]:
+        log(f"\n{'Drawer':<25} {'Pending':>8} {'Leased':>8} {'Done':>8} {'Failed':>8}")
+        for drawer_id, c in sorted(status["drawers"].items()):
+            log(f"{drawer_id:<25} {c['pending']:>8} {c['leased']:>8} {c['done']:>8} {c['failed']:>8}")
+    if status["leases"]:
+        log("\nLeases:")
+        for lease in status["leases"]:
+            log(f"  {lease['drawer']} {lease['step']} on {lease['worker']} "
+                f"(heartbeat {lease['heartbeat_age']:.0f}s ago)")
+
+
+def _start_run_log(config, args):
+    """
+    Open the run log (resources.instrumentation), start the progress
+    aggregator (resources.progress) and the metrics exporters (resources.metrics).
+    """
+    settings = config.instrumentation_settings
+    path = start_run(settings)
+    if path:
+        log(f"Run log:     {path}")
+    progress = config.progress_settings
+    event_log = None
+    if progress["event_log"]:
+        base = os.path.splitext(path)[0] if path else os.path.join(
+            settings["directory"], f"run_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}")
+        os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+        event_log = f"{base}_progress.jsonl"
+    start_progress(progress, event_log)
+    metrics.start(config.metrics_settings)
+
+
 def main():
     config = DrawerDissectConfig()
+    resource_scheduler.configure(config.resource_scheduler_settings)
     start_time = time.time()
 
     try:
         args = parse_arguments()
 
         if args.status:
-            generate_status_report(config, write_report=args.write_report)
+            generate_status_report(config, write_report=args.write_report, verify=args.verify)
             return
 
         if args.list_drawers:
@@ -557,12 +1598,41 @@ def main():
                 log("No drawers found")
             return
 
+        if args.watch:
+            _start_run_log(config, args)
+            run_watch(config, args)
+            return
+
+        if args.queue_status:
+            show_queue_status(config)
+            return
+
+        if args.requeue_failed:
+            log(f"Moved {_work_queue(config).requeue_failed()} failed unit(s) back to pending")
+            return
+
+        if args.worker:
+            _start_run_log(config, args)
+            run_queue_worker(config, args)
+            return
+
         specified = [d.strip() for d in args.drawers.split(",")] if args.drawers else None
+
+        if args.plan:
+            generate_plan(config, specified, determine_steps(args), args)
+            return
+
         drawers_to_process = get_drawers_to_process(config, specified)
         if not drawers_to_process:
             log("No drawers to process")
             return
 
+        if args.enqueue:
+            if args.rerun:
+                log("--enqueue ignores --rerun")
+            enqueue_drawers(config, drawers_to_process, determine_steps(args))
+            return
+
         valid_drawers, specimen_only_drawers = [], []
         for drawer_id in drawers_to_process:
             if validate_drawer_structure(config, drawer_id):
@@ -597,6 +1667,7 @@ def main():
 
     log("DrawerDissect Pipeline")
     log("======================")
+    _start_run_log(config, args)
     log(f"Deployment:  {config.deployment}")
     log(f"Drawers:     {', '.join(valid_drawers)}")
     if specimen_only_drawers:
@@ -604,9 +1675,19 @@ def main():
     log(f"Steps:       {', '.join(steps_to_run)}")
     if args.rerun:
         log("Mode: RERUN (overwriting existing outputs)")
-
+    if args.stream:
+        log("Mode: STREAM (trays and specimens flow through steps as soon as inputs exist)")
+
+    scheduling = config.scheduling_settings
+    if args.parallel_drawers is not None:
+        scheduling["parallel_drawers"] = args.parallel_drawers
+    if args.stream and scheduling["parallel_drawers"] > 1:
+        log("Streaming mode runs one drawer at a time; ignoring parallel_drawers")
+        scheduling["parallel_drawers"] = 1
+
+    planned = {}
+    failed_drawers = []
     for drawer_id in valid_drawers:
-        log(f"\n{'='*20} Processing {drawer_id} {'='*20}")
         is_specimen_only = drawer_id in specimen_only_drawers
 
         drawer_steps = [
@@ -617,10 +1698,33 @@ def main():
         if not drawer_steps:
             log(f"No valid steps to run for drawer {drawer_id}")
             continue
+        planned[drawer_id] = drawer_steps
+
+    if scheduling["parallel_drawers"] > 1 and len(planned) > 1:
+        scheduler = DrawerScheduler(
+            lambda drawer_id, step: run_step_for_drawer(step, config, drawer_id, args),
+            scheduling,
+        )
+        failed_drawers = scheduler.run({d: group_stage_steps(s, config) for d, s in planned.items()})
+        scheduler.log_timeline()
+    else:
+        depth = {"waiting": len(planned), "running": 0}
+        track_queue("drawers", lambda: dict(depth))
+        for drawer_id, drawer_steps in planned.items():
+            depth["waiting"] -= 1
+            depth["running"] = 1
+            log(f"\n{'='*20} Processing {drawer_id} {'='*20}")
 
-        for step in drawer_steps:
-            log(f"Running {step} for {drawer_id}")
-            run_step_for_drawer(step, config, drawer_id, args)
+            if args.stream:
+                run_drawer_streaming(config, drawer_id, drawer_steps, args)
+                continue
+
+            drawer_steps = group_stage_steps(drawer_steps, config)
+
+            for step in drawer_steps:
+                log(f"Running {step} for {drawer_id}")
+                run_step_for_drawer(step, config, drawer_id, args)
+        depth["running"] = 0
 
     total = time.time() - start_time
     h, rem = divmod(total, 3600)
@@ -633,7 +1737,10 @@ def main():
         time_str = f"{s:.2f}s"
 
     log("\n" + "=" * 50)
-    log("Pipeline completed successfully")
+    if failed_drawers:
+        log(f"Pipeline completed with errors in {len(failed_drawers)} drawer(s): {', '.join(failed_drawers)}")
+    else:
+        log("Pipeline completed successfully")
     log(f"Total processing time: {time_str}")
     log("=" * 50)
 
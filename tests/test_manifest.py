@@ -0,0 +1,92 @@
+"""
+Tests for content-based invalidation in functions/manifest.py, which
+deletes files from the drawer folders.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.manifest import Manifest, derives_from  # noqa: E402
+
+DRAWER = "drawer_01"
+TRAYS = [f"{DRAWER}_tray_{n:02d}" for n in (1, 2)]
+
+
+def _write(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def _drawer(tmp_path):
+    """A drawer with its image, tray coordinates, a size ratio table and two tray crops."""
+    drawer_dir = tmp_path / DRAWER
+    directories = {key: str(drawer_dir / key) for key in ("fullsize", "coordinates", "trays")}
+    _write(drawer_dir / "fullsize" / f"{DRAWER}.jpg", "image")
+    _write(drawer_dir / "fullsize" / "sizeratios.csv", "drawer_ID,px_mm_ratio\n")
+    _write(drawer_dir / "coordinates" / f"{DRAWER}_1000.json", '{"predictions": [1, 2]}')
+    for tray in TRAYS:
+        _write(drawer_dir / "trays" / f"{tray}.jpg", "crop")
+
+    manifest = Manifest(str(drawer_dir), directories)
+    for key in directories:
+        manifest.sync(key, full=True)
+    manifest.record("trays", ["fullsize", "coordinates"], "{}")
+    return drawer_dir, manifest
+
+
+def _invalidate(manifest):
+    for key in ("fullsize", "coordinates"):
+        manifest.sync(key, full=True)
+    return manifest.invalidate("trays", ["fullsize", "coordinates"], "{}")
+
+
+def _trays(drawer_dir):
+    return sorted(os.listdir(drawer_dir / "trays"))
+
+
+def test_drawer_inputs_are_matched_by_name():
+    assert derives_from(TRAYS[0], DRAWER)
+    assert derives_from(TRAYS[0], f"{DRAWER}_1000")
+    assert not derives_from(TRAYS[0], "sizeratios")
+    assert not derives_from(TRAYS[0], "drawer_02")
+    assert derives_from(f"{DRAWER}_1000", DRAWER)
+    assert derives_from(f"{TRAYS[0]}_spec_001", TRAYS[0])
+    assert not derives_from(f"{TRAYS[0]}_spec_001", TRAYS[1])
+
+
+def test_unchanged_inputs_keep_outputs(tmp_path):
+    drawer_dir, manifest = _drawer(tmp_path)
+    _invalidate(manifest)
+    assert _trays(drawer_dir) == [f"{tray}.jpg" for tray in TRAYS]
+
+
+def test_editing_sizeratios_keeps_tray_crops(tmp_path):
+    drawer_dir, manifest = _drawer(tmp_path)
+    _write(drawer_dir / "fullsize" / "sizeratios.csv", "drawer_ID,px_mm_ratio\ndrawer_01,12.5\n")
+    _invalidate(manifest)
+    assert _trays(drawer_dir) == [f"{tray}.jpg" for tray in TRAYS]
+
+
+def test_changed_drawer_image_removes_tray_crops(tmp_path):
+    drawer_dir, manifest = _drawer(tmp_path)
+    _write(drawer_dir / "fullsize" / f"{DRAWER}.jpg", "another image")
+    _invalidate(manifest)
+    assert _trays(drawer_dir) == []
+    assert manifest.files("trays") == []
+
+
+def test_changed_coordinates_remove_tray_crops(tmp_path):
+    drawer_dir, manifest = _drawer(tmp_path)
+    _write(drawer_dir / "coordinates" / f"{DRAWER}_1000.json", '{"predictions": [1, 3]}')
+    _invalidate(manifest)
+    assert _trays(drawer_dir) == []
+
+
+def test_changed_settings_remove_outputs(tmp_path):
+    drawer_dir, manifest = _drawer(tmp_path)
+    manifest.invalidate("trays", ["fullsize", "coordinates"], '{"confidence": 50}')
+    assert _trays(drawer_dir) == []
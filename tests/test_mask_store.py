@@ -0,0 +1,39 @@
+"""
+Tests for functions/mask_store.py, where a folder may hold a mask as a PNG,
+in its masks.sqlite container, or both.
+
+Run with: python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.mask_store import export_pngs, iter_masks, read_mask, write_mask  # noqa: E402
+
+
+def _mask(value: int) -> np.ndarray:
+    mask = np.zeros((20, 30), dtype=np.uint8)
+    mask[5:15, 5:25] = value
+    return mask
+
+
+def test_iter_masks_yields_each_mask_once(tmp_path):
+    tray = tmp_path / "tray_01"
+    write_mask(str(tray / "spec_001.png"), _mask(255), store=True)
+    write_mask(str(tray / "spec_002.png"), _mask(255), store=True)
+    cv2.imwrite(str(tray / "spec_003.png"), _mask(255))
+    assert export_pngs(str(tmp_path)) == 2  # spec_001 and spec_002 now exist both ways
+
+    paths = sorted(iter_masks(str(tmp_path)))
+    assert paths == [str(tray / f"spec_00{n}.png") for n in (1, 2, 3)]
+
+
+def test_png_is_read_before_the_container(tmp_path):
+    path = str(tmp_path / "tray_01" / "spec_001.png")
+    write_mask(path, _mask(255), store=True)
+    cv2.imwrite(path, _mask(0))
+    assert read_mask(path).max() == 0
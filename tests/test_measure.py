@@ -0,0 +1,119 @@
+"""
+Tests for the len1/len2 engines in functions/measure.py.
+
+"compat" must give the values of the original nested loops, which produced
+the measurements.csv files of existing collections; "calipers" must give the
+hull diameter and the hull width perpendicular to it.
+
+Run with: python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from functions.measure import _caliper_lengths, _compat_lengths, get_lengths  # noqa: E402
+
+SEEDS = range(300)
+
+
+def _original_lengths(hull_points):
+    """The nested loops get_lengths used before the engines were added."""
+    max_distance = 0
+    len1_points = None
+    for i in range(len(hull_points)):
+        for j in range(i + 1, len(hull_points)):
+            dist = np.sqrt(np.sum((hull_points[i] - hull_points[j]) ** 2))
+            if dist > max_distance:
+                max_distance = dist
+                len1_points = (hull_points[i], hull_points[j])
+
+    if len1_points is None:
+        return None, None, None, None
+
+    len1_vector = len1_points[1] - len1_points[0]
+    len1_unit = len1_vector / np.linalg.norm(len1_vector)
+
+    max_perp_distance = 0
+    len2_points = None
+    for i in range(len(hull_points)):
+        for j in range(i + 1, len(hull_points)):
+            vector = hull_points[j] - hull_points[i]
+            dist = np.sqrt(np.sum((hull_points[i] - hull_points[j]) ** 2))
+            angle = np.abs(np.dot(vector / np.linalg.norm(vector), len1_unit))
+            if angle < 0.1 and dist > max_perp_distance:
+                max_perp_distance = dist
+                len2_points = (hull_points[i], hull_points[j])
+
+    return max_distance, len1_points, max_perp_distance, len2_points
+
+
+def _random_hull(seed):
+    """Convex hull points of a random specimen-like blob: an elongated, rotated cloud of pixels."""
+    rng = np.random.default_rng(seed)
+    count = int(rng.integers(3, 200))
+    points = rng.normal(size=(count, 2)) * [rng.uniform(20, 400), rng.uniform(5, 150)]
+    angle = rng.uniform(0, np.pi)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    contour = np.round(points @ rotation.T + 1000).astype(np.int32).reshape(-1, 1, 2)
+    return cv2.convexHull(contour).reshape(-1, 2)
+
+
+def _same_pair(a, b):
+    return a is None and b is None or (a is not None and b is not None
+                                       and all(np.array_equal(p, q) for p, q in zip(a, b)))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_compat_matches_original_loops(seed):
+    hull_points = _random_hull(seed)
+    expected = _original_lengths(hull_points)
+    len1, len1_points, len2, len2_points = _compat_lengths(hull_points)
+
+    assert len1 == pytest.approx(expected[0], abs=1e-9)
+    assert _same_pair(len1_points, expected[1])
+    assert len2 == pytest.approx(expected[2], abs=1e-9)
+    assert _same_pair(len2_points, expected[3])
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_calipers_give_diameter_and_perpendicular_width(seed):
+    hull_points = _random_hull(seed)
+    points = hull_points.astype(np.float64)
+    len1, (a, b), width, _ = _caliper_lengths(hull_points)
+
+    pairwise = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    assert len1 == pytest.approx(pairwise.max(), abs=1e-9)
+    assert np.linalg.norm(b.astype(np.float64) - a) == pytest.approx(len1, abs=1e-9)
+
+    direction = (b - a) / np.linalg.norm(b - a)
+    offsets = points @ np.array([-direction[1], direction[0]])
+    assert width == pytest.approx(offsets.max() - offsets.min(), abs=1e-6)
+
+
+def test_engines_agree_on_len1():
+    for seed in SEEDS:
+        hull_points = _random_hull(seed)
+        assert _caliper_lengths(hull_points)[0] == pytest.approx(_compat_lengths(hull_points)[0], abs=1e-9)
+
+
+def test_degenerate_contours():
+    point = np.array([[[5, 5]]], dtype=np.int32)
+    assert get_lengths(point, "compat") == (None, None, None, None)
+    assert get_lengths(point, "calipers") == (None, None, None, None)
+
+    line = np.array([[[0, 0]], [[10, 0]], [[20, 0]]], dtype=np.int32)
+    for engine in ("compat", "calipers"):
+        len1, _, len2, len2_points = get_lengths(line, engine)
+        assert len1 == pytest.approx(20)
+        assert len2 == 0 and len2_points is None
+
+
+def test_default_engine_is_compat():
+    hull_points = _random_hull(0)
+    contour = hull_points.reshape(-1, 1, 2).astype(np.int32)
+    assert get_lengths(contour)[2] == pytest.approx(_original_lengths(hull_points)[2], abs=1e-9)